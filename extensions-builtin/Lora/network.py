@@ -2,7 +2,7 @@ import os
 from collections import namedtuple
 import enum
 
-from modules import sd_models, cache, errors, hashes, shared
+from modules import sd_models, cache, errors, hashes, hash_queue, shared
 
 NetworkWeights = namedtuple('NetworkWeights', ['network_key', 'sd_key', 'w', 'sd_module'])
 
@@ -52,6 +52,9 @@ class NetworkOnDisk:
             ''
         )
 
+        if not self.hash:
+            hash_queue.service.enqueue(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors, priority=hash_queue.priority_network, callback=self.set_hash)
+
         self.sd_version = self.detect_version()
 
     def detect_version(self):
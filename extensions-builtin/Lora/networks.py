@@ -1,5 +1,8 @@
+import collections
+import itertools
 import os
 import re
+import weakref
 
 import network
 import network_lora
@@ -11,7 +14,7 @@ import network_full
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, cond_cache
 
 module_types = [
     network_lora.ModuleTypeLora(),
@@ -22,6 +25,81 @@ module_types = [
 ]
 
 
+class NetworkDeltaCache:
+    """
+    Changes to weights of layers calculated from networks, kept between generations so that switching to a different set
+    of networks doesn't need to calculate them again. Deltas are stored on the same device as the layer they are for, and
+    dropped by release_moved_layers() once the layer is moved elsewhere; total size is limited by lora_delta_cache_mb,
+    least recently used deltas are dropped first.
+    """
+
+    entry_overhead = 256
+    """size counted for every entry in addition to its tensors, so that entries without tensors are limited too"""
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.tokens = itertools.count()
+
+    def layer_key(self, layer, key):
+        token = getattr(layer, "network_delta_token", None)
+        if token is None:
+            token = next(self.tokens)
+            layer.network_delta_token = token
+            layer.network_delta_keys = set()
+
+        return token, key
+
+    def get(self, layer, key):
+        entry_key = self.layer_key(layer, key)
+        entry = self.entries.get(entry_key)
+        if entry is None:
+            return None
+
+        self.entries.move_to_end(entry_key)
+        return entry[0]
+
+    def put(self, layer, key, deltas):
+        max_size = shared.opts.lora_delta_cache_mb * 1024 * 1024
+        size = sum(x.element_size() * x.nelement() for x in deltas) + self.entry_overhead
+        if size > max_size:
+            return
+
+        entry_key = self.layer_key(layer, key)
+        self.drop(entry_key)
+        self.entries[entry_key] = (deltas, size, weakref.ref(layer))
+        self.size += size
+        layer.network_delta_keys.add(entry_key)
+
+        while self.size > max_size:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def drop_layer(self, layer):
+        for entry_key in getattr(layer, "network_delta_keys", ()):
+            self.drop(entry_key)
+
+        layer.network_delta_token = None
+        layer.network_delta_keys = set()
+
+    def drop_unused(self):
+        """removes deltas for layers of models that no longer exist"""
+
+        for entry_key, entry in list(self.entries.items()):
+            if entry[2]() is None:
+                self.drop(entry_key)
+
+
+network_delta_cache = NetworkDeltaCache()
+
+layers_with_backup = weakref.WeakSet()
+"""layers that have network_weights_backup; used to find backups and deltas left on a device that the layer moved from"""
+
+
 re_digits = re.compile(r"\d+")
 re_x_proj = re.compile(r"(.*)_([qkv]_proj)$")
 re_compiled = {}
@@ -104,6 +182,8 @@ def convert_diffusers_name_to_compvis(key, is_sd2):
 
 
 def assign_network_names_to_compvis_modules(sd_model):
+    network_delta_cache.drop_unused()
+
     network_layer_mapping = {}
 
     if shared.sd_model.is_sdxl:
@@ -190,7 +270,35 @@ def load_network(name, network_on_disk):
     return net
 
 
+def release_moved_layers():
+    """
+    Handles layers of models that were moved to another device since networks were last applied to them, such as a
+    checkpoint moved to RAM when another one becomes active: their cached deltas are dropped, and backups kept on
+    "Same device" are moved along with the layer, so that nothing of the model is left behind in VRAM.
+    """
+
+    for layer in list(layers_with_backup):
+        weights_backup = getattr(layer, "network_weights_backup", None)
+        if weights_backup is None:
+            continue
+
+        device = network_layer_weights(layer)[0].device
+        backups = weights_backup if isinstance(weights_backup, tuple) else (weights_backup, )
+
+        if shared.opts.lora_backup_location == "Same device" and backups[0].device != device:
+            moved = tuple(x.to(device) for x in backups)
+            layer.network_weights_backup = moved if isinstance(weights_backup, tuple) else moved[0]
+
+        for entry_key in getattr(layer, "network_delta_keys", ()):
+            entry = network_delta_cache.entries.get(entry_key)
+            if entry is not None and any(x.device != device for x in entry[0]):
+                network_delta_cache.drop_layer(layer)
+                break
+
+
 def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=None):
+    release_moved_layers()
+
     already_loaded = {}
 
     for net in loaded_networks:
@@ -245,17 +353,90 @@ def network_restore_weights_from_backup(self: Union[torch.nn.Conv2d, torch.nn.Li
         return
 
     if isinstance(self, torch.nn.MultiheadAttention):
-        self.in_proj_weight.copy_(weights_backup[0])
-        self.out_proj.weight.copy_(weights_backup[1])
+        self.in_proj_weight.copy_(weights_backup[0], non_blocking=True)
+        self.out_proj.weight.copy_(weights_backup[1], non_blocking=True)
     else:
-        self.weight.copy_(weights_backup)
+        self.weight.copy_(weights_backup, non_blocking=True)
+
+
+def network_backup_weight(weight):
+    """copy of original weight of a layer, in the location selected in settings"""
+
+    if shared.opts.lora_backup_location == "Same device":
+        return weight.detach().clone()
+
+    backup = weight.to(devices.cpu, copy=True)
+    if shared.opts.lora_backup_location == "Pinned CPU memory" and weight.device.type == "cuda":
+        backup = backup.pin_memory()  # faster to copy back to GPU
+
+    return backup
+
+
+def network_layer_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
+    if isinstance(self, torch.nn.MultiheadAttention):
+        return self.in_proj_weight, self.out_proj.weight
+
+    return self.weight,
+
+
+def network_key(net):
+    """identifies the changes net makes to weights; deltas are cached under this key"""
+
+    return net.name, net.mtime, net.te_multiplier, net.unet_multiplier, net.dyn_dim
+
+
+def network_calc_deltas(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention], net, network_layer_name):
+    """
+    Calculates changes to weights of layer self made by network net, as a tuple matching network_layer_weights(self).
+    Changes are calculated from original weights, so they do not depend on which other networks are applied.
+    """
+
+    weights_backup = self.network_weights_backup
+
+    module = net.modules.get(network_layer_name, None)
+    if module is not None and hasattr(self, 'weight'):
+        updown = module.calc_updown(weights_backup.to(self.weight.device, dtype=self.weight.dtype))
+
+        if len(self.weight.shape) == 4 and self.weight.shape[1] == 9:
+            # inpainting model. zero pad updown to make channel[1]  4 to 9
+            updown = torch.nn.functional.pad(updown, (0, 0, 0, 0, 0, 5))
+
+        return updown,
+
+    module_q = net.modules.get(network_layer_name + "_q_proj", None)
+    module_k = net.modules.get(network_layer_name + "_k_proj", None)
+    module_v = net.modules.get(network_layer_name + "_v_proj", None)
+    module_out = net.modules.get(network_layer_name + "_out_proj", None)
+
+    if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
+        in_proj_weight = weights_backup[0].to(self.in_proj_weight.device, dtype=self.in_proj_weight.dtype)
+        out_proj_weight = weights_backup[1].to(self.out_proj.weight.device, dtype=self.out_proj.weight.dtype)
+
+        updown_q = module_q.calc_updown(in_proj_weight)
+        updown_k = module_k.calc_updown(in_proj_weight)
+        updown_v = module_v.calc_updown(in_proj_weight)
+        updown_qkv = torch.vstack([updown_q, updown_k, updown_v])
+        updown_out = module_out.calc_updown(out_proj_weight)
+
+        return updown_qkv, updown_out
+
+    if module is not None:
+        print(f'failed to calculate network weights for layer {network_layer_name}')
+
+    return ()
+
+
+max_incremental_updates = 4
+"""after this many incremental changes, weights are restored from backup to get rid of accumulated rounding errors"""
 
 
 def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
     """
     Applies the currently selected set of networks to the weights of torch layer self.
     If weights already have this particular set of networks applied, does nothing.
-    If not, restores orginal weights from backup and alters weights according to networks.
+    If not, either subtracts changes from networks that are no longer selected and adds changes from new ones, or
+    restores orginal weights from backup and adds changes from all networks, whichever is less work.
+    Changes calculated for each network are kept in network_delta_cache.
     """
 
     network_layer_name = getattr(self, 'network_layer_name', None)
@@ -263,56 +444,62 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
         return
 
     current_names = getattr(self, "network_current_names", ())
-    wanted_names = tuple((x.name, x.te_multiplier, x.unet_multiplier, x.dyn_dim) for x in loaded_networks)
+    wanted_names = tuple(network_key(x) for x in loaded_networks)
 
     weights_backup = getattr(self, "network_weights_backup", None)
     if weights_backup is None:
         if isinstance(self, torch.nn.MultiheadAttention):
-            weights_backup = (self.in_proj_weight.to(devices.cpu, copy=True), self.out_proj.weight.to(devices.cpu, copy=True))
+            weights_backup = (network_backup_weight(self.in_proj_weight), network_backup_weight(self.out_proj.weight))
         else:
-            weights_backup = self.weight.to(devices.cpu, copy=True)
+            weights_backup = network_backup_weight(self.weight)
 
         self.network_weights_backup = weights_backup
+        layers_with_backup.add(self)
 
-    if current_names != wanted_names:
-        network_restore_weights_from_backup(self)
-
-        for net in loaded_networks:
-            module = net.modules.get(network_layer_name, None)
-            if module is not None and hasattr(self, 'weight'):
-                with torch.no_grad():
-                    updown = module.calc_updown(self.weight)
-
-                    if len(self.weight.shape) == 4 and self.weight.shape[1] == 9:
-                        # inpainting model. zero pad updown to make channel[1]  4 to 9
-                        updown = torch.nn.functional.pad(updown, (0, 0, 0, 0, 0, 5))
-
-                    self.weight += updown
-                    continue
+    if current_names == wanted_names:
+        return
 
-            module_q = net.modules.get(network_layer_name + "_q_proj", None)
-            module_k = net.modules.get(network_layer_name + "_k_proj", None)
-            module_v = net.modules.get(network_layer_name + "_v_proj", None)
-            module_out = net.modules.get(network_layer_name + "_out_proj", None)
-
-            if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
-                with torch.no_grad():
-                    updown_q = module_q.calc_updown(self.in_proj_weight)
-                    updown_k = module_k.calc_updown(self.in_proj_weight)
-                    updown_v = module_v.calc_updown(self.in_proj_weight)
-                    updown_qkv = torch.vstack([updown_q, updown_k, updown_v])
-                    updown_out = module_out.calc_updown(self.out_proj.weight)
-
-                    self.in_proj_weight += updown_qkv
-                    self.out_proj.weight += updown_out
-                    continue
+    removed = list(current_names)
+    added = []
+    for key in wanted_names:
+        if key in removed:
+            removed.remove(key)
+        else:
+            added.append(key)
+
+    removed_deltas = [network_delta_cache.get(self, key) for key in removed]
+    incremental = (
+        shared.opts.lora_incremental_apply and
+        getattr(self, "network_incremental_updates", 0) < max_incremental_updates and
+        len(removed) + len(added) < len(wanted_names) and
+        all(x is not None for x in removed_deltas)
+    )
+
+    nets = {network_key(x): x for x in loaded_networks}
+    weights = network_layer_weights(self)
+
+    with torch.no_grad():
+        if incremental:
+            for deltas in removed_deltas:
+                for weight, delta in zip(weights, deltas):
+                    weight -= delta
+
+            self.network_incremental_updates = getattr(self, "network_incremental_updates", 0) + 1
+        else:
+            network_restore_weights_from_backup(self)
+            added = wanted_names
+            self.network_incremental_updates = 0
 
-            if module is None:
-                continue
+        for key in added:
+            deltas = network_delta_cache.get(self, key)
+            if deltas is None:
+                deltas = network_calc_deltas(self, nets[key], network_layer_name)
+                network_delta_cache.put(self, key, deltas)
 
-            print(f'failed to calculate network weights for layer {network_layer_name}')
+            for weight, delta in zip(weights, deltas):
+                weight += delta
 
-        self.network_current_names = wanted_names
+    self.network_current_names = wanted_names
 
 
 def network_forward(module, input, original_forward):
@@ -345,6 +532,8 @@ def network_forward(module, input, original_forward):
 def network_reset_cached_weight(self: Union[torch.nn.Conv2d, torch.nn.Linear]):
     self.network_current_names = ()
     self.network_weights_backup = None
+    self.network_incremental_updates = 0
+    network_delta_cache.drop_layer(self)
 
 
 def network_Linear_forward(self, input):
@@ -390,6 +579,8 @@ def network_MultiheadAttention_load_state_dict(self, *args, **kwargs):
 
 
 def list_available_networks():
+    cond_cache.clear()
+
     available_networks.clear()
     available_network_aliases.clear()
     forbidden_network_aliases.clear()
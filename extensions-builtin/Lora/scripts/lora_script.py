@@ -65,6 +65,9 @@ shared.options_templates.update(shared.options_section(('extra_networks', "Extra
     "lora_add_hashes_to_infotext": shared.OptionInfo(True, "Add Lora hashes to infotext"),
     "lora_show_all": shared.OptionInfo(False, "Always show all networks on the Lora page").info("otherwise, those detected as for incompatible version of Stable Diffusion will be hidden"),
     "lora_hide_unknown_for_versions": shared.OptionInfo([], "Hide networks of unknown versions for model versions", gr.CheckboxGroup, {"choices": ["SD1", "SD2", "SDXL"]}),
+    "lora_backup_location": shared.OptionInfo("CPU", "Keep original weights of layers changed by networks in", gr.Radio, {"choices": ["CPU", "Pinned CPU memory", "Same device"]}).info("Same device is fastest to restore from, but uses VRAM"),
+    "lora_delta_cache_mb": shared.OptionInfo(512, "Memory for keeping calculated changes to weights from networks between generations", gr.Number, {"precision": 0}).info("in MB, on the same device as the model; 0 = disable"),
+    "lora_incremental_apply": shared.OptionInfo(True, "When the set of networks changes, only undo removed networks and apply new ones").info("instead of restoring original weights and applying all networks again"),
 }))
 
 
@@ -93,76 +93,85 @@ function requestProgress(id_task, progressbarContainer, gallery, atEnd, onProgre
         atEnd();
     };
 
-    var fun = function(id_task, id_live_preview) {
-        request("./internal/progress", {id_task: id_task, id_live_preview: id_live_preview}, function(res) {
-            if (res.completed) {
-                removeProgressBar();
-                return;
-            }
+    // updates progressbar and preview from the response; returns false if the task is over and progressbar was removed
+    var onResponse = function(res) {
+        if (res.completed) {
+            removeProgressBar();
+            return false;
+        }
 
-            var rect = progressbarContainer.getBoundingClientRect();
+        var rect = progressbarContainer.getBoundingClientRect();
 
-            if (rect.width) {
-                divProgress.style.width = rect.width + "px";
-            }
+        if (rect.width) {
+            divProgress.style.width = rect.width + "px";
+        }
 
-            let progressText = "";
+        let progressText = "";
 
-            divInner.style.width = ((res.progress || 0) * 100.0) + '%';
-            divInner.style.background = res.progress ? "" : "transparent";
+        divInner.style.width = ((res.progress || 0) * 100.0) + '%';
+        divInner.style.background = res.progress ? "" : "transparent";
 
-            if (res.progress > 0) {
-                progressText = ((res.progress || 0) * 100.0).toFixed(0) + '%';
-            }
+        if (res.progress > 0) {
+            progressText = ((res.progress || 0) * 100.0).toFixed(0) + '%';
+        }
 
-            if (res.eta) {
-                progressText += " ETA: " + formatTime(res.eta);
-            }
+        if (res.eta) {
+            progressText += " ETA: " + formatTime(res.eta);
+        }
 
 
-            setTitle(progressText);
+        setTitle(progressText);
 
-            if (res.textinfo && res.textinfo.indexOf("\n") == -1) {
-                progressText = res.textinfo + " " + progressText;
-            }
+        if (res.textinfo && res.textinfo.indexOf("\n") == -1) {
+            progressText = res.textinfo + " " + progressText;
+        }
 
-            divInner.textContent = progressText;
+        divInner.textContent = progressText;
 
-            var elapsedFromStart = (new Date() - dateStart) / 1000;
+        var elapsedFromStart = (new Date() - dateStart) / 1000;
 
-            if (res.active) wasEverActive = true;
+        if (res.active) wasEverActive = true;
 
-            if (!res.active && wasEverActive) {
-                removeProgressBar();
-                return;
-            }
+        if (!res.active && wasEverActive) {
+            removeProgressBar();
+            return false;
+        }
+
+        if (elapsedFromStart > inactivityTimeout && !res.queued && !res.active) {
+            removeProgressBar();
+            return false;
+        }
 
-            if (elapsedFromStart > inactivityTimeout && !res.queued && !res.active) {
-                removeProgressBar();
-                return;
-            }
 
+        if (res.live_preview && gallery) {
+            rect = gallery.getBoundingClientRect();
+            if (rect.width) {
+                livePreview.style.width = rect.width + "px";
+                livePreview.style.height = rect.height + "px";
+            }
 
-            if (res.live_preview && gallery) {
-                rect = gallery.getBoundingClientRect();
-                if (rect.width) {
-                    livePreview.style.width = rect.width + "px";
-                    livePreview.style.height = rect.height + "px";
+            var img = new Image();
+            img.onload = function() {
+                livePreview.appendChild(img);
+                if (livePreview.childElementCount > 2) {
+                    livePreview.removeChild(livePreview.firstElementChild);
                 }
+            };
+            img.src = res.live_preview;
+        }
 
-                var img = new Image();
-                img.onload = function() {
-                    livePreview.appendChild(img);
-                    if (livePreview.childElementCount > 2) {
-                        livePreview.removeChild(livePreview.firstElementChild);
-                    }
-                };
-                img.src = res.live_preview;
-            }
 
+        if (onProgress) {
+            onProgress(res);
+        }
+
+        return true;
+    };
 
-            if (onProgress) {
-                onProgress(res);
+    var fun = function(id_task, id_live_preview) {
+        request("./internal/progress", {id_task: id_task, id_live_preview: id_live_preview}, function(res) {
+            if (!onResponse(res)) {
+                return;
             }
 
             setTimeout(() => {
@@ -173,5 +182,35 @@ function requestProgress(id_task, progressbarContainer, gallery, atEnd, onProgre
         });
     };
 
-    fun(id_task, 0);
+    // receives progress as server-sent events, each containing only the fields that changed; falls back to polling
+    // if the stream can't be opened or is closed before the task is over
+    var stream = function(id_task) {
+        var state = {};
+        var finished = false;
+        var source = new EventSource("./internal/progress/stream?id_task=" + encodeURIComponent(id_task));
+
+        source.onmessage = function(event) {
+            var changes = JSON.parse(event.data);
+            Object.assign(state, changes);
+            state.live_preview = changes.live_preview;
+
+            if (!onResponse(state)) {
+                finished = true;
+                source.close();
+            }
+        };
+
+        source.onerror = function() {
+            source.close();
+            if (!finished) {
+                fun(id_task, state.id_live_preview || 0);
+            }
+        };
+    };
+
+    if (window.EventSource) {
+        stream(id_task);
+    } else {
+        fun(id_task, 0);
+    }
 }
@@ -1,22 +1,23 @@
 import base64
+import json
 import io
 import os
 import time
 import datetime
 import uvicorn
 import gradio as gr
-from threading import Lock
 from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart
-from modules.api import models
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, job_queue, cond_cache, hash_queue, upscale_cache
+from modules.api import models, batching, results
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
@@ -27,6 +28,7 @@ from modules.sd_models import checkpoints_list, unload_model_weights, reload_mod
 from modules.sd_vae import vae_dict
 from modules.sd_models_config import find_checkpoint_config_near_filename
 from modules.realesrgan_model import get_realesrgan_models
+from modules.upscaler import model_cache
 from modules import devices
 from typing import Dict, List, Any
 import piexif
@@ -66,7 +68,29 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
-def encode_pil_to_base64(image):
+def image_file_format():
+    """returns extension and media type of files produced by encode_pil_to_bytes"""
+
+    extension = opts.samples_format.lower()
+    return extension, "image/jpeg" if extension in ("jpg", "jpeg") else f"image/{extension}"
+
+
+def decode_uploaded_image(file):
+    try:
+        return Image.open(BytesIO(file.file.read()))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Invalid uploaded image") from e
+
+
+def validate_response_format(response_format):
+    response_format = response_format or "json"
+    if response_format not in models.response_formats:
+        raise HTTPException(status_code=422, detail=f"Unknown response format {response_format}; must be one of: {', '.join(models.response_formats)}")
+
+    return response_format
+
+
+def encode_pil_to_bytes(image):
     with io.BytesIO() as output_bytes:
 
         if opts.samples_format.lower() == 'png':
@@ -95,7 +119,11 @@ def encode_pil_to_base64(image):
 
         bytes_data = output_bytes.getvalue()
 
-    return base64.b64encode(bytes_data)
+    return bytes_data
+
+
+def encode_pil_to_base64(image):
+    return base64.b64encode(encode_pil_to_bytes(image))
 
 
 def api_middleware(app: FastAPI):
@@ -163,7 +191,7 @@ def api_middleware(app: FastAPI):
 
 
 class Api:
-    def __init__(self, app: FastAPI, queue_lock: Lock):
+    def __init__(self, app: FastAPI, queue_lock: job_queue.ExclusiveLock):
         if shared.cmd_opts.api_auth:
             self.credentials = {}
             for auth in shared.cmd_opts.api_auth.split(","):
@@ -176,6 +204,8 @@ class Api:
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/img2img/upload", self.img2img_upload_api, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/results/{result_id}/{index}", self.get_result_file, methods=["GET"])
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
@@ -203,6 +233,11 @@ class Api:
         self.add_api_route("/sdapi/v1/train/embedding", self.train_embedding, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/cond-cache", self.get_cond_cache, methods=["GET"], response_model=models.CondCacheResponse)
+        self.add_api_route("/sdapi/v1/cond-cache/clear", self.clear_cond_cache, methods=["POST"])
+        self.add_api_route("/sdapi/v1/upscale-cache", self.get_upscale_cache, methods=["GET"], response_model=models.UpscaleCacheResponse)
+        self.add_api_route("/sdapi/v1/upscale-cache/clear", self.clear_upscale_cache, methods=["POST"])
+        self.add_api_route("/sdapi/v1/hashing", self.get_hashing_status, methods=["GET"], response_model=models.HashingStatusResponse)
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
@@ -216,6 +251,8 @@ class Api:
         self.default_script_arg_txt2img = []
         self.default_script_arg_img2img = []
 
+        self.txt2img_batcher = batching.Txt2ImgBatcher(lambda args: self.process_txt2img(args, self.default_script_arg_txt2img))
+
     def add_api_route(self, path: str, endpoint, **kwargs):
         if shared.cmd_opts.api_auth:
             return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.auth)], **kwargs)
@@ -326,10 +363,19 @@ class Api:
 
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
+        response_format = validate_response_format(args.pop('response_format', None))
 
-        with self.queue_lock:
+        if self.txt2img_batcher.can_batch(args, selectable_scripts is not None or bool(txt2imgreq.alwayson_scripts)):
+            processed = self.txt2img_batcher.submit(args)
+        else:
+            processed = self.process_txt2img(args, script_args, selectable_scripts)
+
+        return self.images_response(models.TextToImageResponse, processed, send_images, response_format, vars(txt2imgreq))
+
+    def process_txt2img(self, args, script_args, selectable_scripts=None):
+        with job_queue.scheduler.job(job_queue.diffusion):
             with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
-                p.scripts = script_runner
+                p.scripts = scripts.scripts_txt2img
                 p.outpath_grids = opts.outdir_txt2img_grids
                 p.outpath_samples = opts.outdir_txt2img_samples
 
@@ -342,9 +388,7 @@ class Api:
                     processed = process_images(p)
                 shared.state.end()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
-        return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
+        return processed
 
     def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
         init_images = img2imgreq.init_images
@@ -355,6 +399,34 @@ class Api:
         if mask:
             mask = decode_base64_to_image(mask)
 
+        return self.process_img2img(img2imgreq, [decode_base64_to_image(x) for x in init_images], mask)
+
+    async def img2img_upload_api(self, request: Request):
+        """
+        Same as img2img, but images are uploaded as files in multipart/form-data instead of base64 strings: init_images
+        (one or more files), optional mask file, and a payload field with the rest of the request as JSON.
+        """
+
+        form = await request.form()
+
+        try:
+            img2imgreq = models.StableDiffusionImg2ImgProcessingAPI.parse_raw(form.get("payload") or "{}")
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid payload: {e}") from e
+
+        init_images = [decode_uploaded_image(x) for x in form.getlist("init_images")]
+        if not init_images:
+            raise HTTPException(status_code=404, detail="Init image not found")
+
+        mask = form.get("mask")
+        mask = decode_uploaded_image(mask) if mask else None
+
+        img2imgreq.init_images = []
+        img2imgreq.mask = None
+
+        return await run_in_threadpool(self.process_img2img, img2imgreq, init_images, mask)
+
+    def process_img2img(self, img2imgreq, init_images, mask):
         script_runner = scripts.scripts_img2img
         if not script_runner.scripts:
             script_runner.initialize_scripts(True)
@@ -382,10 +454,11 @@ class Api:
 
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
+        response_format = validate_response_format(args.pop('response_format', None))
 
-        with self.queue_lock:
+        with job_queue.scheduler.job(job_queue.diffusion):
             with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
-                p.init_images = [decode_base64_to_image(x) for x in init_images]
+                p.init_images = init_images
                 p.scripts = script_runner
                 p.outpath_grids = opts.outdir_img2img_grids
                 p.outpath_samples = opts.outdir_img2img_samples
@@ -399,20 +472,50 @@ class Api:
                     processed = process_images(p)
                 shared.state.end()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
             img2imgreq.mask = None
 
-        return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+        return self.images_response(models.ImageToImageResponse, processed, send_images, response_format, vars(img2imgreq))
+
+    def images_response(self, response_model, processed, send_images, response_format, parameters):
+        """makes response for txt2img/img2img in requested format; all images are encoded in parallel, first ones are sent as soon as they are ready"""
+
+        images = processed.images if send_images else []
+
+        if response_format == "zip":
+            extension, _ = image_file_format()
+            info = json.dumps({"parameters": jsonable_encoder(parameters), "info": processed.js()})
+            files = [(f"{i:05}.{extension}", data) for i, data in enumerate(results.encode_all(encode_pil_to_bytes, images))] + [("info.json", info.encode("utf8"))]
+
+            # Content-Encoding set here stops GZipMiddleware from compressing already compressed images
+            return StreamingResponse(results.zip_stream(files), media_type="application/zip", headers={"Content-Disposition": 'attachment; filename="images.zip"', "Content-Encoding": "identity"})
+
+        if response_format == "urls":
+            _, media_type = image_file_format()
+            result_id = results.store.add(results.encode_all(encode_pil_to_bytes, images), media_type)
+            urls = [f"/sdapi/v1/results/{result_id}/{i}" for i in range(len(images))]
+
+            return response_model(images=urls, parameters=parameters, info=processed.js())
+
+        b64images = [x.result() for x in results.encode_all(encode_pil_to_base64, images)]
+
+        return response_model(images=b64images, parameters=parameters, info=processed.js())
+
+    def get_result_file(self, result_id: str, index: int):
+        res = results.store.get(result_id, index)
+        if res is None:
+            raise HTTPException(status_code=404, detail="Result not found or expired")
+
+        data, media_type = res
+        return Response(content=data, media_type=media_type, headers={"Content-Encoding": "identity"})
 
     def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
 
         reqDict['image'] = decode_base64_to_image(reqDict['image'])
 
-        with self.queue_lock:
+        with job_queue.scheduler.job(job_queue.postprocess):
             result = postprocessing.run_extras(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict)
 
         return models.ExtrasSingleImageResponse(image=encode_pil_to_base64(result[0][0]), html_info=result[1])
@@ -423,7 +526,7 @@ class Api:
         image_list = reqDict.pop('imageList', [])
         image_folder = [decode_base64_to_image(x.data) for x in image_list]
 
-        with self.queue_lock:
+        with job_queue.scheduler.job(job_queue.postprocess):
             result = postprocessing.run_extras(extras_mode=1, image_folder=image_folder, image="", input_dir="", output_dir="", save_output=False, **reqDict)
 
         return models.ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
@@ -473,6 +576,9 @@ class Api:
         return models.ProgressResponse(progress=progress, eta_relative=eta_relative, state=shared.state.dict(), current_image=current_image, textinfo=shared.state.textinfo)
 
     def interrogateapi(self, interrogatereq: models.InterrogateRequest):
+        if interrogatereq.images is not None or interrogatereq.directory is not None:
+            return self.interrogate_batch(interrogatereq)
+
         image_b64 = interrogatereq.image
         if image_b64 is None:
             raise HTTPException(status_code=404, detail="Image not found")
@@ -481,7 +587,7 @@ class Api:
         img = img.convert('RGB')
 
         # Override object param
-        with self.queue_lock:
+        with job_queue.scheduler.job(job_queue.interrogate):
             if interrogatereq.model == "clip":
                 processed = shared.interrogator.interrogate(img)
             elif interrogatereq.model == "deepdanbooru":
@@ -491,6 +597,54 @@ class Api:
 
         return models.InterrogateResponse(caption=processed)
 
+    def interrogate_batch(self, interrogatereq: models.InterrogateRequest):
+        if interrogatereq.model not in ("clip", "deepdanbooru"):
+            raise HTTPException(status_code=404, detail="Model not found")
+
+        filenames = None
+        if interrogatereq.directory is not None:
+            if shared.cmd_opts.hide_ui_dir_config:
+                raise HTTPException(status_code=403, detail="Launched with --hide-ui-dir-config, directory access disabled")
+            if not os.path.isdir(interrogatereq.directory):
+                raise HTTPException(status_code=404, detail="Directory not found")
+
+        # images are decoded lazily as the batches are processed, so a large directory is never all in memory at once
+        with job_queue.scheduler.job(job_queue.interrogate):
+            if interrogatereq.model == "clip":
+                if interrogatereq.directory is not None:
+                    filenames = []
+                    pil_images = self.load_images_from_directory(interrogatereq.directory, filenames)
+                else:
+                    pil_images = (decode_base64_to_image(x).convert('RGB') for x in interrogatereq.images)
+
+                captions = list(shared.interrogator.interrogate_batch(pil_images))
+            else:
+                if interrogatereq.directory is not None:
+                    items = shared.listfiles(interrogatereq.directory)
+                else:
+                    items = (decode_base64_to_image(x) for x in interrogatereq.images)
+
+                captions = list(deepbooru.model.tag_images(items))
+
+                if interrogatereq.directory is not None:
+                    tagged = [(filename, caption) for filename, caption in zip(items, captions) if caption is not None]
+                    filenames = [filename for filename, _ in tagged]
+                    captions = [caption for _, caption in tagged]
+
+        return models.InterrogateResponse(captions=captions, filenames=filenames)
+
+    def load_images_from_directory(self, directory, filenames):
+        """yields images from files in directory, skipping those that are not images; names of the files used are appended to filenames"""
+
+        for filename in shared.listfiles(directory):
+            try:
+                image = Image.open(filename).convert('RGB')
+            except Exception:
+                continue
+
+            filenames.append(filename)
+            yield image
+
     def interruptapi(self):
         shared.state.interrupt()
 
@@ -538,16 +692,22 @@ class Api:
         return [{"name": sampler[0], "aliases":sampler[2], "options":sampler[3]} for sampler in sd_samplers.all_samplers]
 
     def get_upscalers(self):
-        return [
-            {
+        res = []
+
+        for upscaler in shared.sd_upscalers:
+            key = upscaler.scaler.model_cache_key(upscaler.data_path)
+
+            res.append({
                 "name": upscaler.name,
                 "model_name": upscaler.scaler.model_name,
                 "model_path": upscaler.data_path,
                 "model_url": None,
                 "scale": upscaler.scale,
-            }
-            for upscaler in shared.sd_upscalers
-        ]
+                "loaded": model_cache.is_loaded(key),
+                **model_cache.stats_for(key),
+            })
+
+        return res
 
     def get_latent_upscale_modes(self):
         return [
@@ -601,7 +761,7 @@ class Api:
         }
 
     def refresh_checkpoints(self):
-        with self.queue_lock:
+        with job_queue.scheduler.job(job_queue.exclusive):
             shared.refresh_checkpoints()
 
     def create_embedding(self, args: dict):
@@ -720,6 +880,21 @@ class Api:
             cuda = {'error': f'{err}'}
         return models.MemoryResponse(ram=ram, cuda=cuda)
 
+    def get_cond_cache(self):
+        return models.CondCacheResponse(**cond_cache.cache.stats())
+
+    def clear_cond_cache(self):
+        cond_cache.clear()
+
+    def get_upscale_cache(self):
+        return models.UpscaleCacheResponse(**upscale_cache.cache.stats())
+
+    def clear_upscale_cache(self):
+        upscale_cache.cache.clear()
+
+    def get_hashing_status(self):
+        return models.HashingStatusResponse(**hash_queue.service.status())
+
     def launch(self, server_name, port):
         self.app.include_router(self.router)
         uvicorn.run(self.app, host=server_name, port=port, timeout_keep_alive=shared.cmd_opts.timeout_keep_alive)
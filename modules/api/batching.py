@@ -0,0 +1,184 @@
+import copy
+import threading
+import time
+
+from modules import shared, extra_networks, images
+from modules.processing import get_fixed_seed
+from modules.shared import opts
+
+per_request_fields = {"prompt", "negative_prompt", "seed", "subseed", "batch_size"}
+"""fields in which requests merged into the same batch are allowed to differ"""
+
+
+class PendingRequest:
+    def __init__(self, args):
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PendingGroup:
+    def __init__(self):
+        self.requests = []
+        self.closed = False
+        self.size = 0
+
+
+class Txt2ImgBatcher:
+    """Holds compatible txt2img API requests for a short while and runs them as a single batch.
+
+    The first request of a group waits for the configured window, then runs everyone who joined as one call to the
+    process function with batch_size equal to the sum of their batch sizes; the result is split back per request,
+    and each request gets a grid of its own images. A request that nobody joined runs unchanged.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.lock = threading.Condition()
+        self.groups = {}
+
+    def can_batch(self, args, script_args_given):
+        if shared.opts.api_txt2img_batch_window <= 0 or script_args_given:
+            return False
+
+        return args.get("n_iter", 1) == 1 and isinstance(args.get("prompt"), str) and args.get("batch_size", 1) <= shared.opts.api_txt2img_batch_max_size
+
+    def batch_key(self, args):
+        _, extra_network_data = extra_networks.parse_prompt(args.get("prompt") or "")
+        networks = extra_networks.extra_network_data_key(extra_network_data)
+        fields = tuple(sorted((k, repr(v)) for k, v in args.items() if k not in per_request_fields))
+
+        return fields, networks
+
+    def submit(self, args):
+        """Blocks until the batch containing this request is processed; returns the request's part of the result."""
+
+        request = PendingRequest(args)
+        key = self.batch_key(args)
+        max_size = shared.opts.api_txt2img_batch_max_size
+
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None or group.closed or group.size + args.get("batch_size", 1) > max_size:
+                group = PendingGroup()
+                self.groups[key] = group
+                leader = True
+            else:
+                leader = False
+
+            group.requests.append(request)
+            group.size += args.get("batch_size", 1)
+            self.lock.notify_all()
+
+            if leader:
+                deadline = time.time() + shared.opts.api_txt2img_batch_window / 1000
+                self.lock.wait_for(lambda: group.size >= max_size or time.time() >= deadline, timeout=max(deadline - time.time(), 0))
+
+                group.closed = True
+                if self.groups.get(key) is group:
+                    del self.groups[key]
+
+        if leader:
+            self.run(group.requests)
+
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def run(self, requests):
+        try:
+            if len(requests) == 1:
+                requests[0].result = self.process(dict(requests[0].args))
+                return
+
+            args = dict(requests[0].args)
+            prompts, negative_prompts, seeds, subseeds, sizes = [], [], [], [], []
+            subseed_strength = args.get("subseed_strength", 0)
+
+            for request in requests:
+                batch_size = request.args.get("batch_size", 1)
+                seed = int(get_fixed_seed(request.args.get("seed", -1)))
+                subseed = int(get_fixed_seed(request.args.get("subseed", -1)))
+
+                # same seeds as process_images_inner would pick for this request if it ran alone
+                prompts += [request.args.get("prompt", "")] * batch_size
+                negative_prompts += [request.args.get("negative_prompt") or ""] * batch_size
+                seeds += [seed + (x if subseed_strength == 0 else 0) for x in range(batch_size)]
+                subseeds += [subseed + x for x in range(batch_size)]
+                sizes.append(batch_size)
+
+            args.update(prompt=prompts, negative_prompt=negative_prompts, seed=seeds, subseed=subseeds, batch_size=len(prompts), n_iter=1, do_not_save_grid=True)
+
+            processed = self.process(args)
+
+            for request, part in zip(requests, split_processed(processed, sizes, do_not_save_grid=requests[0].args.get("do_not_save_grid", False))):
+                request.result = part
+        except Exception as e:
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                request.done.set()
+
+
+def split_processed(processed, sizes, do_not_save_grid=True):
+    """
+    Splits Processed object for a merged batch, made without a grid, into one Processed object for each of the merged
+    requests. Unless do_not_save_grid is set, each part gets a grid of its images, returned and saved according to
+    settings, like process_images would make for that request alone.
+    """
+
+    res = []
+    image_start = processed.index_of_first_image
+    start = 0
+
+    for size in sizes:
+        part = copy.copy(processed)
+        end = start + size
+
+        part.images = processed.images[image_start + start:image_start + end]
+        part.infotexts = processed.infotexts[image_start + start:image_start + end]
+        part.all_prompts = processed.all_prompts[start:end]
+        part.all_negative_prompts = processed.all_negative_prompts[start:end]
+        part.all_seeds = processed.all_seeds[start:end]
+        part.all_subseeds = processed.all_subseeds[start:end]
+        part.prompt = part.all_prompts[0]
+        part.negative_prompt = part.all_negative_prompts[0]
+        part.seed = part.all_seeds[0]
+        part.subseed = part.all_subseeds[0]
+        part.info = part.infotexts[0] if part.infotexts else processed.info
+        part.batch_size = size
+        part.index_of_first_image = 0
+
+        if not do_not_save_grid:
+            add_grid(part)
+
+        res.append(part)
+        start = end
+
+    return res
+
+
+def add_grid(part):
+    """makes a grid of the part's images like process_images does, using the part's first infotext for it"""
+
+    unwanted_grid_because_of_img_count = len(part.images) < 2 and opts.grid_only_if_multiple
+    if not (opts.return_grid or opts.grid_save) or unwanted_grid_because_of_img_count:
+        return
+
+    grid = images.image_grid(part.images, part.batch_size)
+    text = part.infotexts[0] if part.infotexts else part.info
+
+    if opts.return_grid:
+        if opts.enable_pnginfo:
+            grid.info["parameters"] = text
+        part.images = [grid] + part.images
+        part.infotexts = [text] + part.infotexts
+        part.index_of_first_image = 1
+
+    if opts.grid_save:
+        images.save_image(grid, opts.outdir_txt2img_grids, "grid", part.seed, part.prompt, opts.grid_format, info=text, short_filename=not opts.grid_extended_filename, p=part, grid=True)
@@ -108,6 +108,7 @@ StableDiffusionTxt2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "response_format", "type": str, "default": "json"},
     ]
 ).generate_model()
 
@@ -125,16 +126,24 @@ StableDiffusionImg2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "response_format", "type": str, "default": "json"},
     ]
 ).generate_model()
 
+response_formats = ["json", "zip", "urls"]
+"""
+json: images in base64 inside the JSON response
+zip: a zip archive with image files and info.json, sent as images are encoded
+urls: JSON response with URLs of image files instead of images, valid for api_results_ttl seconds or until api_results_max_mb is used up by newer results
+"""
+
 class TextToImageResponse(BaseModel):
-    images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format, or its URL for response_format=urls.")
     parameters: dict
     info: str
 
 class ImageToImageResponse(BaseModel):
-    images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format, or its URL for response_format=urls.")
     parameters: dict
     info: str
 
@@ -191,10 +200,14 @@ class ProgressResponse(BaseModel):
 
 class InterrogateRequest(BaseModel):
     image: str = Field(default="", title="Image", description="Image to work on, must be a Base64 string containing the image's data.")
+    images: List[str] = Field(default=None, title="Images", description="List of images to work on as Base64 strings; processed in batches instead of image.")
+    directory: str = Field(default=None, title="Directory", description="Directory on the server with images to work on; processed in batches instead of image.")
     model: str = Field(default="clip", title="Model", description="The interrogate model used.")
 
 class InterrogateResponse(BaseModel):
     caption: str = Field(default=None, title="Caption", description="The generated caption for the image.")
+    captions: List[Optional[str]] = Field(default=None, title="Captions", description="The generated captions for images or files from the directory, if those were requested; null for images that failed.")
+    filenames: List[str] = Field(default=None, title="Filenames", description="Files from the directory, in the same order as captions.")
 
 class TrainResponse(BaseModel):
     info: str = Field(title="Train info", description="Response string from train embedding or hypernetwork task.")
@@ -242,6 +255,10 @@ class UpscalerItem(BaseModel):
     model_path: Optional[str] = Field(title="Path")
     model_url: Optional[str] = Field(title="URL")
     scale: Optional[float] = Field(title="Scale")
+    loaded: Optional[bool] = Field(title="Loaded", description="Whether the model is currently kept in memory")
+    loads: Optional[int] = Field(title="Loads", description="Number of times the model was loaded from disk")
+    hits: Optional[int] = Field(title="Hits", description="Number of times the model was used without loading it")
+    evictions: Optional[int] = Field(title="Evictions", description="Number of times the model was unloaded to make space for others")
 
 class LatentUpscalerModeItem(BaseModel):
     name: str = Field(title="Name")
@@ -292,6 +309,38 @@ class MemoryResponse(BaseModel):
     ram: dict = Field(title="RAM", description="System memory stats")
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
 
+class CondCacheResponse(BaseModel):
+    entries: int = Field(title="Entries", description="Number of prompt conditionings in the cache")
+    size: int = Field(title="Size", description="Total size of cached conditionings, in bytes")
+    max_size: int = Field(title="Max size", description="Cache size limit, in bytes")
+    hits: int = Field(title="Hits", description="Number of lookups that found a cached conditioning")
+    misses: int = Field(title="Misses", description="Number of lookups that had to compute the conditioning")
+    evictions: int = Field(title="Evictions", description="Number of conditionings removed from the cache")
+
+class UpscaleCacheResponse(BaseModel):
+    entries: int = Field(title="Entries", description="Number of upscaled images kept in memory")
+    size: int = Field(title="Size", description="Total size of upscaled images in memory, in bytes")
+    max_size: int = Field(title="Max size", description="Memory cache size limit, in bytes")
+    disk_entries: int = Field(title="Disk entries", description="Number of upscaled images saved on disk")
+    disk_size: int = Field(title="Disk size", description="Total size of upscaled images on disk, in bytes")
+    max_disk_size: int = Field(title="Max disk size", description="Disk cache size limit, in bytes")
+    hits: int = Field(title="Hits", description="Number of lookups that found the image in memory")
+    disk_hits: int = Field(title="Disk hits", description="Number of lookups that read the image from disk")
+    misses: int = Field(title="Misses", description="Number of lookups that had to upscale the image")
+
+class HashingTaskItem(BaseModel):
+    title: str = Field(title="Title", description="Name of the file in the hash cache")
+    filename: str = Field(title="Filename", description="Path to the file")
+    size: int = Field(title="Size", description="Size of the file, in bytes")
+    processed: int = Field(title="Processed", description="Number of bytes hashed so far")
+
+class HashingStatusResponse(BaseModel):
+    queued: int = Field(title="Queued", description="Number of files waiting to be hashed")
+    queued_bytes: int = Field(title="Queued bytes", description="Total size of files waiting to be hashed")
+    finished: int = Field(title="Finished", description="Number of files hashed since startup")
+    failed: int = Field(title="Failed", description="Number of files that could not be hashed")
+    current: List[HashingTaskItem] = Field(title="Current", description="Files being hashed right now")
+
 
 class ScriptsList(BaseModel):
     txt2img: list = Field(default=None, title="Txt2img", description="Titles of scripts (txt2img)")
@@ -0,0 +1,147 @@
+import io
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from modules import shared
+
+encoder_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="api-encode")
+"""threads encoding images for API responses; image encoders release GIL, so several images are encoded at once"""
+
+
+def encode_all(func, items):
+    """starts encoding all items in encoder_pool, returning futures in the same order; first results are ready before the last ones"""
+
+    return [encoder_pool.submit(func, item) for item in items]
+
+
+def result_of(data):
+    return data.result() if isinstance(data, Future) else data
+
+
+class StreamBuffer(io.RawIOBase):
+    """write-only file that collects written data until it's taken; lets zipfile write an archive that is sent as it's made"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(files):
+    """
+    Yields a zip archive with files from the (name, data) iterable, where data is bytes or a Future with bytes. Each
+    file is sent as soon as its data is ready. Files are stored without compression, since encoded images don't compress.
+    """
+
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, data in files:
+            archive.writestr(name, result_of(data))
+            yield buffer.take()
+
+    yield buffer.take()
+
+
+class StoredResult:
+    def __init__(self, files, media_type):
+        self.files = files
+        self.media_type = media_type
+        self.expires = time.time() + shared.opts.api_results_ttl
+        self.size = 0
+        """total length of files that finished encoding"""
+
+
+class ResultStore:
+    """
+    Keeps encoded images from API requests for api_results_ttl seconds, so that clients can download them by URL as
+    plain files instead of receiving them as base64 inside JSON. Images can be still encoding when they are added.
+    If kept images take more than api_results_max_mb, images of the oldest requests are removed before they expire.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.size = 0
+
+    def add(self, files, media_type):
+        result_id = uuid.uuid4().hex
+        result = StoredResult(files, media_type)
+
+        with self.lock:
+            self.remove_expired()
+            self.results[result_id] = result
+
+        # outside of the lock: callbacks of futures that are already done run right away
+        for data in files:
+            if isinstance(data, Future):
+                data.add_done_callback(lambda future: self.count(result_id, result, future))
+            else:
+                self.count(result_id, result, data)
+
+        return result_id
+
+    def count(self, result_id, result, data):
+        """adds length of a file that finished encoding to the total, removing oldest results if there is too much"""
+
+        if isinstance(data, Future) and data.exception() is not None:
+            return
+
+        size = len(result_of(data))
+
+        with self.lock:
+            if self.results.get(result_id) is not result:
+                return
+
+            result.size += size
+            self.size += size
+            self.remove_oversized()
+
+    def get(self, result_id, index):
+        """returns bytes of the file and its media type, or None if there is no such file or it has expired"""
+
+        with self.lock:
+            self.remove_expired()
+            result = self.results.get(result_id)
+
+        if result is None or not 0 <= index < len(result.files):
+            return None
+
+        return result_of(result.files[index]), result.media_type
+
+    def remove_expired(self):
+        now = time.time()
+        while self.results:
+            result_id, result = next(iter(self.results.items()))
+            if result.expires > now:
+                break
+
+            self.remove(result_id)
+
+    def remove_oversized(self):
+        """removes oldest results until the rest fit into api_results_max_mb; the newest result is kept even if it doesn't fit"""
+
+        max_size = shared.opts.api_results_max_mb * 1024 * 1024
+        while max_size > 0 and self.size > max_size and len(self.results) > 1:
+            self.remove(next(iter(self.results)))
+
+    def remove(self, result_id):
+        result = self.results.pop(result_id)
+        self.size -= result.size
+
+
+store = ResultStore()
@@ -1,45 +1,169 @@
 import json
 import os.path
+import sqlite3
 import threading
-import time
+from collections.abc import MutableMapping
 
 from modules.paths import data_path, script_path
 
 cache_filename = os.path.join(data_path, "cache.json")
-cache_data = None
-cache_lock = threading.Lock()
+cache_db_filename = os.path.join(data_path, "cache.db")
+cache_db = None
+cache_lock = threading.RLock()
 
-dump_cache_after = None
-dump_cache_thread = None
+cache_sections = {}
 
 
-def dump_cache():
+def open_cache_db():
     """
-    Marks cache for writing to disk. 5 seconds after no one else flags the cache for writing, it is written.
+    Opens the sqlite database with cached data, creating it if necessary. If it's a new database, and there is
+    cache.json from previous versions, its contents are imported into the database.
     """
 
-    global dump_cache_after
-    global dump_cache_thread
+    is_new = not os.path.isfile(cache_db_filename)
+
+    conn = sqlite3.connect(cache_db_filename, check_same_thread=False, isolation_level=None)
+
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (subsection TEXT NOT NULL, title TEXT NOT NULL, entry TEXT NOT NULL, PRIMARY KEY (subsection, title))")
+    except sqlite3.DatabaseError:
+        conn.close()
+
+        # write-ahead log and shared memory files belong to the old database and must not be applied to the new one
+        moved_filename = os.path.join(script_path, "tmp", "cache.db")
+        os.makedirs(os.path.dirname(moved_filename), exist_ok=True)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(cache_db_filename + suffix):
+                os.replace(cache_db_filename + suffix, moved_filename + suffix)
+
+        print('[ERROR] issue occurred while trying to open cache.db, move current cache to tmp/cache.db and create new cache')
+        return open_cache_db()
+
+    if is_new and os.path.isfile(cache_filename):
+        migrate_json_cache(conn)
+
+    return conn
 
-    def thread_func():
-        global dump_cache_after
-        global dump_cache_thread
 
-        while dump_cache_after is not None and time.time() < dump_cache_after:
-            time.sleep(1)
+def migrate_json_cache(conn):
+    try:
+        with open(cache_filename, "r", encoding="utf8") as file:
+            data = json.load(file)
+    except Exception:
+        print('[ERROR] issue occurred while trying to read cache.json, it will not be imported into the new cache')
+        return
 
+    rows = [(subsection, title, json.dumps(entry)) for subsection, entries in data.items() for title, entry in entries.items()]
+
+    with conn:
+        conn.execute("BEGIN")  # a single transaction for all rows; otherwise each one would be committed separately
+        conn.executemany("INSERT OR REPLACE INTO cache (subsection, title, entry) VALUES (?, ?, ?)", rows)
+
+    print(f"Imported {len(rows)} entries from cache.json into cache.db")
+
+
+def db():
+    global cache_db
+
+    if cache_db is None:
         with cache_lock:
-            with open(cache_filename, "w", encoding="utf8") as file:
-                json.dump(cache_data, file, indent=4)
+            if cache_db is None:
+                cache_db = open_cache_db()
+
+    return cache_db
 
-            dump_cache_after = None
-            dump_cache_thread = None
+
+class CacheSection(MutableMapping):
+    """
+    A dict-like view of one subsection of the cache. Assigning or deleting an entry writes it to the database
+    immediately in its own transaction. Entries read from the section since the last dump_cache() call are remembered,
+    so that changes made to them in-place are written by the next dump_cache() call, which then forgets them; only
+    those entries are serialized again to check for changes.
+    """
+
+    def __init__(self, subsection):
+        self.subsection = subsection
+        self.entries = {}
+        """entries read or assigned since the last flush(), by title"""
+
+        self.stored = {}
+        """json text that is in the database for each of entries"""
+
+    def __getitem__(self, title):
+        with cache_lock:
+            if title not in self.entries:
+                row = db().execute("SELECT entry FROM cache WHERE subsection = ? AND title = ?", (self.subsection, title)).fetchone()
+                if row is None:
+                    raise KeyError(title)
+
+                self.entries[title] = json.loads(row[0])
+                self.stored[title] = row[0]
+
+            return self.entries[title]
+
+    def __setitem__(self, title, entry):
+        with cache_lock:
+            self.entries[title] = entry
+            self.write(title)
+
+    def __delitem__(self, title):
+        with cache_lock:
+            cursor = db().execute("DELETE FROM cache WHERE subsection = ? AND title = ?", (self.subsection, title))
+            self.entries.pop(title, None)
+            self.stored.pop(title, None)
+
+            if cursor.rowcount == 0:
+                raise KeyError(title)
+
+    def __contains__(self, title):
+        try:
+            self[title]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        with cache_lock:
+            titles = [row[0] for row in db().execute("SELECT title FROM cache WHERE subsection = ?", (self.subsection,))]
+
+        return iter(titles)
+
+    def __len__(self):
+        with cache_lock:
+            return db().execute("SELECT COUNT(*) FROM cache WHERE subsection = ?", (self.subsection,)).fetchone()[0]
+
+    def write(self, title):
+        text = json.dumps(self.entries[title])
+        if self.stored.get(title) == text:
+            return
+
+        db().execute("INSERT OR REPLACE INTO cache (subsection, title, entry) VALUES (?, ?, ?)", (self.subsection, title, text))
+        self.stored[title] = text
+
+    def flush(self):
+        """writes entries that were changed in-place since they were read, and forgets all remembered entries"""
+
+        with cache_lock:
+            for title in self.entries:
+                self.write(title)
+
+            self.entries.clear()
+            self.stored.clear()
+
+
+def dump_cache():
+    """
+    Writes entries of the cache that were changed in-place to disk.
+
+    Entries assigned with cache(subsection)[title] = ... are written immediately, so this is only needed after
+    modifying an entry that was read from the cache.
+    """
 
     with cache_lock:
-        dump_cache_after = time.time() + 5
-        if dump_cache_thread is None:
-            dump_cache_thread = threading.Thread(name='cache-writer', target=thread_func)
-            dump_cache_thread.start()
+        for section in cache_sections.values():
+            section.flush()
 
 
 def cache(subsection):
@@ -50,27 +174,14 @@ def cache(subsection):
         subsection (str): The subsection identifier for the cache.
 
     Returns:
-        dict: The cache data for the specified subsection.
+        CacheSection: A dict-like object with the cache data for the specified subsection.
     """
 
-    global cache_data
-
-    if cache_data is None:
-        with cache_lock:
-            if cache_data is None:
-                if not os.path.isfile(cache_filename):
-                    cache_data = {}
-                else:
-                    try:
-                        with open(cache_filename, "r", encoding="utf8") as file:
-                            cache_data = json.load(file)
-                    except Exception:
-                        os.replace(cache_filename, os.path.join(script_path, "tmp", "cache.json"))
-                        print('[ERROR] issue occurred while trying to read cache.json, move current cache to tmp/cache.json and create new cache')
-                        cache_data = {}
-
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+    with cache_lock:
+        s = cache_sections.get(subsection)
+        if s is None:
+            s = CacheSection(subsection)
+            cache_sections[subsection] = s
 
     return s
 
@@ -115,6 +226,4 @@ def cached_data_for_file(subsection, title, filename, func):
         entry = {'mtime': ondisk_mtime, 'value': value}
         existing_cache[title] = entry
 
-        dump_cache()
-
     return entry['value']
@@ -1,16 +1,16 @@
 from functools import wraps
 import html
-import threading
 import time
 
-from modules import shared, progress, errors
+from modules import shared, progress, errors, job_queue
 
-queue_lock = threading.Lock()
+queue_lock = job_queue.ExclusiveLock()
+"""kept for extensions; entering it waits until no other job runs, same as before the scheduler was added"""
 
 
-def wrap_queued_call(func):
+def wrap_queued_call(func, job_type=job_queue.exclusive):
     def f(*args, **kwargs):
-        with queue_lock:
+        with job_queue.scheduler.job(job_type):
             res = func(*args, **kwargs)
 
         return res
@@ -18,7 +18,7 @@ def wrap_queued_call(func):
     return f
 
 
-def wrap_gradio_gpu_call(func, extra_outputs=None):
+def wrap_gradio_gpu_call(func, extra_outputs=None, job_type=job_queue.diffusion):
     @wraps(func)
     def f(*args, **kwargs):
 
@@ -29,17 +29,19 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
         else:
             id_task = None
 
-        with queue_lock:
-            shared.state.begin(job=id_task)
-            progress.start_task(id_task)
-
-            try:
-                res = func(*args, **kwargs)
-                progress.record_results(id_task, res)
-            finally:
-                progress.finish_task(id_task)
-
-            shared.state.end()
+        try:
+            with job_queue.scheduler.job(job_type, id_task):
+                shared.state.begin(job=id_task)
+                progress.start_task(id_task, detached=shared.state.detached)
+
+                try:
+                    res = func(*args, **kwargs)
+                    progress.record_results(id_task, res)
+                finally:
+                    progress.finish_task(id_task)
+                    shared.state.end()
+        finally:
+            progress.pending_tasks.pop(id_task, None)
 
         return res
 
@@ -66,18 +68,17 @@ def wrap_gradio_call(func, extra_outputs=None, add_stats=False):
                 arg_str += f" (Argument list truncated at {max_debug_str_len}/{len(arg_str)} characters)"
             errors.report(f"{message}\n{arg_str}", exc_info=True)
 
-            shared.state.job = ""
-            shared.state.job_count = 0
-
             if extra_outputs_array is None:
                 extra_outputs_array = [None, '']
 
             error_message = f'{type(e).__name__}: {e}'
             res = extra_outputs_array + [f"<div class='error'>{html.escape(error_message)}</div>"]
 
-        shared.state.skipped = False
-        shared.state.interrupted = False
-        shared.state.job_count = 0
+        # a job that ran alongside generation must not reset the flags of that generation
+        if not shared.state.job:
+            shared.state.skipped = False
+            shared.state.interrupted = False
+            shared.state.job_count = 0
 
         if not add_stats:
             return tuple(res)
@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from modules import shared
+
+
+def size_of(obj):
+    """approximate number of bytes taken by tensors in a conditioning object"""
+
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+
+    if isinstance(obj, dict):
+        return sum(size_of(x) for x in obj.values())
+
+    if isinstance(obj, (list, tuple)):
+        return sum(size_of(x) for x in obj)
+
+    if hasattr(obj, '__dict__'):
+        return sum(size_of(x) for x in vars(obj).values())
+
+    return 0
+
+
+class ConditioningCache:
+    """Process-wide LRU cache of computed prompt conditionings, limited by the total size of tensors in it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def max_size(self):
+        return int(shared.opts.cond_cache_size_mb * 1024 * 1024)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = size_of(value)
+        max_size = self.max_size()
+        if size > max_size:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.evictions += len(self.entries)
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+cache = ConditioningCache()
+
+
+def clear():
+    """drops all cached conditionings; to be called when something that affects them without being in the key changes: the model weights, embeddings or Lora files"""
+
+    cache.clear()
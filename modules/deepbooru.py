@@ -1,10 +1,13 @@
+import collections
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import numpy as np
+from PIL import Image, ImageOps
 
-from modules import modelloader, paths, deepbooru_model, devices, images, shared
+from modules import modelloader, paths, deepbooru_model, devices, images, shared, errors
 
 re_special = re.compile(r'([\\()])')
 
@@ -12,6 +15,10 @@ re_special = re.compile(r'([\\()])')
 class DeepDanbooru:
     def __init__(self):
         self.model = None
+        self.tag_names = None
+        self.tag_alpha_rank = None
+        self.tag_allowed = None
+        self.filtered_tags = None
 
     def load(self):
         if self.model is not None:
@@ -30,6 +37,11 @@ class DeepDanbooru:
         self.model.eval()
         self.model.to(devices.cpu, devices.dtype)
 
+        self.tag_names = np.array(self.model.tags)
+        self.tag_alpha_rank = np.argsort(np.argsort(self.tag_names, kind='stable'), kind='stable')
+        self.tag_allowed = ~np.char.startswith(self.tag_names, "rating:")
+        self.filtered_tags = None
+
     def start(self):
         self.load()
         self.model.to(devices.device)
@@ -47,41 +59,102 @@ class DeepDanbooru:
         return res
 
     def tag_multi(self, pil_image, force_disable_ranks=False):
-        threshold = shared.opts.interrogate_deepbooru_score_threshold
-        use_spaces = shared.opts.deepbooru_use_spaces
-        use_escape = shared.opts.deepbooru_escape
-        alpha_sort = shared.opts.deepbooru_sort_alpha
-        include_ranks = shared.opts.interrogate_return_ranks and not force_disable_ranks
+        return self.tag_batch([pil_image], force_disable_ranks=force_disable_ranks)[0]
+
+    def tag_batch(self, pil_images, force_disable_ranks=False):
+        """tags a list of images, running the model on deepbooru_batch_size of them at a time; model must be started"""
+
+        return list(self.tag_iter(pil_images, force_disable_ranks=force_disable_ranks))
+
+    def tag_iter(self, items, force_disable_ranks=False):
+        """
+        Tags images from an iterable of PIL images or filenames, yielding tags for each one in order, or None for files
+        that could not be read. Images are decoded and resized by a pool of deepbooru_workers threads, at most two
+        batches ahead of the model, so memory use doesn't depend on how many items there are. Model must be started.
+        """
+
+        batch_size = max(int(shared.opts.deepbooru_batch_size), 1)
+        items = iter(items)
+        exhausted = False
+
+        with ThreadPoolExecutor(max_workers=max(int(shared.opts.deepbooru_workers), 1), thread_name_prefix="deepbooru") as pool:
+            pending = collections.deque()
+
+            while True:
+                while not exhausted and len(pending) < batch_size * 2:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                    else:
+                        pending.append(pool.submit(self.prepare_image, item))
 
-        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
-        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
+                if not pending:
+                    break
+
+                batch = [pending.popleft().result() for _ in range(min(batch_size, len(pending)))]
+                yield from self.tag_prepared(batch, force_disable_ranks)
+
+    def tag_images(self, items):
+        """same as tag_iter, but starts the model before and stops it after"""
+
+        self.start()
+        try:
+            yield from self.tag_iter(items)
+        finally:
+            self.stop()
+
+    def prepare_image(self, item):
+        if isinstance(item, str):
+            try:
+                with Image.open(item) as image:
+                    item = ImageOps.exif_transpose(image).convert("RGB")
+            except Exception:
+                return None  # not an image; files in a directory are skipped the same way everywhere else
+
+        try:
+            pic = images.resize_image(2, item.convert("RGB"), 512, 512)
+            return np.array(pic, dtype=np.float32) / 255
+        except Exception as e:
+            errors.display(e, "preparing image for deepbooru")
+            return None
+
+    def tag_prepared(self, arrays, force_disable_ranks=False):
+        valid = [a for a in arrays if a is not None]
+        if not valid:
+            return [None] * len(arrays)
 
         with torch.no_grad(), devices.autocast():
-            x = torch.from_numpy(a).to(devices.device)
-            y = self.model(x)[0].detach().cpu().numpy()
+            x = torch.from_numpy(np.stack(valid)).to(devices.device)
+            y = self.model(x).detach().float().cpu().numpy()
 
-        probability_dict = {}
+        probabilities = iter(y)
+        return [None if a is None else self.tags_from_probabilities(next(probabilities), force_disable_ranks) for a in arrays]
 
-        for tag, probability in zip(self.model.tags, y):
-            if probability < threshold:
-                continue
+    def filtered_tags_mask(self):
+        filter_text = shared.opts.deepbooru_filter_tags
+        if self.filtered_tags is None or self.filtered_tags[0] != filter_text:
+            filtertags = [x.strip().replace(' ', '_') for x in filter_text.split(",")]
+            self.filtered_tags = filter_text, np.isin(self.tag_names, filtertags)
 
-            if tag.startswith("rating:"):
-                continue
+        return self.filtered_tags[1]
 
-            probability_dict[tag] = probability
+    def tags_from_probabilities(self, y, force_disable_ranks=False):
+        threshold = shared.opts.interrogate_deepbooru_score_threshold
+        use_spaces = shared.opts.deepbooru_use_spaces
+        use_escape = shared.opts.deepbooru_escape
+        alpha_sort = shared.opts.deepbooru_sort_alpha
+        include_ranks = shared.opts.interrogate_return_ranks and not force_disable_ranks
+
+        indices = np.flatnonzero((y >= threshold) & self.tag_allowed & ~self.filtered_tags_mask())
 
         if alpha_sort:
-            tags = sorted(probability_dict)
+            indices = indices[np.argsort(self.tag_alpha_rank[indices], kind='stable')]
         else:
-            tags = [tag for tag, _ in sorted(probability_dict.items(), key=lambda x: -x[1])]
+            indices = indices[np.argsort(-y[indices], kind='stable')]
 
         res = []
 
-        filtertags = {x.strip().replace(' ', '_') for x in shared.opts.deepbooru_filter_tags.split(",")}
-
-        for tag in [x for x in tags if x not in filtertags]:
-            probability = probability_dict[tag]
+        for tag, probability in zip(self.tag_names[indices].tolist(), y[indices].tolist()):
             tag_outformat = tag
             if use_spaces:
                 tag_outformat = tag_outformat.replace('_', ' ')
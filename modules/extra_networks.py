@@ -163,6 +163,12 @@ def parse_prompt(prompt):
     return prompt, res
 
 
+def extra_network_data_key(extra_network_data):
+    """returns a hashable value that is the same for equal extra network data, for use in cache keys"""
+
+    return tuple(sorted((name, tuple(tuple(params.items) for params in params_list)) for name, params_list in (extra_network_data or {}).items()))
+
+
 def parse_prompts(prompts):
     res = []
     extra_data = None
@@ -1,4 +1,4 @@
-from modules import shared
+from modules import shared, job_queue
 
 
 class FaceRestoration:
@@ -16,4 +16,5 @@ def restore_faces(np_image):
 
     face_restorer = face_restorers[0]
 
-    return face_restorer.restore(np_image)
+    with job_queue.scheduler.job(job_queue.face_restore):
+        return face_restorer.restore(np_image)
@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from modules import shared, hashes, errors
+
+priority_checkpoint = 2
+priority_network = 1
+priority_default = 0
+
+priority_now = 1000
+"""priority of a file a request is waiting for; such files are hashed on the requesting thread ahead of everything"""
+
+
+class BandwidthLimiter:
+    """Token bucket shared by all hashing threads, keeping their combined reads within hash_io_limit_mb per second."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def consume(self, size):
+        limit = shared.opts.hash_io_limit_mb * 1024 * 1024
+        if limit <= 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            start = max(self.next_time, now)
+            self.next_time = start + size / limit
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class HashTask:
+    def __init__(self, filename, title, use_addnet_hash, priority):
+        self.filename = filename
+        self.title = title
+        self.use_addnet_hash = use_addnet_hash
+        self.priority = priority
+        self.callbacks = []
+        self.running = False
+        self.done = threading.Event()
+        self.result = None
+
+        try:
+            self.size = os.path.getsize(filename)
+        except OSError:
+            self.size = 0
+
+        self.processed = 0
+
+    def progress(self, n):
+        self.processed += n
+
+
+class HashingService:
+    """
+    Calculates sha256 of model files in background threads, files with higher priority first.
+
+    Every finished hash is written to the cache right away, so after a restart only the files that were not done yet
+    are hashed again. When something needs a hash immediately, hash_now() takes the file out of the queue and hashes
+    it on the calling thread, without the bandwidth limit, or waits for it if a worker is already on it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = []
+        self.tasks = {}
+        self.workers = []
+        self.counter = itertools.count()
+        self.limiter = BandwidthLimiter()
+        self.finished = 0
+        self.failed = 0
+
+    def enqueue(self, filename, title, use_addnet_hash=False, priority=priority_default, callback=None):
+        """Queues file for hashing in background; callback, if given, is called with the hash once it is known."""
+
+        if shared.cmd_opts.no_hashing or not shared.opts.hash_in_background:
+            return
+
+        key = (title, use_addnet_hash)
+
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is None:
+                task = HashTask(filename, title, use_addnet_hash, priority)
+                self.tasks[key] = task
+            elif task.running or priority <= task.priority:
+                priority = None
+            else:
+                task.priority = priority
+
+            if callback is not None:
+                task.callbacks.append(callback)
+
+            if priority is not None:
+                heapq.heappush(self.queue, (-priority, next(self.counter), key))
+
+            self.start_workers()
+
+    def hash_now(self, filename, title, use_addnet_hash=False):
+        key = (title, use_addnet_hash)
+
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is None:
+                task = HashTask(filename, title, use_addnet_hash, priority_now)
+                self.tasks[key] = task
+
+            wait = task.running
+            task.running = True
+            task.priority = priority_now
+
+        if wait:
+            task.done.wait()
+            return task.result
+
+        self.run(task, limiter=None)
+        return task.result
+
+    def start_workers(self):
+        count = max(int(shared.opts.hash_workers), 1)
+        while len(self.workers) < min(count, len(self.tasks)):
+            thread = threading.Thread(target=self.worker, name="hashing", daemon=True)
+            self.workers.append(thread)
+            thread.start()
+
+    def next_task(self):
+        with self.lock:
+            while self.queue:
+                neg_priority, _, key = heapq.heappop(self.queue)
+                task = self.tasks.get(key)
+                if task is None or task.running or task.priority != -neg_priority:
+                    continue  # already taken, or an outdated entry left after priority change
+
+                task.running = True
+                return task
+
+            self.workers.remove(threading.current_thread())
+            return None
+
+    def worker(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+
+            self.run(task, limiter=self.limiter)
+
+    def run(self, task, limiter):
+        try:
+            task.result = hashes.sha256_from_cache(task.filename, task.title, task.use_addnet_hash)
+            if task.result is None:
+                task.result = hashes.calculate_and_store(task.filename, task.title, task.use_addnet_hash, limiter=limiter, progress=task.progress)
+
+            self.finished += 1
+        except Exception as e:
+            errors.display(e, f"calculating hash for {task.filename}")
+            self.failed += 1
+
+        with self.lock:
+            self.tasks.pop((task.title, task.use_addnet_hash), None)
+
+        task.done.set()
+
+        if task.result is not None:
+            for callback in task.callbacks:
+                try:
+                    callback(task.result)
+                except Exception as e:
+                    errors.display(e, f"processing hash for {task.filename}")
+
+    def status(self):
+        with self.lock:
+            tasks = list(self.tasks.values())
+
+        return {
+            "queued": sum(1 for task in tasks if not task.running),
+            "queued_bytes": sum(task.size for task in tasks if not task.running),
+            "finished": self.finished,
+            "failed": self.failed,
+            "current": [
+                {"title": task.title, "filename": task.filename, "size": task.size, "processed": task.processed}
+                for task in tasks if task.running
+            ],
+        }
+
+
+service = HashingService()
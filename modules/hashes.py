@@ -7,18 +7,38 @@ import modules.cache
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+blksize = 16 * 1024 * 1024
+
+
+def hash_file(file, offset=0, limiter=None, progress=None):
+    """sha256 of the file's contents starting from offset; file is read into a reused buffer in large blocks"""
 
-def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+    buffer = bytearray(blksize)
+    view = memoryview(buffer)
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    file.seek(offset)
+    while True:
+        if limiter is not None:
+            limiter.consume(blksize)
+
+        n = file.readinto(buffer)
+        if not n:
+            break
+
+        hash_sha256.update(view[:n])
+
+        if progress is not None:
+            progress(n)
 
     return hash_sha256.hexdigest()
 
 
+def calculate_sha256(filename, limiter=None, progress=None):
+    with open(filename, "rb") as f:
+        return hash_file(f, limiter=limiter, progress=progress)
+
+
 def sha256_from_cache(filename, title, use_addnet_hash=False):
     hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
     ondisk_mtime = os.path.getmtime(filename)
@@ -36,7 +56,10 @@ def sha256_from_cache(filename, title, use_addnet_hash=False):
 
 
 def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+    """
+    Returns sha256 of the file, from cache if possible. If the hash has to be calculated, it is done right away, ahead
+    of everything queued for background hashing; if the file is already being hashed in background, waits for that.
+    """
 
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
     if sha256_value is not None:
@@ -45,37 +68,40 @@ def sha256(filename, title, use_addnet_hash=False):
     if shared.cmd_opts.no_hashing:
         return None
 
-    print(f"Calculating sha256 for {filename}: ", end='')
+    from modules import hash_queue
+
+    return hash_queue.service.hash_now(filename, title, use_addnet_hash)
+
+
+def calculate_and_store(filename, title, use_addnet_hash=False, limiter=None, progress=None):
+    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+    mtime = os.path.getmtime(filename)
+
     if use_addnet_hash:
         with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
+            sha256_value = addnet_hash_safetensors(file, limiter=limiter, progress=progress)
     else:
-        sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+        sha256_value = calculate_sha256(filename, limiter=limiter, progress=progress)
+    print(f"Calculated sha256 for {filename}: {sha256_value}")  # a single print, since several files can be hashed at once
 
     hashes[title] = {
-        "mtime": os.path.getmtime(filename),
+        "mtime": mtime,
         "sha256": sha256_value,
     }
 
-    dump_cache()
-
     return sha256_value
 
 
-def addnet_hash_safetensors(b):
+def addnet_hash_safetensors(b, limiter=None, progress=None):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
-    hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
     b.seek(0)
     header = b.read(8)
     n = int.from_bytes(header, "little")
 
     offset = n + 8
-    b.seek(offset)
-    for chunk in iter(lambda: b.read(blksize), b""):
-        hash_sha256.update(chunk)
+    if progress is not None:
+        progress(offset)
 
-    return hash_sha256.hexdigest()
+    return hash_file(b, offset, limiter=limiter, progress=progress)
 
@@ -16,8 +16,9 @@ from PIL import Image, ImageFont, ImageDraw, ImageColor, PngImagePlugin
 import string
 import json
 import hashlib
+import threading
 
-from modules import sd_samplers, shared, script_callbacks, errors
+from modules import sd_samplers, shared, script_callbacks, errors, save_queue
 from modules.paths_internal import roboto_ttf_file
 from modules.shared import opts
 
@@ -486,14 +487,14 @@ def get_next_sequence_number(path, basename):
     """
     Determines and returns the next sequence number to use when saving an image in the specified directory.
 
-    The sequence starts at 0.
+    The sequence starts at 0. Files that are still being saved in background count as already existing.
     """
     result = -1
     if basename != '':
         basename = f"{basename}-"
 
     prefix_length = len(basename)
-    for p in os.listdir(path):
+    for p in os.listdir(path) + save_queue.saver.pending(path):
         if p.startswith(basename):
             parts = os.path.splitext(p[prefix_length:])[0].split('-')  # splits the filename (removing the basename first if one is defined, so the sequence number is always the first element)
             try:
@@ -504,6 +505,130 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+class SequenceDirectory:
+    def __init__(self):
+        self.mtime = None
+        self.next_numbers = {}
+        self.writing = 0
+        self.written_mtime = None
+        """mtime of the directory when writing began, or right after the latest of our writes to it finished"""
+
+
+class SequenceNumbers:
+    """
+    Allocates sequence numbers for saved images without listing the directory every time.
+
+    The first allocation for a directory and basename lists the directory once, same as get_next_sequence_number;
+    after that the next number is kept in memory and handed out under a lock, so that threads saving at the same time
+    never get the same number. Directory's mtime is remembered after each listing and after each of our own writes to
+    it; if it is different on the next allocation, something else has put files there, and the directory is listed
+    again. Our writes are told apart from others by the mtime that the directory has right after them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = {}
+
+    def get_directory(self, path):
+        """called with lock held"""
+
+        path = os.path.abspath(path)
+        directory = self.directories.get(path)
+        if directory is None:
+            directory = SequenceDirectory()
+            self.directories[path] = directory
+
+        return directory
+
+    def reserve(self, path, basename, make_filename, attempts=500):
+        """
+        Returns the next free sequence number for files starting with basename in path, and the filename made from it
+        by make_filename; the number is not given out again.
+        """
+
+        mtime = os.stat(path).st_mtime_ns
+
+        with self.lock:
+            directory = self.get_directory(path)
+
+            if directory.mtime != mtime and not directory.writing:
+                directory.next_numbers.clear()
+                directory.mtime = mtime
+
+            number = directory.next_numbers.get(basename)
+            if number is None:
+                number = get_next_sequence_number(path, basename)
+
+            filename = None
+            for i in range(attempts):
+                filename = make_filename(number + i)
+                if not save_queue.saver.exists(filename):
+                    number += i
+                    break
+            else:
+                number += attempts - 1
+
+            directory.next_numbers[basename] = number + 1
+
+        return number, filename
+
+    def begin_write(self, path):
+        with self.lock:
+            directory = self.get_directory(path)
+
+            if not directory.writing:
+                mtime = os.stat(path).st_mtime_ns
+
+                # files that appeared since our last write must not be missed when end_write() remembers the new mtime
+                if directory.mtime is not None and directory.mtime != mtime:
+                    directory.next_numbers.clear()
+                    directory.mtime = None
+
+                directory.written_mtime = mtime
+
+            directory.writing += 1
+
+    def wrote(self, path):
+        """called right after our files are written to the directory; remembers the mtime that they left it with"""
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+
+        with self.lock:
+            directory = self.get_directory(path)
+            directory.written_mtime = max(directory.written_mtime or 0, mtime)
+
+    def end_write(self, path):
+        """
+        Once none of our files are being written to the directory, its current mtime is remembered if it is the one
+        that our own writes left it with, so that they do not cause it to be listed again. If it is different, another
+        process has changed the directory while we were writing, and remembered numbers are dropped.
+        """
+
+        with self.lock:
+            directory = self.get_directory(path)
+            directory.writing -= 1
+
+            if directory.writing:
+                return
+
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+
+            if directory.mtime is not None and mtime is not None and mtime == directory.written_mtime:
+                directory.mtime = mtime
+            else:
+                directory.next_numbers.clear()
+                directory.mtime = None
+
+
+sequence_numbers = SequenceNumbers()
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None, pnginfo_section_name='parameters'):
     """
     Saves image to filename, including geninfo as text information for generation info.
@@ -610,13 +735,11 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             file_decoration = f"-{file_decoration}"
 
         if add_number:
-            basecount = get_next_sequence_number(path, basename)
-            fullfn = None
-            for i in range(500):
-                fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
-                fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
-                    break
+            def make_filename(number):
+                fn = f"{number:05}" if basename == '' else f"{basename}-{number:04}"
+                return os.path.join(path, f"{fn}{file_decoration}.{extension}")
+
+            _, fullfn = sequence_numbers.reserve(path, basename, make_filename)
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
     else:
@@ -649,38 +772,55 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         fullfn_without_extension = fullfn_without_extension[:max_name_len - max(4, len(extension))]
         params.filename = fullfn_without_extension + extension
         fullfn = params.filename
-    _atomically_save_image(image, fullfn_without_extension, extension)
 
     image.already_saved_as = fullfn
 
-    oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
-    if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
-        ratio = image.width / image.height
-        resize_to = None
-        if oversize and ratio > 1:
-            resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
-        elif oversize:
-            resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+    txt_fullfn = f"{fullfn_without_extension}.txt" if opts.save_txt and info is not None else None
 
-        if resize_to is not None:
-            try:
-                # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
-                image = image.resize(resize_to, LANCZOS)
-            except Exception:
-                image = image.resize(resize_to)
+    def _save_files():
+        sequence_numbers.begin_write(os.path.dirname(fullfn))
         try:
-            _atomically_save_image(image, fullfn_without_extension, ".jpg")
-        except Exception as e:
-            errors.display(e, "saving image as downscaled JPG")
-
-    if opts.save_txt and info is not None:
-        txt_fullfn = f"{fullfn_without_extension}.txt"
-        with open(txt_fullfn, "w", encoding="utf8") as file:
-            file.write(f"{info}\n")
-    else:
-        txt_fullfn = None
+            _write_files()
+            sequence_numbers.wrote(os.path.dirname(fullfn))
+        finally:
+            sequence_numbers.end_write(os.path.dirname(fullfn))
+
+    def _write_files():
+        _atomically_save_image(image, fullfn_without_extension, extension)
+
+        oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
+        if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
+            ratio = image.width / image.height
+            resize_to = None
+            if oversize and ratio > 1:
+                resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
+            elif oversize:
+                resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+
+            image_jpg = image
+            if resize_to is not None:
+                try:
+                    # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
+                    image_jpg = image.resize(resize_to, LANCZOS)
+                except Exception:
+                    image_jpg = image.resize(resize_to)
+            try:
+                _atomically_save_image(image_jpg, fullfn_without_extension, ".jpg")
+            except Exception as e:
+                errors.display(e, "saving image as downscaled JPG")
 
-    script_callbacks.image_saved_callback(params)
+        if txt_fullfn is not None:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{info}\n")
+
+    def _saved():
+        script_callbacks.image_saved_callback(params)
+
+    if save_queue.saver.active():
+        save_queue.saver.submit(_save_files, _saved, fullfn)
+    else:
+        _save_files()
+        _saved()
 
     return fullfn, txt_fullfn
 
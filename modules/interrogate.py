@@ -1,9 +1,11 @@
+import hashlib
 import os
 import sys
 from collections import namedtuple
 from pathlib import Path
 import re
 
+import numpy as np
 import torch
 import torch.hub
 
@@ -19,6 +21,9 @@ Category = namedtuple("Category", ["name", "topn", "items"])
 
 re_topn = re.compile(r"\.top(\d+)\.")
 
+text_features_dir = os.path.join(paths.data_path, "cache", "interrogate")
+text_features_batch_size = 256
+
 def category_types():
     return [f.stem for f in Path(shared.interrogator.content_dir).glob('*.txt')]
 
@@ -51,6 +56,7 @@ class InterrogateModels:
 
     def __init__(self, content_dir):
         self.loaded_categories = None
+        self.loaded_text_features = {}
         self.skip_categories = []
         self.content_dir = content_dir
         self.running_on_cpu = devices.device_interrogate == torch.device("cpu")
@@ -149,69 +155,139 @@ class InterrogateModels:
 
         devices.torch_gc()
 
-    def rank(self, image_features, text_array, top_count=1):
+    def limit_text_array(self, text_array):
+        if shared.opts.interrogate_clip_dict_limit != 0:
+            text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
+
+        return list(text_array)
+
+    def text_features(self, text_array):
+        """
+        Returns normalized CLIP features for all lines of text_array as a single matrix on the interrogate device.
+
+        The features are calculated once for every list of lines and stored in cache/interrogate as a .npy file named
+        after the CLIP model and the hash of the lines, so after the first time they are only read from disk.
+        """
+
+        text_hash = hashlib.sha256("\n".join(text_array).encode("utf8")).hexdigest()[0:16]
+        features = self.loaded_text_features.get(text_hash)
+        if features is not None:
+            return features
+
+        filename = os.path.join(text_features_dir, f"{clip_model_name.replace('/', '-')}-{text_hash}.npy")
+
+        matrix = None
+        if os.path.exists(filename):
+            try:
+                matrix = np.load(filename, mmap_mode='r')
+            except Exception as e:
+                errors.display(e, f"loading CLIP text features from {filename}")
+
+        if matrix is None or matrix.shape[0] != len(text_array):
+            matrix = self.calculate_text_features(text_array)
+
+            os.makedirs(text_features_dir, exist_ok=True)
+            with open(filename + ".tmp", "wb") as file:
+                np.save(file, matrix)
+            os.replace(filename + ".tmp", filename)
+
+        features = torch.tensor(matrix).to(devices.device_interrogate)
+        self.loaded_text_features[text_hash] = features
+
+        return features
+
+    def calculate_text_features(self, text_array):
         import clip
 
-        devices.torch_gc()
+        res = []
+        with torch.no_grad(), devices.autocast():
+            for i in range(0, len(text_array), text_features_batch_size):
+                text_tokens = clip.tokenize(text_array[i:i + text_features_batch_size], truncate=True).to(devices.device_interrogate)
+                text_features = self.clip_model.encode_text(text_tokens).float()
+                text_features /= text_features.norm(dim=-1, keepdim=True)
+                res.append(text_features.cpu().half().numpy())
 
-        if shared.opts.interrogate_clip_dict_limit != 0:
-            text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
+        return np.concatenate(res) if res else np.zeros((0, self.clip_model.text_projection.shape[1]), dtype=np.float16)
+
+    def rank_batch(self, image_features, text_array, top_count=1):
+        """for each row of image_features, returns top_count best matching lines of text_array along with their scores"""
+
+        text_array = self.limit_text_array(text_array)
+        text_features = self.text_features(text_array).type(image_features.dtype)
 
         top_count = min(top_count, len(text_array))
-        text_tokens = clip.tokenize(list(text_array), truncate=True).to(devices.device_interrogate)
-        text_features = self.clip_model.encode_text(text_tokens).type(self.dtype)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
+        similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
+        top_probs, top_labels = similarity.float().cpu().topk(top_count, dim=-1)
+
+        return [[(text_array[label], prob * 100) for prob, label in zip(probs.tolist(), labels.tolist())] for probs, labels in zip(top_probs, top_labels)]
 
-        similarity = torch.zeros((1, len(text_array))).to(devices.device_interrogate)
-        for i in range(image_features.shape[0]):
-            similarity += (100.0 * image_features[i].unsqueeze(0) @ text_features.T).softmax(dim=-1)
-        similarity /= image_features.shape[0]
+    def rank(self, image_features, text_array, top_count=1):
+        """returns top_count lines of text_array matching best on average over all rows of image_features"""
 
-        top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
-        return [(text_array[top_labels[0][i].numpy()], (top_probs[0][i].numpy()*100)) for i in range(top_count)]
+        text_array = self.limit_text_array(text_array)
+        text_features = self.text_features(text_array).type(image_features.dtype)
 
-    def generate_caption(self, pil_image):
-        gpu_image = transforms.Compose([
+        top_count = min(top_count, len(text_array))
+        similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1).mean(dim=0, keepdim=True)
+        top_probs, top_labels = similarity.float().cpu().topk(top_count, dim=-1)
+
+        return [(text_array[label], prob * 100) for prob, label in zip(top_probs[0].tolist(), top_labels[0].tolist())]
+
+    def generate_captions(self, pil_images):
+        transform = transforms.Compose([
             transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-        ])(pil_image).unsqueeze(0).type(self.dtype).to(devices.device_interrogate)
+        ])
+
+        gpu_images = torch.stack([transform(x) for x in pil_images]).type(self.dtype).to(devices.device_interrogate)
 
         with torch.no_grad():
-            caption = self.blip_model.generate(gpu_image, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+            captions = self.blip_model.generate(gpu_images, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
 
-        return caption[0]
+        return captions
 
-    def interrogate(self, pil_image):
-        res = ""
-        shared.state.begin(job="interrogate")
-        try:
-            if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-                lowvram.send_everything_to_cpu()
-                devices.torch_gc()
+    def generate_caption(self, pil_image):
+        return self.generate_captions([pil_image])[0]
 
-            self.load()
+    def interrogate_images(self, pil_images):
+        """interrogates a list of images as a single batch; models must be loaded"""
 
-            caption = self.generate_caption(pil_image)
+        res = self.generate_captions(pil_images)
+        if len(pil_images) == 1:
             self.send_blip_to_ram()
             devices.torch_gc()
 
-            res = caption
-
-            clip_image = self.clip_preprocess(pil_image).unsqueeze(0).type(self.dtype).to(devices.device_interrogate)
-
-            with torch.no_grad(), devices.autocast():
-                image_features = self.clip_model.encode_image(clip_image).type(self.dtype)
+        clip_images = torch.stack([self.clip_preprocess(x) for x in pil_images]).type(self.dtype).to(devices.device_interrogate)
 
-                image_features /= image_features.norm(dim=-1, keepdim=True)
+        with torch.no_grad(), devices.autocast():
+            image_features = self.clip_model.encode_image(clip_images).type(self.dtype)
+            image_features /= image_features.norm(dim=-1, keepdim=True)
 
-                for cat in self.categories():
-                    matches = self.rank(image_features, cat.items, top_count=cat.topn)
+            for cat in self.categories():
+                for i, matches in enumerate(self.rank_batch(image_features, cat.items, top_count=cat.topn)):
                     for match, score in matches:
                         if shared.opts.interrogate_return_ranks:
-                            res += f", ({match}:{score/100:.3f})"
+                            res[i] += f", ({match}:{score/100:.3f})"
                         else:
-                            res += f", {match}"
+                            res[i] += f", {match}"
+
+        return res
+
+    def prepare(self):
+        if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+            lowvram.send_everything_to_cpu()
+            devices.torch_gc()
+
+        self.load()
+
+    def interrogate(self, pil_image):
+        res = ""
+        shared.state.begin(job="interrogate")
+        try:
+            self.prepare()
+
+            res = self.interrogate_images([pil_image])[0]
 
         except Exception:
             errors.report("Error interrogating", exc_info=True)
@@ -221,3 +297,42 @@ class InterrogateModels:
         shared.state.end()
 
         return res
+
+    def interrogate_batch(self, pil_images):
+        """
+        Interrogates images from an iterable, taking interrogate_batch_size of them at a time, so that images can be
+        loaded lazily. Yields a caption for every image, or None if its batch failed.
+        """
+
+        batch_size = max(int(shared.opts.interrogate_batch_size), 1)
+
+        shared.state.begin(job="interrogate")
+        try:
+            self.prepare()
+
+            batch = []
+            for pil_image in pil_images:
+                batch.append(pil_image)
+                if len(batch) >= batch_size:
+                    yield from self.interrogate_batch_part(batch)
+                    batch = []
+
+                if shared.state.interrupted:
+                    return
+
+            if batch:
+                yield from self.interrogate_batch_part(batch)
+
+        finally:
+            self.unload()
+            shared.state.end()
+
+    def interrogate_batch_part(self, batch):
+        try:
+            res = self.interrogate_images(batch)
+        except Exception:
+            errors.report("Error interrogating", exc_info=True)
+            res = [None] * len(batch)
+
+        shared.state.nextjob()
+        return res
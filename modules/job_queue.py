@@ -0,0 +1,248 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from modules import shared, errors
+
+resources = ("unet", "vae", "clip", "upscaler", "face_restorer")
+
+
+class JobType:
+    def __init__(self, name, uses, priority):
+        self.name = name
+        self.uses = frozenset(uses)
+        """resources that the job needs to hold exclusively while running"""
+
+        self.priority = priority
+        """jobs with lower values are started first when they compete for the same resource"""
+
+    def __repr__(self):
+        return f"JobType({self.name!r})"
+
+
+diffusion = JobType("diffusion", ("unet", "vae", "clip"), priority=1)
+postprocess = JobType("postprocess", ("upscaler", "face_restorer"), priority=0)
+interrogate = JobType("interrogate", ("clip", ), priority=0)
+train = JobType("train", resources, priority=2)
+exclusive = JobType("exclusive", resources, priority=1)
+
+upscale = JobType("upscale", ("upscaler", ), priority=0)
+"""taken by upscalers for the time they run; inside a generation job, for hires fix and SD upscale"""
+
+face_restore = JobType("face_restore", ("face_restorer", ), priority=0)
+"""taken by face restoration for the time it runs"""
+
+job_types = [diffusion, postprocess, interrogate, train, exclusive, upscale, face_restore]
+
+
+class QueueFullError(RuntimeError):
+    def __init__(self, job_type):
+        super().__init__(f"Too many {job_type.name} jobs in queue, try again later")
+        self.status_code = 503
+
+
+class Ticket:
+    def __init__(self, job_type, id_task, priority, number):
+        self.job_type = job_type
+        self.id_task = id_task
+        self.priority = priority
+        self.number = number
+        self.uses = job_type.uses
+        self.time_queued = time.time()
+
+    def order(self):
+        return self.priority, self.number
+
+
+class JobScheduler:
+    """Starts jobs as soon as the resources they need are free.
+
+    Jobs are run on the calling thread; the scheduler only decides when each of them is allowed to start. A waiting job
+    is started when none of its resources are held by a running job, and no job that is ahead of it in the queue wants
+    any of them, so that long generation jobs can't starve each other while short postprocessing jobs still get to
+    overlap with them. When generation gets to hires fix or face restoration, it takes the upscaler or face restorer
+    for that time only, through a nested job, waiting for a postprocessing job that uses them to finish.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = []
+        self.held = set()
+        self.counter = 0
+        self.local = threading.local()
+        self.wait_times = {job_type.name: deque(maxlen=100) for job_type in job_types}
+        self.completed = {job_type.name: 0 for job_type in job_types}
+        self.release_callbacks = {}
+
+    def on_release(self, resource, callback):
+        """adds a function to be called when a job is done with resource; it's called while the job still holds it"""
+
+        self.release_callbacks.setdefault(resource, []).append(callback)
+
+    def run_release_callbacks(self, released):
+        for resource in released:
+            for callback in self.release_callbacks.get(resource, ()):
+                try:
+                    callback()
+                except Exception as e:
+                    errors.display(e, f"releasing {resource}")
+
+    def resources_for(self, job_type):
+        if not shared.parallel_processing_allowed or not shared.opts.job_queue_parallel:
+            return frozenset(resources)
+
+        return job_type.uses
+
+    def can_start(self, ticket):
+        if ticket.uses & self.held:
+            return False
+
+        for other in self.waiting:
+            if other.order() < ticket.order() and other.uses & ticket.uses:
+                return False
+
+        return True
+
+    @contextmanager
+    def job(self, job_type, id_task=None, priority=None, timeout=None):
+        """
+        Context manager that waits for the job's turn and holds its resources until the block is done.
+        Raises TimeoutError if the job could not start within timeout seconds.
+        """
+
+        held_by_thread = getattr(self.local, "held", None)
+        if held_by_thread is not None:
+            # nested call on a thread that is already running a job: the outer job already has its turn, so only wait
+            # for resources that it does not hold yet instead of queueing behind others (which could deadlock)
+            with self.nested_job(job_type, held_by_thread, timeout=timeout):
+                yield
+            return
+
+        with self.condition:
+            queued = sum(1 for x in self.waiting if x.job_type is job_type)
+            if shared.opts.job_queue_max_size > 0 and queued >= shared.opts.job_queue_max_size:
+                raise QueueFullError(job_type)
+
+            self.counter += 1
+            ticket = Ticket(job_type, id_task, job_type.priority if priority is None else priority, self.counter)
+            ticket.uses = self.resources_for(job_type)
+            self.waiting.append(ticket)
+
+            try:
+                started = self.condition.wait_for(lambda: self.can_start(ticket), timeout=timeout)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+            if not started:
+                raise TimeoutError(f"{job_type.name} job could not start in {timeout} seconds")
+
+            self.held |= ticket.uses
+            self.running.append(ticket)
+            self.wait_times[job_type.name].append(time.time() - ticket.time_queued)
+
+        self.local.held = set(ticket.uses)
+        detached = "unet" not in ticket.uses
+        shared.state.detach_thread(detached)
+
+        try:
+            yield
+        finally:
+            self.run_release_callbacks(ticket.uses)
+            shared.state.detach_thread(False)
+            self.local.held = None
+
+            with self.condition:
+                self.held -= ticket.uses
+                self.running.remove(ticket)
+                self.completed[job_type.name] += 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def nested_job(self, job_type, held_by_thread, timeout=None):
+        missing = self.resources_for(job_type) - held_by_thread
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: not (missing & self.held), timeout=timeout):
+                raise TimeoutError(f"{job_type.name} job could not start in {timeout} seconds")
+
+            self.held |= missing
+            held_by_thread |= missing
+
+        try:
+            yield
+        finally:
+            self.run_release_callbacks(missing)
+
+            with self.condition:
+                self.held -= missing
+                held_by_thread -= missing
+                self.condition.notify_all()
+
+    def position(self, id_task):
+        """returns how many jobs have to start before the job for id_task; None if the task is not waiting"""
+
+        with self.condition:
+            ticket = next((x for x in self.waiting if x.id_task == id_task), None)
+            if ticket is None:
+                return None
+
+            return sum(1 for x in self.waiting if x.order() < ticket.order())
+
+    def status(self):
+        with self.condition:
+            now = time.time()
+            res = {}
+            for job_type in job_types:
+                waits = self.wait_times[job_type.name]
+                waiting = [x for x in self.waiting if x.job_type is job_type]
+
+                res[job_type.name] = {
+                    "queued": len(waiting),
+                    "running": sum(1 for x in self.running if x.job_type is job_type),
+                    "completed": self.completed[job_type.name],
+                    "average_wait": sum(waits) / len(waits) if waits else 0.0,
+                    "longest_current_wait": max((now - x.time_queued for x in waiting), default=0.0),
+                }
+
+            return {"resources_in_use": sorted(self.held), "jobs": res}
+
+
+scheduler = JobScheduler()
+
+
+class ExclusiveLock:
+    """Drop-in replacement for the old queue_lock: entering it runs an exclusive job in the scheduler."""
+
+    def __init__(self):
+        self.jobs = threading.local()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        job = self.jobs.stack.pop()
+        return job.__exit__(exc_type, exc_val, exc_tb)
+
+    def acquire(self, blocking=True, timeout=-1):
+        """same as threading.Lock.acquire: returns False if the lock could not be taken without blocking, or in timeout seconds"""
+
+        if not blocking:
+            timeout = 0
+
+        job = scheduler.job(exclusive, timeout=timeout if timeout >= 0 else None)
+        try:
+            job.__enter__()
+        except TimeoutError:
+            return False
+
+        if not hasattr(self.jobs, "stack"):
+            self.jobs.stack = []
+        self.jobs.stack.append(job)
+
+        return True
+
+    def release(self):
+        self.__exit__(None, None, None)
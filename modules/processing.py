@@ -14,7 +14,7 @@ from skimage import exposure
 from typing import Any, Dict, List
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, cond_cache, save_queue
 from modules.sd_hijack import model_hijack
 from modules.shared import opts, cmd_opts, state
 import modules.shared as shared
@@ -349,9 +349,37 @@ class StableDiffusionProcessing:
 
         cache = caches[0]
 
-        with devices.autocast():
-            cache[1] = function(shared.sd_model, required_prompts, steps)
+        # same parameters in hashable form, for the cache shared between all processing objects
+        shared_cache_key = (
+            function.__module__,
+            function.__name__,
+            tuple(required_prompts),
+            getattr(required_prompts, 'is_negative_prompt', False),
+            getattr(required_prompts, 'width', None),
+            getattr(required_prompts, 'height', None),
+            steps,
+            opts.CLIP_stop_at_last_layers,
+            opts.enable_emphasis,
+            opts.comma_padding_backtrack,
+            opts.use_old_emphasis_implementation,
+            model_hijack.embedding_db.version,
+            shared.sd_model.sd_checkpoint_info,
+            extra_networks.extra_network_data_key(extra_network_data),
+            opts.sdxl_crop_left,
+            opts.sdxl_crop_top,
+            self.width,
+            self.height,
+        )
 
+        result = cond_cache.cache.get(shared_cache_key) if opts.cond_cache_size_mb > 0 else None
+        if result is None:
+            with devices.autocast():
+                result = function(shared.sd_model, required_prompts, steps)
+
+            if opts.cond_cache_size_mb > 0:
+                cond_cache.cache.put(shared_cache_key, result)
+
+        cache[1] = result
         cache[0] = cached_params
         return cache[1]
 
@@ -538,15 +566,37 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
     return x
 
 
+def get_decode_batch_size(batch):
+    """how many latents from batch to decode with the VAE at once; either from settings or from available VRAM"""
+
+    if shared.opts.sd_vae_decode_batch_size > 0:
+        return shared.opts.sd_vae_decode_batch_size
+
+    if devices.device.type != "cuda":
+        return 1
+
+    free, _ = torch.cuda.mem_get_info(devices.device)
+    free += torch.cuda.memory_reserved(devices.device) - torch.cuda.memory_allocated(devices.device)
+
+    # rough upper bound for decoder activations: the last up blocks work on full resolution with up to 512 channels
+    pixels = batch.shape[2] * opt_f * batch.shape[3] * opt_f
+    bytes_per_image = pixels * 1024 * torch.finfo(devices.dtype_vae).bits // 8
+
+    return max(1, int(free * 0.8) // bytes_per_image)
+
+
 def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
     samples = []
+    decode_batch_size = get_decode_batch_size(batch)
 
-    for i in range(batch.shape[0]):
-        sample = decode_first_stage(model, batch[i:i + 1])[0]
+    for i in range(0, batch.shape[0], decode_batch_size):
+        sub_batch = batch[i:i + decode_batch_size]
+        decoded = decode_first_stage(model, sub_batch)
 
         if check_for_nans:
             try:
-                devices.test_for_nans(sample, "vae")
+                for sample in decoded:
+                    devices.test_for_nans(sample, "vae")
             except devices.NansException as e:
                 if devices.dtype_vae == torch.float32 or not shared.opts.auto_vae_precision:
                     raise e
@@ -562,12 +612,12 @@ def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
                 model.first_stage_model.to(devices.dtype_vae)
                 batch = batch.to(devices.dtype_vae)
 
-                sample = decode_first_stage(model, batch[i:i + 1])[0]
+                decoded = decode_first_stage(model, batch[i:i + decode_batch_size])
 
         if target_device is not None:
-            sample = sample.to(target_device)
+            decoded = decoded.to(target_device)
 
-        samples.append(sample)
+        samples += list(decoded)
 
     return samples
 
@@ -670,7 +720,8 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
 
         sd_models.apply_token_merging(p.sd_model, p.get_token_merging_ratio())
 
-        res = process_images_inner(p)
+        with save_queue.saver.job():
+            res = process_images_inner(p)
 
     finally:
         sd_models.apply_token_merging(p.sd_model, 0)
@@ -1,27 +1,120 @@
+import asyncio
 import base64
 import io
+import json
+import threading
 import time
+from typing import Dict, List
 
 import gradio as gr
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
 
 from modules.shared import opts
 
 import modules.shared as shared
+from modules import job_queue
 
 
 current_task = None
+detached_tasks = set()
 pending_tasks = {}
 finished_tasks = []
 recorded_results = []
 recorded_results_limit = 2
 
+live_preview_lock = threading.Lock()
+live_preview_encoded = (None, None, None)
 
-def start_task(id_task):
+stream_inactivity_timeout = 60
+stream_keepalive_interval = 15
+
+
+class ProgressBroadcaster:
+    """
+    Tells progress streams when shared.state or the list of tasks changes, so that they wait for changes instead of
+    polling. Progress of the current task is computed once per change and shared by all streams and progress requests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.waiters = []
+
+        self.current_lock = threading.Lock()
+        self.current = (None, None)
+        """version, and progress of the current task at that version as returned by current_task_progress()"""
+
+    def publish(self):
+        """called from any thread when progress changes; wakes up all waiting streams"""
+
+        with self.lock:
+            self.version += 1
+            waiters, self.waiters = self.waiters, []
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake_up, future)
+
+    async def wait(self, version, timeout):
+        """waits until there is a change after the given version or until timeout seconds pass; returns the new version"""
+
+        loop = asyncio.get_running_loop()
+
+        with self.lock:
+            if self.version != version:
+                return self.version
+
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+        return self.version
+
+    def is_current(self):
+        return self.current[0] == self.version
+
+    def current_progress(self):
+        """returns progress of the current task, computing it only if something has changed since the last call"""
+
+        with self.current_lock:
+            version = self.version
+            if self.current[0] != version:
+                self.current = (version, current_task_progress())
+
+            return self.current[1]
+
+    def last_progress(self):
+        """returns progress of the current task as computed by the last call to current_progress(), without computing it"""
+
+        return self.current[1] or {"progress": 0, "eta": None, "id_live_preview": None, "live_preview": None, "textinfo": None}
+
+
+def wake_up(future):
+    if not future.done():
+        future.set_result(None)
+
+
+broadcaster = ProgressBroadcaster()
+shared.state.on_change(broadcaster.publish)
+
+
+def start_task(id_task, detached=False):
     global current_task
 
-    current_task = id_task
+    if detached:
+        detached_tasks.add(id_task)
+    else:
+        current_task = id_task
+
     pending_tasks.pop(id_task, None)
+    broadcaster.publish()
 
 
 def finish_task(id_task):
@@ -30,10 +123,14 @@ def finish_task(id_task):
     if current_task == id_task:
         current_task = None
 
+    detached_tasks.discard(id_task)
+
     finished_tasks.append(id_task)
     if len(finished_tasks) > 16:
         finished_tasks.pop(0)
 
+    broadcaster.publish()
+
 
 def record_results(id_task, res):
     recorded_results.append((id_task, res))
@@ -43,6 +140,7 @@ def record_results(id_task, res):
 
 def add_task_to_queue(id_job):
     pending_tasks[id_job] = time.time()
+    broadcaster.publish()
 
 
 class ProgressRequest(BaseModel):
@@ -61,17 +159,63 @@ class ProgressResponse(BaseModel):
     textinfo: str = Field(default=None, title="Info text", description="Info text used by WebUI.")
 
 
+class JobTypeQueueStatus(BaseModel):
+    queued: int = Field(title="Number of jobs of this type waiting to start")
+    running: int = Field(title="Number of jobs of this type running right now")
+    completed: int = Field(title="Number of jobs of this type finished since startup")
+    average_wait: float = Field(title="Average time in seconds the last 100 jobs of this type waited before starting")
+    longest_current_wait: float = Field(title="Time in seconds the oldest waiting job of this type has been waiting")
+
+
+class QueueStatusResponse(BaseModel):
+    resources_in_use: List[str] = Field(title="Resources held by running jobs")
+    jobs: Dict[str, JobTypeQueueStatus] = Field(title="Queue status for each job type")
+
+
 def setup_progress_api(app):
+    app.add_api_route("/internal/queue", queue_status_api, methods=["GET"], response_model=QueueStatusResponse)
+    app.add_api_route("/internal/progress/stream", progress_stream_api, methods=["GET"])
     return app.add_api_route("/internal/progress", progressapi, methods=["POST"], response_model=ProgressResponse)
 
 
+def queue_status_api():
+    return QueueStatusResponse(**job_queue.scheduler.status())
+
+
 def progressapi(req: ProgressRequest):
+    return task_progress(req, broadcaster.current_progress)
+
+
+def task_progress(req: ProgressRequest, get_current_progress):
     active = req.id_task == current_task
     queued = req.id_task in pending_tasks
     completed = req.id_task in finished_tasks
 
+    if req.id_task in detached_tasks:
+        return ProgressResponse(active=True, queued=False, completed=False, id_live_preview=-1, textinfo="Running alongside another job...")
+
     if not active:
-        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo="In queue..." if queued else "Waiting...")
+        if queued:
+            position = job_queue.scheduler.position(req.id_task)
+            textinfo = "In queue..." if position is None else f"In queue ({position} ahead)..."
+        else:
+            textinfo = "Waiting..."
+
+        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo=textinfo)
+
+    current = get_current_progress()
+
+    id_live_preview = req.id_live_preview
+    live_preview = None
+    if current["live_preview"] is not None and current["id_live_preview"] != req.id_live_preview:
+        live_preview = current["live_preview"]
+        id_live_preview = current["id_live_preview"]
+
+    return ProgressResponse(active=active, queued=queued, completed=completed, progress=current["progress"], eta=current["eta"], live_preview=live_preview, id_live_preview=id_live_preview, textinfo=current["textinfo"])
+
+
+def current_task_progress():
+    """progress, eta, info text and the latest live preview of the task that shared.state tracks"""
 
     progress = 0
 
@@ -89,33 +233,98 @@ def progressapi(req: ProgressRequest):
     predicted_duration = elapsed_since_start / progress if progress > 0 else None
     eta = predicted_duration - elapsed_since_start if predicted_duration is not None else None
 
-    id_live_preview = req.id_live_preview
-    shared.state.set_current_image()
-    if opts.live_previews_enable and shared.state.id_live_preview != req.id_live_preview:
-        image = shared.state.current_image
-        if image is not None:
-            buffered = io.BytesIO()
-
-            if opts.live_previews_image_format == "png":
-                # using optimize for large images takes an enormous amount of time
-                if max(*image.size) <= 256:
-                    save_kwargs = {"optimize": True}
-                else:
-                    save_kwargs = {"optimize": False, "compress_level": 1}
-
-            else:
-                save_kwargs = {}
-
-            image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
-            base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
-            live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
-            id_live_preview = shared.state.id_live_preview
+    id_live_preview, live_preview = None, None
+    if opts.live_previews_enable:
+        id_live_preview, live_preview = encoded_live_preview()
+
+    return {"progress": progress, "eta": eta, "id_live_preview": id_live_preview, "live_preview": live_preview, "textinfo": shared.state.textinfo}
+
+
+def encoded_live_preview():
+    """
+    Updates live preview from the current latent if enough steps were made, and returns its id together with the image
+    as a data: uri. Each preview image is encoded only once, no matter how many clients are watching progress.
+    """
+
+    global live_preview_encoded
+
+    with live_preview_lock:
+        shared.state.set_current_image()
+
+        id_live_preview = shared.state.id_live_preview
+        image_format = opts.live_previews_image_format
+
+        if live_preview_encoded[0:2] != (id_live_preview, image_format):
+            image = shared.state.current_image
+            live_preview_encoded = (id_live_preview, image_format, None if image is None else encode_live_preview(image, image_format))
+
+        return live_preview_encoded[0], live_preview_encoded[2]
+
+
+def encode_live_preview(image, image_format):
+    buffered = io.BytesIO()
+
+    if image_format == "png":
+        # using optimize for large images takes an enormous amount of time
+        if max(*image.size) <= 256:
+            save_kwargs = {"optimize": True}
         else:
-            live_preview = None
+            save_kwargs = {"optimize": False, "compress_level": 1}
+
     else:
-        live_preview = None
+        save_kwargs = {}
+
+    image.save(buffered, format=image_format, **save_kwargs)
+    base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+    return f"data:image/{image_format};base64,{base64_image}"
 
-    return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo)
+
+def progress_stream_api(id_task: str, id_live_preview: int = -1):
+    return StreamingResponse(progress_events(id_task, id_live_preview), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Encoding": "identity"})
+
+
+async def progress_events(id_task, id_live_preview):
+    """
+    Server-sent events with progress of a task, in the same format as ProgressResponse. Only fields that changed since the
+    previous event are sent, and live_preview only when there is a new image. The stream ends when the task is done.
+    Events are sent when the broadcaster reports a change, at most once per live preview refresh period.
+    """
+
+    sent = {}
+    was_active = False
+    time_start = time.time()
+    time_sent = time_start
+
+    while True:
+        if id_task == current_task and not broadcaster.is_current():
+            # the first stream to see a change computes progress and encodes the live preview for everyone
+            await run_in_threadpool(broadcaster.current_progress)
+
+        version = broadcaster.version
+        res = task_progress(ProgressRequest(id_task=id_task, id_live_preview=id_live_preview), broadcaster.last_progress)
+        now = time.time()
+
+        data = res.dict()
+        if data["live_preview"] is None:
+            del data["live_preview"]
+        else:
+            id_live_preview = res.id_live_preview
+
+        changes = {k: v for k, v in data.items() if k not in sent or sent[k] != v}
+        if changes:
+            sent.update(changes)
+            time_sent = now
+            yield f"data: {json.dumps(changes)}\n\n"
+        elif now - time_sent >= stream_keepalive_interval:
+            time_sent = now
+            yield ": keep-alive\n\n"
+
+        was_active = was_active or res.active
+        if res.completed or (was_active and not res.active) or (not res.active and not res.queued and now - time_start > stream_inactivity_timeout):
+            return
+
+        await asyncio.sleep(max(opts.live_preview_refresh_period, 50) / 1000)
+        await broadcaster.wait(version, timeout=stream_keepalive_interval)
 
 
 def restore_progress(id_task):
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import bisect
 import re
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
 from typing import List
 import lark
 
@@ -26,6 +28,87 @@ plain: /([^\\\[\]():|]|\\.)+/
 %import common.SIGNED_NUMBER -> NUMBER
 """)
 
+
+class LruCache:
+    """Thread-safe dict that keeps at most max_entries most recently used entries."""
+
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+schedules_cache = LruCache(1024)
+"""parsed prompt schedules by (prompt, steps); the token counter in UI parses the same prompt on every keystroke"""
+
+
+class CollectSteps(lark.Visitor):
+    def __init__(self, steps):
+        super().__init__()
+        self.steps = steps
+        self.res = [steps]
+
+    def scheduled(self, tree):
+        tree.children[-1] = float(tree.children[-1])
+        if tree.children[-1] < 1:
+            tree.children[-1] *= self.steps
+        tree.children[-1] = min(self.steps, int(tree.children[-1]))
+        self.res.append(tree.children[-1])
+
+    def alternate(self, tree):
+        self.res.extend(range(1, self.steps+1))
+
+
+class AtStep(lark.Transformer):
+    def __init__(self, step):
+        super().__init__()
+        self.step = step
+
+    def scheduled(self, args):
+        before, after, _, when = args
+        yield before or () if self.step <= when else after
+    def alternate(self, args):
+        yield next(args[(self.step - 1)%len(args)])
+    def start(self, args):
+        def flatten(x):
+            if type(x) == str:
+                yield x
+            else:
+                for gen in x:
+                    yield from flatten(gen)
+        return ''.join(flatten(args))
+    def plain(self, args):
+        yield args[0].value
+    def __default__(self, data, children, meta):
+        for child in children:
+            yield child
+
+
 def get_learned_conditioning_prompt_schedules(prompts, steps):
     """
     >>> g = lambda p: get_learned_conditioning_prompt_schedules([p], 10)[0]
@@ -56,43 +139,12 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
     """
 
     def collect_steps(steps, tree):
-        res = [steps]
-
-        class CollectSteps(lark.Visitor):
-            def scheduled(self, tree):
-                tree.children[-1] = float(tree.children[-1])
-                if tree.children[-1] < 1:
-                    tree.children[-1] *= steps
-                tree.children[-1] = min(steps, int(tree.children[-1]))
-                res.append(tree.children[-1])
-
-            def alternate(self, tree):
-                res.extend(range(1, steps+1))
-
-        CollectSteps().visit(tree)
-        return sorted(set(res))
+        visitor = CollectSteps(steps)
+        visitor.visit(tree)
+        return sorted(set(visitor.res))
 
     def at_step(step, tree):
-        class AtStep(lark.Transformer):
-            def scheduled(self, args):
-                before, after, _, when = args
-                yield before or () if step <= when else after
-            def alternate(self, args):
-                yield next(args[(step - 1)%len(args)])
-            def start(self, args):
-                def flatten(x):
-                    if type(x) == str:
-                        yield x
-                    else:
-                        for gen in x:
-                            yield from flatten(gen)
-                return ''.join(flatten(args))
-            def plain(self, args):
-                yield args[0].value
-            def __default__(self, data, children, meta):
-                for child in children:
-                    yield child
-        return AtStep().transform(tree)
+        return AtStep(step).transform(tree)
 
     def get_schedule(prompt):
         try:
@@ -104,8 +156,17 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
             return [[steps, prompt]]
         return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
 
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
-    return [promptdict[prompt] for prompt in prompts]
+    promptdict = {}
+    for prompt in set(prompts):
+        schedule = schedules_cache.get((prompt, steps))
+        if schedule is None:
+            schedule = get_schedule(prompt)
+            schedules_cache.put((prompt, steps), schedule)
+
+        promptdict[prompt] = schedule
+
+    # copies, so that changes made by the caller do not end up in the cache
+    return [[[step, text] for step, text in promptdict[prompt]] for prompt in prompts]
 
 
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
@@ -150,20 +211,17 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps):
     res = []
 
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps)
-    cache = {}
+    batches, locations = plan_conditioning_batches(model, prompt_schedules)
 
-    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
-
-        cached = cache.get(prompt, None)
-        if cached is not None:
-            res.append(cached)
-            continue
-
-        texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
-        conds = model.get_learned_conditioning(texts)
+    batch_conds = []
+    for batch in batches:
+        texts = SdConditioning(batch, copy_from=prompts)
+        batch_conds.append(model.get_learned_conditioning(texts))
 
+    for prompt_schedule, schedule_locations in zip(prompt_schedules, locations):
         cond_schedule = []
-        for i, (end_at_step, _) in enumerate(prompt_schedule):
+        for (end_at_step, _), (batch_index, i) in zip(prompt_schedule, schedule_locations):
+            conds = batch_conds[batch_index]
             if isinstance(conds, dict):
                 cond = {k: v[i] for k, v in conds.items()}
             else:
@@ -171,12 +229,76 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps):
 
             cond_schedule.append(ScheduledPromptConditioning(end_at_step, cond))
 
-        cache[prompt] = cond_schedule
         res.append(cond_schedule)
 
     return res
 
 
+def plan_conditioning_batches(model, prompt_schedules):
+    """
+    Plans encoding of all texts of all prompt schedules in as few calls to model.get_learned_conditioning as possible.
+    Returns a list of batches, each a list of texts, and for every schedule, for every entry of it, a pair of
+    (index of batch, index of the text in batch).
+
+    Every text gets exactly the conditioning it would get if its schedule was encoded on its own, as before:
+    - text encoder pads all texts in a call to the same number of chunks, so texts are grouped by the number of chunks
+      their schedule is padded to;
+    - emphasis is normalized by the mean of the whole call, so a schedule with emphasis gets a call of its own;
+    - SDXL uses zero conditioning for a negative prompt if all texts in the call are empty, so schedules with only
+      empty texts are not grouped with others.
+    Texts without emphasis from different prompts, schedule steps and AND parts end up in the same call.
+    """
+
+    from modules import shared
+
+    process_texts = getattr(model.cond_stage_model, 'process_texts', None)
+    if shared.opts.use_old_emphasis_implementation:
+        process_texts = None
+
+    batches = []
+    locations = []
+    separate_batches = {}
+    shared_batches = {}
+    shared_rows = {}
+
+    for prompt_schedule in prompt_schedules:
+        texts = [x[1] for x in prompt_schedule]
+
+        batch_chunks = process_texts(texts)[0] if process_texts is not None else None
+        if batch_chunks is None or any(m != 1.0 for chunks in batch_chunks for chunk in chunks for m in chunk.multipliers):
+            key = tuple(texts)
+            index = separate_batches.get(key)
+            if index is None:
+                index = len(batches)
+                batches.append(texts)
+                separate_batches[key] = index
+
+            locations.append([(index, i) for i in range(len(texts))])
+            continue
+
+        batch_key = (max(len(chunks) for chunks in batch_chunks), all(text == '' for text in texts))
+
+        schedule_locations = []
+        for text in texts:
+            location = shared_rows.get((batch_key, text))
+            if location is None:
+                index = shared_batches.get(batch_key)
+                if index is None:
+                    index = len(batches)
+                    batches.append([])
+                    shared_batches[batch_key] = index
+
+                location = (index, len(batches[index]))
+                batches[index].append(text)
+                shared_rows[(batch_key, text)] = location
+
+            schedule_locations.append(location)
+
+        locations.append(schedule_locations)
+
+    return batches, locations
+
+
 re_AND = re.compile(r"\bAND\b")
 re_weight = re.compile(r"^(.*?)(?:\s*:\s*([-+]?(?:\d+\.?|\d*\.\d+)))?\s*$")
 
@@ -279,6 +401,54 @@ def reconstruct_cond_batch(c: List[List[ScheduledPromptConditioning]], current_s
     return res
 
 
+class ConditioningTable:
+    """
+    Results of reconstruct_cond_batch or reconstruct_multicond_batch for all sampling steps of a job. They only change
+    at steps where one of the schedules moves on to its next entry, so sampling steps are split into spans at those
+    steps; the result is made once for each span, and for all other steps in it, it's looked up.
+
+    Results are shared between steps, so they must not be changed in place.
+    """
+
+    def __init__(self, c, reconstruct):
+        self.c = c
+        self.reconstruct = reconstruct
+        self.results = {}
+
+        if isinstance(c, MulticondLearnedConditioning):
+            schedules = [composable_prompt.schedules for composable_prompts in c.batch for composable_prompt in composable_prompts]
+        else:
+            schedules = c
+
+        self.boundaries = sorted({entry.end_at_step for schedule in schedules for entry in schedule})
+
+    def get(self, current_step):
+        span = bisect.bisect_left(self.boundaries, current_step)
+
+        res = self.results.get(span)
+        if res is None:
+            res = self.reconstruct(self.c, current_step)
+            self.results[span] = res
+
+        return res
+
+
+def get_conditioning_table(table, c, reconstruct):
+    """returns table if it was made for c, or a new table for c otherwise"""
+
+    if table is not None and table.c is c and table.reconstruct is reconstruct:
+        return table
+
+    return ConditioningTable(c, reconstruct)
+
+
+def copy_cond(cond):
+    if isinstance(cond, dict):
+        return DictWithShape({k: v.clone() for k, v in cond.items()}, cond.shape)
+
+    return cond.clone()
+
+
 def stack_conds(tensors):
     # if prompts have wildly different lengths above the limit we'll get tensors of different shapes
     # and won't be able to torch.stack them. So this fixes that.
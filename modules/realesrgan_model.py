@@ -4,7 +4,7 @@ import numpy as np
 from PIL import Image
 from realesrgan import RealESRGANer
 
-from modules.upscaler import Upscaler, UpscalerData
+from modules.upscaler import Upscaler, UpscalerData, model_cache
 from modules.shared import cmd_opts, opts
 from modules import modelloader, errors
 
@@ -48,14 +48,16 @@ class UpscalerRealESRGAN(Upscaler):
             errors.report(f"Unable to load RealESRGAN model {path}", exc_info=True)
             return img
 
-        upsampler = RealESRGANer(
+        half = not cmd_opts.no_half and not cmd_opts.upcast_sampling
+
+        upsampler = model_cache.get((self.name, path, half, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap), lambda: RealESRGANer(
             scale=info.scale,
             model_path=info.local_data_path,
             model=info.model(),
-            half=not cmd_opts.no_half and not cmd_opts.upcast_sampling,
+            half=half,
             tile=opts.ESRGAN_tile,
             tile_pad=opts.ESRGAN_tile_overlap,
-        )
+        ))
 
         upsampled = upsampler.enhance(np.array(img), outscale=info.scale)[0]
 
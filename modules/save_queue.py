@@ -0,0 +1,136 @@
+import contextlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import shared, errors
+
+
+class SaveTask:
+    def __init__(self, save, done, filename):
+        self.save = save
+        self.done = done
+        self.filename = filename
+        self.finished = False
+        self.failed = False
+
+
+class ImageSaveQueue:
+    """
+    Writes images to disk in background threads while generation goes on with the next batch.
+
+    Saving happens in background only inside job(), on the thread that entered it; everywhere else images are saved
+    right away as before. Image is encoded in a worker thread, but the image_saved callbacks are called in the same
+    order the images were submitted, after the file is in place. When save_images_queue_size images are waiting, the
+    next submit waits for one of them to be done, and job() waits for all of them before returning.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.local = threading.local()
+        self.executor = None
+        self.executor_workers = 0
+        self.tasks = deque()
+        self.pending_files = {}
+        self.reporting = False
+
+    @contextlib.contextmanager
+    def job(self):
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+
+        try:
+            yield
+        finally:
+            self.local.depth -= 1
+            self.flush()
+
+    def active(self):
+        return shared.opts.save_images_in_background and getattr(self.local, 'depth', 0) > 0
+
+    def pending(self, path):
+        """names of files in path directory that are going to be written, but are not there yet"""
+
+        with self.lock:
+            return list(self.pending_files.get(os.path.abspath(path), ()))
+
+    def exists(self, filename):
+        return os.path.exists(filename) or os.path.basename(filename) in self.pending(os.path.dirname(filename))
+
+    def get_executor(self):
+        """called with lock held"""
+
+        workers = max(int(shared.opts.save_images_workers), 1)
+        if self.executor is None or self.executor_workers != workers:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="save-images")
+            self.executor_workers = workers
+
+        return self.executor
+
+    def submit(self, save, done, filename):
+        """calls save() in background, and done() once save() has finished and done() of all earlier images was called"""
+
+        task = SaveTask(save, done, filename)
+
+        with self.lock:
+            while len(self.tasks) >= max(int(shared.opts.save_images_queue_size), 1):
+                self.lock.wait()
+
+            self.tasks.append(task)
+            self.pending_files.setdefault(os.path.abspath(os.path.dirname(filename)), set()).add(os.path.basename(filename))
+            executor = self.get_executor()
+
+        executor.submit(self.run, task)
+
+    def run(self, task):
+        try:
+            task.save()
+        except Exception as e:
+            errors.display(e, f"saving image {task.filename}")
+            task.failed = True
+
+        with self.lock:
+            task.finished = True
+
+            path = os.path.abspath(os.path.dirname(task.filename))
+            names = self.pending_files.get(path)
+            if names is not None:
+                names.discard(os.path.basename(task.filename))
+                if not names:
+                    del self.pending_files[path]
+
+        self.report()
+
+    def report(self):
+        """calls done() of finished tasks in submission order; only one thread does it at a time"""
+
+        while True:
+            with self.lock:
+                if self.reporting or not self.tasks or not self.tasks[0].finished:
+                    return
+
+                task = self.tasks.popleft()
+                self.reporting = True
+
+            try:
+                if not task.failed:
+                    task.done()
+            except Exception as e:
+                errors.display(e, f"processing saved image {task.filename}")
+            finally:
+                with self.lock:
+                    self.reporting = False
+                    self.lock.notify_all()
+
+    def flush(self):
+        """waits until all submitted images are saved and their callbacks are called"""
+
+        with self.lock:
+            while self.tasks or self.reporting:
+                self.lock.wait()
+
+
+saver = ImageSaveQueue()
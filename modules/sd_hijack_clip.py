@@ -46,6 +46,9 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         self.input_key = getattr(wrapped, 'input_key', 'txt')
         self.legacy_ucg_val = None
 
+        self.chunks_cache = prompt_parser.LruCache(1024)
+        """results of tokenize_line() for prompts seen before, so that the same prompt is not tokenized again in every job and on every keystroke in UI"""
+
     def empty_chunk(self):
         """creates an empty PromptChunk and returns it"""
 
@@ -180,20 +183,24 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         """
         Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of results and maximum
         length, in tokens, of all texts.
+
+        The cache is kept between calls; its key has everything besides the text that changes the result: options for
+        emphasis and comma backtrack, and version of embedding database.
         """
 
         token_count = 0
 
-        cache = {}
         batch_chunks = []
         for line in texts:
-            if line in cache:
-                chunks = cache[line]
-            else:
-                chunks, current_token_count = self.tokenize_line(line)
-                token_count = max(current_token_count, token_count)
+            key = (line, opts.enable_emphasis, opts.comma_padding_backtrack, self.hijack.embedding_db.version)
+
+            res = self.chunks_cache.get(key)
+            if res is None:
+                res = self.tokenize_line(line)
+                self.chunks_cache.put(key, res)
 
-                cache[line] = chunks
+            chunks, current_token_count = res
+            token_count = max(current_token_count, token_count)
 
             batch_chunks.append(chunks)
 
@@ -237,6 +244,7 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         if opts.textual_inversion_add_hashes_to_infotext and used_embeddings:
             hashes = []
             for name, embedding in used_embeddings.items():
+                embedding.read_hash()
                 shorthash = embedding.shorthash
                 if not shorthash:
                     continue
@@ -1,4 +1,5 @@
 import collections
+import collections.abc
 import os.path
 import sys
 import gc
@@ -14,7 +15,7 @@ import ldm.modules.midas as midas
 
 from ldm.util import instantiate_from_config
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, hash_queue, sd_models_config, sd_unet, sd_models_xl, cond_cache
 from modules.sd_hijack_inpainting import do_inpainting_hijack
 from modules.timer import Timer
 import tomesd
@@ -135,6 +136,9 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+        if checkpoint_info.sha256 is None:
+            hash_queue.service.enqueue(checkpoint_info.filename, f"checkpoint/{checkpoint_info.name}", priority=hash_queue.priority_checkpoint)
+
 
 def get_closet_checkpoint_match(search_string):
     checkpoint_info = checkpoint_aliases.get(search_string, None)
@@ -264,6 +268,52 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
     return sd
 
 
+class SafetensorsStateDict(collections.abc.Mapping):
+    """
+    State dict of a .safetensors checkpoint that reads each tensor from the memory-mapped file only when it is accessed.
+    The file's pages are shared through OS page cache with other processes that read the same checkpoint.
+    """
+
+    def __init__(self, filename):
+        self.file = safetensors.safe_open(filename, framework="pt", device="cpu")
+        self.key_names = {transform_checkpoint_dict_key(k): k for k in self.file.keys()}
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(self.key_names[key])
+
+    def __contains__(self, key):
+        return key in self.key_names
+
+    def __iter__(self):
+        return iter(self.key_names)
+
+    def __len__(self):
+        return len(self.key_names)
+
+
+def load_state_dict_streaming(model, state_dict, chunk_size=64 * 1024 * 1024):
+    """
+    Loads weights from state_dict into model a few layers at a time: only tensors adding up to chunk_size bytes are read
+    from the file at once, so memory use stays close to the size of the model itself.
+    """
+
+    chunk = {}
+    size = 0
+
+    for key in state_dict:
+        tensor = state_dict[key]
+        chunk[key] = tensor
+        size += tensor.element_size() * tensor.nelement()
+
+        if size >= chunk_size:
+            model.load_state_dict(chunk, strict=False)
+            chunk.clear()
+            size = 0
+
+    if chunk:
+        model.load_state_dict(chunk, strict=False)
+
+
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
     sd_model_hash = checkpoint_info.calculate_shorthash()
     timer.record("calculate hash")
@@ -274,6 +324,11 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
         return checkpoints_loaded[checkpoint_info]
 
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
+
+    _, extension = os.path.splitext(checkpoint_info.filename)
+    if extension.lower() == ".safetensors" and shared.opts.sd_checkpoint_streaming_load and not shared.opts.disable_mmap_load_safetensors:
+        return SafetensorsStateDict(checkpoint_info.filename)
+
     res = read_state_dict(checkpoint_info.filename)
     timer.record("load weights from disk")
 
@@ -296,38 +351,37 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if model.is_sdxl:
         sd_models_xl.extend_sdxl(model)
 
-    model.load_state_dict(state_dict, strict=False)
+    streamed = isinstance(state_dict, SafetensorsStateDict)
+    if streamed:
+        # convert the model first, so that weights are cast to their final dtype as they are copied in
+        if not shared.cmd_opts.no_half:
+            apply_half(model)
+            timer.record("apply half()")
+
+        load_state_dict_streaming(model, state_dict)
+    else:
+        model.load_state_dict(state_dict, strict=False)
+
     del state_dict
     timer.record("apply weights to model")
 
     if shared.opts.sd_checkpoint_cache > 0:
-        # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
+        # cache newly loaded model; after streaming, the model already has its final dtype, so its state dict holds the
+        # same tensors that loading a VAE or applying Lora changes in place later, and they have to be copied
+        if streamed:
+            checkpoints_loaded[checkpoint_info] = {k: v.detach().to(devices.cpu, copy=True) for k, v in model.state_dict().items()}
+        else:
+            checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
 
     if shared.cmd_opts.opt_channelslast:
         model.to(memory_format=torch.channels_last)
         timer.record("apply channels_last")
 
-    if not shared.cmd_opts.no_half:
-        vae = model.first_stage_model
-        depth_model = getattr(model, 'depth_model', None)
-
-        # with --no-half-vae, remove VAE from model when doing half() to prevent its weights from being converted to float16
-        if shared.cmd_opts.no_half_vae:
-            model.first_stage_model = None
-        # with --upcast-sampling, don't convert the depth model weights to float16
-        if shared.cmd_opts.upcast_sampling and depth_model:
-            model.depth_model = None
-
-        model.half()
-        model.first_stage_model = vae
-        if depth_model:
-            model.depth_model = depth_model
-
+    if not shared.cmd_opts.no_half and not streamed:
+        apply_half(model)
         timer.record("apply half()")
 
-    devices.dtype_unet = torch.float16 if model.is_sdxl and not shared.cmd_opts.no_half else model.model.diffusion_model.dtype
-    devices.unet_needs_upcast = shared.cmd_opts.upcast_sampling and devices.dtype == torch.float16 and devices.dtype_unet == torch.float16
+    set_model_dtypes(model)
 
     model.first_stage_model.to(devices.dtype_vae)
     timer.record("apply dtype to VAE")
@@ -351,6 +405,28 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     timer.record("load VAE")
 
 
+def apply_half(model):
+    vae = model.first_stage_model
+    depth_model = getattr(model, 'depth_model', None)
+
+    # with --no-half-vae, remove VAE from model when doing half() to prevent its weights from being converted to float16
+    if shared.cmd_opts.no_half_vae:
+        model.first_stage_model = None
+    # with --upcast-sampling, don't convert the depth model weights to float16
+    if shared.cmd_opts.upcast_sampling and depth_model:
+        model.depth_model = None
+
+    model.half()
+    model.first_stage_model = vae
+    if depth_model:
+        model.depth_model = depth_model
+
+
+def set_model_dtypes(model):
+    devices.dtype_unet = torch.float16 if model.is_sdxl and not shared.cmd_opts.no_half else model.model.diffusion_model.dtype
+    devices.unet_needs_upcast = shared.cmd_opts.upcast_sampling and devices.dtype == torch.float16 and devices.dtype_unet == torch.float16
+
+
 def enable_midas_autodownload():
     """
     Gives the ldm.modules.midas.api.load_model function automatic downloading.
@@ -423,6 +499,8 @@ sdxl_refiner_clip_weight = 'conditioner.embedders.0.model.ln_final.weight'
 class SdModelData:
     def __init__(self):
         self.sd_model = None
+        self.loaded_sd_models = []
+        """models that are fully loaded, most recently used first; only sd_model among them is hijacked"""
         self.was_loaded_at_least_once = False
         self.lock = threading.Lock()
 
@@ -448,10 +526,103 @@ class SdModelData:
     def set_sd_model(self, v):
         self.sd_model = v
 
+    def find_loaded(self, checkpoint_info):
+        return next((x for x in self.loaded_sd_models if x.sd_checkpoint_info.filename == checkpoint_info.filename), None)
+
+    def mark_used(self, sd_model):
+        if sd_model in self.loaded_sd_models:
+            self.loaded_sd_models.remove(sd_model)
+
+        self.loaded_sd_models.insert(0, sd_model)
+
 
 model_data = SdModelData()
 
 
+def send_model_to_cpu(sd_model):
+    from modules import lowvram
+
+    if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+        lowvram.send_everything_to_cpu()
+    else:
+        sd_model.to(devices.cpu)
+
+    devices.torch_gc()
+
+
+def send_model_to_device(sd_model):
+    if not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram:
+        sd_model.to(shared.device)
+
+
+def deactivate_model(sd_model):
+    """
+    Undoes changes made to the active model when it was activated, so that another loaded model can take its place;
+    VAE state is stored in the model to be restored if it becomes active again.
+    """
+
+    from modules import sd_hijack
+
+    sd_unet.apply_unet("None")
+
+    sd_model.base_vae = sd_vae.base_vae
+    sd_model.base_vae_checkpoint_info = sd_vae.checkpoint_info
+    sd_model.loaded_vae_file = sd_vae.loaded_vae_file
+
+    sd_hijack.model_hijack.undo_hijack(sd_model)
+    model_data.sd_model = None
+
+
+def activate_loaded_model(sd_model, timer):
+    """Makes a model from model_data.loaded_sd_models the active model."""
+
+    from modules import sd_hijack
+
+    sd_vae.base_vae = getattr(sd_model, "base_vae", None)
+    sd_vae.checkpoint_info = getattr(sd_model, "base_vae_checkpoint_info", None)
+    sd_vae.loaded_vae_file = getattr(sd_model, "loaded_vae_file", None)
+
+    send_model_to_device(sd_model)
+    timer.record("move model to device")
+
+    set_model_dtypes(sd_model)
+    shared.opts.data["sd_model_checkpoint"] = sd_model.sd_checkpoint_info.title
+    shared.opts.data["sd_checkpoint_hash"] = sd_model.sd_checkpoint_info.sha256
+
+    sd_hijack.model_hijack.hijack(sd_model)
+    model_data.sd_model = sd_model
+    model_data.mark_used(sd_model)
+    timer.record("hijack")
+
+    # embeddings are registered for the model's text encoder, so they only need reloading if its kind is different
+    embedding_db = sd_hijack.model_hijack.embedding_db
+    embedding_db.load_textual_inversion_embeddings(force_reload=embedding_db.expected_shape != embedding_db.get_expected_shape())
+    timer.record("load textual inversion embeddings")
+
+    script_callbacks.model_loaded_callback(sd_model)
+    timer.record("script callbacks")
+
+    sd_vae.reload_vae_weights(sd_model)
+    timer.record("load VAE")
+
+
+def apply_model_limits():
+    """Unloads models over sd_checkpoints_limit and moves models over sd_checkpoints_gpu_limit to RAM, least recently used first."""
+
+    while len(model_data.loaded_sd_models) > max(shared.opts.sd_checkpoints_limit, 1):
+        sd_model = model_data.loaded_sd_models.pop()
+        print(f"Unloading model over the limit of {shared.opts.sd_checkpoints_limit}: {sd_model.sd_checkpoint_info.title}")
+        send_model_to_cpu(sd_model)
+        del sd_model
+
+    for sd_model in model_data.loaded_sd_models[max(shared.opts.sd_checkpoints_gpu_limit, 1):]:
+        if sd_model is not model_data.sd_model and next(sd_model.parameters()).device != devices.cpu:
+            send_model_to_cpu(sd_model)
+
+    gc.collect()
+    devices.torch_gc()
+
+
 def get_empty_cond(sd_model):
     if hasattr(sd_model, 'conditioner'):
         d = sd_model.get_learned_conditioning([""])
@@ -466,8 +637,16 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     checkpoint_info = checkpoint_info or select_checkpoint()
 
     if model_data.sd_model:
-        sd_hijack.model_hijack.undo_hijack(model_data.sd_model)
-        model_data.sd_model = None
+        previous_model = model_data.sd_model
+        deactivate_model(previous_model)
+
+        # the previous model stays loaded if there's room for one more; otherwise it's dropped to make space
+        if len(model_data.loaded_sd_models) >= shared.opts.sd_checkpoints_limit and previous_model in model_data.loaded_sd_models:
+            model_data.loaded_sd_models.remove(previous_model)
+        elif len(model_data.loaded_sd_models) >= shared.opts.sd_checkpoints_gpu_limit:
+            send_model_to_cpu(previous_model)  # make space in VRAM for the new one
+
+        del previous_model
         gc.collect()
         devices.torch_gc()
 
@@ -522,7 +701,9 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
 
     sd_model.eval()
     model_data.sd_model = sd_model
+    model_data.mark_used(sd_model)
     model_data.was_loaded_at_least_once = True
+    apply_model_limits()
 
     sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)  # Reload embeddings after model load as they may or may not fit the model
 
@@ -537,35 +718,53 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
 
     timer.record("calculate empty prompt")
 
+    apply_model_limits()
+
     print(f"Model loaded in {timer.summary()}.")
 
     return sd_model
 
 
 def reload_model_weights(sd_model=None, info=None):
-    from modules import lowvram, devices, sd_hijack
+    from modules import devices, sd_hijack
     checkpoint_info = info or select_checkpoint()
 
     if not sd_model:
         sd_model = model_data.sd_model
 
-    if sd_model is None:  # previous model load failed
-        current_checkpoint_info = None
-    else:
-        current_checkpoint_info = sd_model.sd_checkpoint_info
-        if sd_model.sd_model_checkpoint == checkpoint_info.filename:
-            return
+    if sd_model is not None and sd_model.sd_model_checkpoint == checkpoint_info.filename:
+        return
 
-        sd_unet.apply_unet("None")
+    timer = Timer()
 
-        if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-            lowvram.send_everything_to_cpu()
-        else:
-            sd_model.to(devices.cpu)
+    loaded_model = model_data.find_loaded(checkpoint_info)
+    if loaded_model is not None:
+        if sd_model is not None:
+            deactivate_model(sd_model)
 
-        sd_hijack.model_hijack.undo_hijack(sd_model)
+        activate_loaded_model(loaded_model, timer)
+        apply_model_limits()
 
-    timer = Timer()
+        print(f"Switched to already loaded model {checkpoint_info.title} in {timer.summary()}.")
+        return loaded_model
+
+    if sd_model is not None and len(model_data.loaded_sd_models) < shared.opts.sd_checkpoints_limit:
+        # there is room for one more model; the current one stays loaded
+        load_model(checkpoint_info)
+        return model_data.sd_model
+
+    if sd_model is not None:
+        deactivate_model(sd_model)
+
+        # weights of the least recently used model are replaced with the new checkpoint
+        sd_model = model_data.loaded_sd_models[-1]
+        send_model_to_cpu(sd_model)
+
+    if sd_model is None:  # previous model load failed
+        current_checkpoint_info = None
+    else:
+        current_checkpoint_info = sd_model.sd_checkpoint_info
+        model_data.sd_model = sd_model
 
     state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
 
@@ -574,6 +773,10 @@ def reload_model_weights(sd_model=None, info=None):
     timer.record("find config")
 
     if sd_model is None or checkpoint_config != sd_model.used_config:
+        if sd_model is not None:
+            model_data.loaded_sd_models.remove(sd_model)
+            model_data.sd_model = None
+
         del sd_model
         load_model(checkpoint_info, already_loaded_state_dict=state_dict)
         return model_data.sd_model
@@ -585,6 +788,8 @@ def reload_model_weights(sd_model=None, info=None):
         load_model_weights(sd_model, current_checkpoint_info, None, timer)
         raise
     finally:
+        cond_cache.clear()
+
         sd_hijack.model_hijack.hijack(sd_model)
         timer.record("hijack")
 
@@ -595,6 +800,9 @@ def reload_model_weights(sd_model=None, info=None):
             sd_model.to(devices.device)
             timer.record("move model to device")
 
+        model_data.mark_used(sd_model)
+        apply_model_limits()
+
     print(f"Weights loaded in {timer.summary()}.")
 
     return sd_model
@@ -609,6 +817,12 @@ def unload_model_weights(sd_model=None, info=None):
         sd_hijack.model_hijack.undo_hijack(model_data.sd_model)
         model_data.sd_model = None
         sd_model = None
+
+    for loaded_model in model_data.loaded_sd_models:
+        loaded_model.to(devices.cpu)
+
+    if model_data.loaded_sd_models:
+        model_data.loaded_sd_models.clear()
         gc.collect()
         devices.torch_gc()
 
@@ -37,6 +37,8 @@ class VanillaStableDiffusionSampler:
         self.eta = None
         self.config = None
         self.last_latent = None
+        self.cond_table = None
+        self.uncond_table = None
 
         self.conditioning_key = sd_model.model.conditioning_key
 
@@ -80,8 +82,11 @@ class VanillaStableDiffusionSampler:
             cond = cond["c_crossattn"][0]
             unconditional_conditioning = unconditional_conditioning["c_crossattn"][0]
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        unconditional_conditioning = prompt_parser.reconstruct_cond_batch(unconditional_conditioning, self.step)
+        self.cond_table = prompt_parser.get_conditioning_table(self.cond_table, cond, prompt_parser.reconstruct_multicond_batch)
+        self.uncond_table = prompt_parser.get_conditioning_table(self.uncond_table, unconditional_conditioning, prompt_parser.reconstruct_cond_batch)
+
+        conds_list, tensor = self.cond_table.get(self.step)
+        unconditional_conditioning = self.uncond_table.get(self.step)
 
         assert all(len(conds) == 1 for conds in conds_list), 'composition via AND is not supported for DDIM/PLMS samplers'
         cond = tensor
@@ -6,7 +6,7 @@ from modules import prompt_parser, devices, sd_samplers_common
 
 from modules.shared import opts, state
 import modules.shared as shared
-from modules.script_callbacks import CFGDenoiserParams, cfg_denoiser_callback
+from modules.script_callbacks import CFGDenoiserParams, cfg_denoiser_callback, callback_map
 from modules.script_callbacks import CFGDenoisedParams, cfg_denoised_callback
 from modules.script_callbacks import AfterCFGCallbackParams, cfg_after_cfg_callback
 
@@ -92,6 +92,8 @@ class CFGDenoiser(torch.nn.Module):
         self.step = 0
         self.image_cfg_scale = None
         self.padded_cond_uncond = False
+        self.cond_table = None
+        self.uncond_table = None
 
     def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
         denoised_uncond = x_out[-uncond.shape[0]:]
@@ -117,8 +119,16 @@ class CFGDenoiser(torch.nn.Module):
         # so is_edit_model is set to False to support AND composition.
         is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        self.cond_table = prompt_parser.get_conditioning_table(self.cond_table, cond, prompt_parser.reconstruct_multicond_batch)
+        self.uncond_table = prompt_parser.get_conditioning_table(self.uncond_table, uncond, prompt_parser.reconstruct_cond_batch)
+
+        conds_list, tensor = self.cond_table.get(self.step)
+        uncond = self.uncond_table.get(self.step)
+
+        # conditioning from tables is used for many steps, and callbacks are free to change what they are given
+        if callback_map['callbacks_cfg_denoiser']:
+            tensor = prompt_parser.copy_cond(tensor)
+            uncond = prompt_parser.copy_cond(uncond)
 
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
@@ -106,11 +106,28 @@ class State:
     current_image = None
     current_image_sampling_step = 0
     id_live_preview = 0
-    textinfo = None
+    _textinfo = None
     time_start = None
     server_start = None
     _server_command_signal = threading.Event()
     _server_command: Optional[str] = None
+    _thread_data = threading.local()
+    _change_callbacks = []
+
+    published_fields = {"job", "job_no", "job_count", "sampling_step", "sampling_steps", "id_live_preview", "_textinfo", "skipped", "interrupted"}
+    """fields that are shown as progress; changing one of them calls the callbacks added with on_change"""
+
+    def __setattr__(self, name, value):
+        changed = name in self.published_fields and getattr(self, name, None) != value
+        super().__setattr__(name, value)
+
+        if changed:
+            for callback in self._change_callbacks:
+                callback()
+
+    def on_change(self, callback) -> None:
+        """Adds a function to be called without arguments, from the thread that made the change, whenever progress changes."""
+        self._change_callbacks.append(callback)
 
     @property
     def need_restart(self) -> bool:
@@ -181,7 +198,34 @@ class State:
 
         return obj
 
+    @property
+    def detached(self) -> bool:
+        """True if the current thread runs a job alongside the one that this State tracks, and must not change it."""
+        return getattr(self._thread_data, "detached", False)
+
+    def detach_thread(self, detached: bool) -> None:
+        self._thread_data.detached = detached
+        self._thread_data.textinfo = None
+
+    @property
+    def textinfo(self) -> Optional[str]:
+        """Info text for the job; a detached thread gets its own, so that it doesn't replace the text of the job that this State tracks."""
+        if self.detached:
+            return getattr(self._thread_data, "textinfo", None)
+
+        return self._textinfo
+
+    @textinfo.setter
+    def textinfo(self, value: Optional[str]) -> None:
+        if self.detached:
+            self._thread_data.textinfo = value
+        else:
+            self._textinfo = value
+
     def begin(self, job: str = "(unknown)"):
+        if self.detached:
+            return
+
         self.sampling_step = 0
         self.job_count = -1
         self.processing_has_refined_job_count = False
@@ -200,6 +244,9 @@ class State:
         log.info("Starting job %s", job)
 
     def end(self):
+        if self.detached:
+            return
+
         duration = time.time() - self.time_start
         log.info("Ending job %s (%.2f seconds)", self.job, duration)
         self.job = ""
@@ -340,6 +387,9 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
     "img_downscale_threshold": OptionInfo(4.0, "File size limit for the above option, MB", gr.Number),
     "target_side_length": OptionInfo(4000, "Width/height limit for the above option, in pixels", gr.Number),
     "img_max_size_mp": OptionInfo(200, "Maximum image size", gr.Number).info("in megapixels"),
+    "save_images_in_background": OptionInfo(True, "Save generated images in background").info("generation goes on with the next batch while images are written to disk"),
+    "save_images_workers": OptionInfo(2, "Number of threads saving images in background", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}),
+    "save_images_queue_size": OptionInfo(16, "Maximum number of images waiting to be saved in background", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}).info("generation waits for saving when there are more"),
 
     "use_original_name_batch": OptionInfo(True, "Use original name for output filename during batch process in extras tab"),
     "use_upscaler_name_as_suffix": OptionInfo(False, "Use upscaler name as filename suffix in the extras tab"),
@@ -374,6 +424,8 @@ options_templates.update(options_section(('saving-to-dirs', "Saving to a directo
 options_templates.update(options_section(('upscaling', "Upscaling"), {
     "ESRGAN_tile": OptionInfo(192, "Tile size for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
     "ESRGAN_tile_overlap": OptionInfo(8, "Tile overlap for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}).info("Low values = visible seam"),
+    "upscaler_models_cache_mb": OptionInfo(1024, "Memory for keeping upscaler models loaded between uses", gr.Number, {"precision": 0}).info("in MB, for all upscaler models together; kept in RAM between jobs and moved to GPU when used; least recently used ones are unloaded first; 0 = load model every time"),
+    "upscaler_tile_batch_size": OptionInfo(4, "Tile batch size for ESRGAN, SwinIR and ScuNET upscalers", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}).info("number of tiles upscaled at once; higher = faster, but uses more VRAM"),
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Select which Real-ESRGAN models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.realesrgan_models_names()}),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in sd_upscalers]}),
 }))
@@ -392,6 +444,16 @@ options_templates.update(options_section(('system', "System"), {
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
     "list_hidden_files": OptionInfo(True, "Load models/files in hidden directories").info("directory is hidden if its name starts with \".\""),
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
+    "sd_checkpoint_streaming_load": OptionInfo(True, "Load .safetensors checkpoints into the model a few layers at a time").info("uses less RAM while loading; doesn't work if memmapping is disabled"),
+    "job_queue_parallel": OptionInfo(True, "Run postprocessing and interrogation jobs alongside generation").info("only when they don't need the same models; hires fix and face restoration wait for running postprocessing; always off with --lowvram and --medvram"),
+    "job_queue_max_size": OptionInfo(0, "Maximum number of waiting jobs of each type", gr.Number, {"precision": 0}).info("0 = unlimited; further requests are refused until the queue shrinks"),
+    "api_txt2img_batch_window": OptionInfo(0, "API: time to wait for compatible txt2img requests to run them as one batch", gr.Slider, {"minimum": 0, "maximum": 2000, "step": 10}).info("in milliseconds; 0 = disable; requests are merged if they only differ in prompt, negative prompt, seed and batch size"),
+    "api_txt2img_batch_max_size": OptionInfo(8, "API: maximum batch size for merged txt2img requests", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "api_results_ttl": OptionInfo(300, "API: time to keep images for requests with response_format=urls", gr.Number, {"precision": 0}).info("in seconds"),
+    "api_results_max_mb": OptionInfo(512, "API: maximum size of kept images for requests with response_format=urls", gr.Number, {"precision": 0}).info("in MB; 0 = no limit; images of oldest requests are removed first"),
+    "hash_in_background": OptionInfo(True, "Calculate hashes of new checkpoints, Lora and embeddings in background"),
+    "hash_workers": OptionInfo(2, "Number of files to hash at once in background", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}),
+    "hash_io_limit_mb": OptionInfo(0, "Disk read speed limit for background hashing", gr.Number, {"precision": 0}).info("in MB/s, for all files together; 0 = unlimited"),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -401,6 +463,10 @@ options_templates.update(options_section(('training', "Training"), {
     "save_training_settings_to_txt": OptionInfo(True, "Save textual inversion and hypernet settings to a text file whenever training starts."),
     "dataset_filename_word_regex": OptionInfo("", "Filename word regex"),
     "dataset_filename_join_string": OptionInfo(" ", "Filename join string"),
+    "training_cache_latents": OptionInfo(True, "Cache latents of dataset images on disk").info("images that did not change since the last training with same VAE, size and latent sampling method are not passed through VAE again; stored in cache/latents"),
+    "training_vae_encode_batch_size": OptionInfo(4, "Batch size for passing dataset images through VAE", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "training_lazy_latents": OptionInfo(True, "Read cached latents from disk when they are used instead of keeping all of them in RAM").info("requires latents cache; for very large datasets"),
+    "training_dataset_workers": OptionInfo(4, "Number of threads reading and resizing dataset images", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}),
     "training_image_repeats_per_epoch": OptionInfo(1, "Number of repeats for a single input image per epoch; used only for displaying epoch number", gr.Number, {"precision": 0}),
     "training_write_csv_every": OptionInfo(500, "Save an csv containing the loss to log directory every N steps, 0 to disable"),
     "training_xattention_optimizations": OptionInfo(False, "Use cross attention optimizations while training"),
@@ -412,6 +478,8 @@ options_templates.update(options_section(('training', "Training"), {
 options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}).info("switching to a loaded checkpoint does not read it from disk again; least recently used ones are unloaded first"),
+    "sd_checkpoints_gpu_limit": OptionInfo(1, "Maximum number of loaded checkpoints to keep in VRAM", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}).info("others are kept in RAM; has no effect with --lowvram and --medvram"),
     "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     "sd_vae": OptionInfo("Automatic", "SD VAE", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list).info("choose VAE model: Automatic = use one with same filename as checkpoint; None = use VAE from checkpoint"),
     "sd_vae_as_default": OptionInfo(True, "Ignore selected VAE for stable diffusion checkpoints that have their own .vae.pt next to them"),
@@ -446,6 +514,8 @@ options_templates.update(options_section(('optimizations', "Optimizations"), {
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for high-res pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}).info("only applies if non-zero and overrides above"),
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt to be same length").info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "experimental_persistent_cond_cache": OptionInfo(False, "persistent cond cache").info("Experimental, keep cond caches across jobs, reduce overhead."),
+    "cond_cache_size_mb": OptionInfo(256, "Prompt conditioning cache size (MB)", gr.Number).info("computed conditionings for prompts are kept and reused across jobs; 0 = disable"),
+    "sd_vae_decode_batch_size": OptionInfo(0, "VAE decode batch size", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}).info("0 = automatic, based on free VRAM; 1 = decode images one by one"),
 }))
 
 options_templates.update(options_section(('compatibility', "Compatibility"), {
@@ -465,11 +535,14 @@ options_templates.update(options_section(('interrogate', "Interrogate Options"),
     "interrogate_clip_max_length": OptionInfo(48, "BLIP: maximum description length", gr.Slider, {"minimum": 1, "maximum": 256, "step": 1}),
     "interrogate_clip_dict_limit": OptionInfo(1500, "CLIP: maximum number of lines in text file").info("0 = No limit"),
     "interrogate_clip_skip_categories": OptionInfo([], "CLIP: skip inquire categories", gr.CheckboxGroup, lambda: {"choices": modules.interrogate.category_types()}, refresh=modules.interrogate.category_types),
+    "interrogate_batch_size": OptionInfo(8, "CLIP: batch size for interrogating multiple images", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}).info("used by batch interrogation in img2img tab and API"),
     "interrogate_deepbooru_score_threshold": OptionInfo(0.5, "deepbooru: score threshold", gr.Slider, {"minimum": 0, "maximum": 1, "step": 0.01}),
     "deepbooru_sort_alpha": OptionInfo(True, "deepbooru: sort tags alphabetically").info("if not: sort by score"),
     "deepbooru_use_spaces": OptionInfo(True, "deepbooru: use spaces in tags").info("if not: use underscores"),
     "deepbooru_escape": OptionInfo(True, "deepbooru: escape (\\) brackets").info("so they are used as literal brackets and not for emphasis"),
     "deepbooru_filter_tags": OptionInfo("", "deepbooru: filter out those tags").info("separate by comma"),
+    "deepbooru_batch_size": OptionInfo(16, "deepbooru: batch size for tagging multiple images", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}).info("used by preprocessing, batch interrogation and API"),
+    "deepbooru_workers": OptionInfo(4, "deepbooru: number of threads reading and resizing images for batches", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}),
 }))
 
 options_templates.update(options_section(('extra_networks', "Extra Networks"), {
@@ -566,7 +639,9 @@ options_templates.update(options_section(('sampler-params', "Sampler parameters"
 options_templates.update(options_section(('postprocessing', "Postprocessing"), {
     'postprocessing_enable_in_main_ui': OptionInfo([], "Enable postprocessing operations in txt2img and img2img tabs", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
-    'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 100, "step": 1}),
+    'upscaling_cache_size_mb': OptionInfo(512, "Maximum size of upscaling cache in memory (MB)", gr.Number).info("images are also limited by the count above; cache is shared by extras tab, batch processing and API"),
+    'upscaling_cache_disk_mb': OptionInfo(0, "Maximum size of upscaling cache on disk (MB)", gr.Number).info("0 = disabled; images pushed out of memory are saved as PNG files in cache/upscale and reused from there"),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
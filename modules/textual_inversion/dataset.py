@@ -1,3 +1,5 @@
+import collections
+import copy
 import os
 import numpy as np
 import PIL
@@ -6,11 +8,13 @@ from PIL import Image
 from torch.utils.data import Dataset, DataLoader, Sampler
 from torchvision import transforms
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from random import shuffle, choices
 
 import random
 import tqdm
 from modules import devices, shared
+from modules.textual_inversion import latent_cache
 import re
 
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
@@ -19,7 +23,7 @@ re_numbers_at_start = re.compile(r"^[-\d]+\s*")
 
 
 class DatasetEntry:
-    def __init__(self, filename=None, filename_text=None, latent_dist=None, latent_sample=None, cond=None, cond_text=None, pixel_values=None, weight=None):
+    def __init__(self, filename=None, filename_text=None, latent_dist=None, latent_sample=None, cond=None, cond_text=None, pixel_values=None, weight=None, cache_key=None, weight_key=None):
         self.filename = filename
         self.filename_text = filename_text
         self.weight = weight
@@ -28,11 +32,37 @@ class DatasetEntry:
         self.cond = cond
         self.cond_text = cond_text
         self.pixel_values = pixel_values
+        self.cache_key = cache_key
+        self.weight_key = weight_key
+
+
+class LoadedImage:
+    def __init__(self, path, size, filename_text, cache_key=None, cached=False, image=None, alpha_channel=None):
+        self.path = path
+        self.size = size
+        self.filename_text = filename_text
+        self.cache_key = cache_key
+        self.cached = cached
+        self.image = image
+        self.alpha_channel = alpha_channel
+
+
+def map_ordered(pool, func, items, window):
+    """like pool.map, but never has more than window items submitted and not yet consumed"""
+
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
 
 
 class PersonalizedBase(Dataset):
     def __init__(self, data_root, width, height, repeats, flip_p=0.5, placeholder_token="*", model=None, cond_model=None, device=None, template_file=None, include_cond=False, batch_size=1, gradient_step=1, shuffle_tags=False, tag_drop_out=0, latent_sampling_method='once', varsize=False, use_weight=False):
-        re_word = re.compile(shared.opts.dataset_filename_word_regex) if shared.opts.dataset_filename_word_regex else None
+        self.re_word = re.compile(shared.opts.dataset_filename_word_regex) if shared.opts.dataset_filename_word_regex else None
 
         self.placeholder_token = placeholder_token
 
@@ -51,98 +81,66 @@ class PersonalizedBase(Dataset):
 
         self.image_paths = [os.path.join(data_root, file_path) for file_path in os.listdir(data_root)]
 
+        self.width = width
+        self.height = height
+        self.varsize = varsize
         self.shuffle_tags = shuffle_tags
         self.tag_drop_out = tag_drop_out
+        self.latent_sampling_method = latent_sampling_method
+        self.use_weight = use_weight
         groups = defaultdict(list)
 
-        print("Preparing dataset...")
-        for path in tqdm.tqdm(self.image_paths):
-            alpha_channel = None
-            if shared.state.interrupted:
-                raise Exception("interrupted")
-            try:
-                image = Image.open(path)
-                #Currently does not work for single color transparency
-                #We would need to read image.info['transparency'] for that
-                if use_weight and 'A' in image.getbands():
-                    alpha_channel = image.getchannel('A')
-                image = image.convert('RGB')
-                if not varsize:
-                    image = image.resize((width, height), PIL.Image.BICUBIC)
-            except Exception:
-                continue
-
-            text_filename = f"{os.path.splitext(path)[0]}.txt"
-            filename = os.path.basename(path)
+        self.cache = latent_cache.LatentCache(model, width, height, varsize, latent_sampling_method) if shared.opts.training_cache_latents else None
+        self.lazy = self.cache is not None and shared.opts.training_lazy_latents
+        encode_batch_size = max(int(shared.opts.training_vae_encode_batch_size), 1)
+        workers = max(int(shared.opts.training_dataset_workers), 1)
+        pending = defaultdict(list)
 
-            if os.path.exists(text_filename):
-                with open(text_filename, "r", encoding="utf8") as file:
-                    filename_text = file.read()
-            else:
-                filename_text = os.path.splitext(filename)[0]
-                filename_text = re.sub(re_numbers_at_start, '', filename_text)
-                if re_word:
-                    tokens = re_word.findall(filename_text)
-                    filename_text = (shared.opts.dataset_filename_join_string or "").join(tokens)
-
-            npimage = np.array(image).astype(np.uint8)
-            npimage = (npimage / 127.5 - 1.0).astype(np.float32)
-
-            torchdata = torch.from_numpy(npimage).permute(2, 0, 1).to(device=device, dtype=torch.float32)
-            latent_sample = None
-
-            with devices.autocast():
-                latent_dist = model.encode_first_stage(torchdata.unsqueeze(dim=0))
-
-            #Perform latent sampling, even for random sampling.
-            #We need the sample dimensions for the weights
-            if latent_sampling_method == "deterministic":
-                if isinstance(latent_dist, DiagonalGaussianDistribution):
-                    # Works only for DiagonalGaussianDistribution
-                    latent_dist.std = 0
-                else:
-                    latent_sampling_method = "once"
-            latent_sample = model.get_first_stage_encoding(latent_dist).squeeze().to(devices.cpu)
-
-            if use_weight and alpha_channel is not None:
-                channels, *latent_size = latent_sample.shape
-                weight_img = alpha_channel.resize(latent_size)
-                npweight = np.array(weight_img).astype(np.float32)
-                #Repeat for every channel in the latent sample
-                weight = torch.tensor([npweight] * channels).reshape([channels] + latent_size)
-                #Normalize the weight to a minimum of 0 and a mean of 1, that way the loss will be comparable to default.
-                weight -= weight.min()
-                weight /= weight.mean()
-            elif use_weight:
-                #If an image does not have a alpha channel, add a ones weight map anyway so we can stack it later
-                weight = torch.ones(latent_sample.shape)
-            else:
-                weight = None
-
-            if latent_sampling_method == "random":
-                entry = DatasetEntry(filename=path, filename_text=filename_text, latent_dist=latent_dist, weight=weight)
-            else:
-                entry = DatasetEntry(filename=path, filename_text=filename_text, latent_sample=latent_sample, weight=weight)
-
-            if not (self.tag_drop_out != 0 or self.shuffle_tags):
-                entry.cond_text = self.create_text(filename_text)
-
-            if include_cond and not (self.tag_drop_out != 0 or self.shuffle_tags):
-                with devices.autocast():
-                    entry.cond = cond_model([entry.cond_text]).to(devices.cpu).squeeze(0)
-            groups[image.size].append(len(self.dataset))
-            self.dataset.append(entry)
-            del torchdata
-            del latent_dist
-            del latent_sample
-            del weight
+        print("Preparing dataset...")
+        try:
+            # images are read and resized by worker threads a limited number of images ahead, while this thread runs VAE
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dataset") as pool:
+                for loaded in tqdm.tqdm(map_ordered(pool, self.load_image, self.image_paths, window=max(workers, encode_batch_size) * 2), total=len(self.image_paths)):
+                    if shared.state.interrupted:
+                        raise Exception("interrupted")
+
+                    if loaded is None:
+                        continue
+
+                    entry = DatasetEntry(filename=loaded.path, filename_text=loaded.filename_text)
+
+                    if loaded.cached and self.lazy:
+                        entry.cache_key = loaded.cache_key
+                        self.set_weight(entry, loaded.alpha_channel, self.latent_shape(self.cache.shape(loaded.cache_key)))
+                    elif loaded.cached:
+                        self.set_latent(entry, self.cache.get(loaded.cache_key), loaded.alpha_channel)
+                    else:
+                        # images of the same size are collected and sent to VAE together
+                        pending[loaded.size].append((entry, loaded))
+                        if len(pending[loaded.size]) >= encode_batch_size:
+                            self.encode_images(pending.pop(loaded.size), model, device)
+
+                    if not (self.tag_drop_out != 0 or self.shuffle_tags):
+                        entry.cond_text = self.create_text(loaded.filename_text)
+
+                    if include_cond and not (self.tag_drop_out != 0 or self.shuffle_tags):
+                        with devices.autocast():
+                            entry.cond = cond_model([entry.cond_text]).to(devices.cpu).squeeze(0)
+                    groups[loaded.size].append(len(self.dataset))
+                    self.dataset.append(entry)
+
+            for items in pending.values():
+                self.encode_images(items, model, device)
+        finally:
+            # latents calculated so far are kept even if preparation was interrupted or failed
+            if self.cache is not None:
+                self.cache.save(final=True)
 
         self.length = len(self.dataset)
         self.groups = list(groups.values())
         assert self.length > 0, "No images have been found in the dataset."
         self.batch_size = min(batch_size, self.length)
         self.gradient_step = min(gradient_step, self.length // self.batch_size)
-        self.latent_sampling_method = latent_sampling_method
 
         if len(groups) > 1:
             print("Buckets:")
@@ -150,6 +148,126 @@ class PersonalizedBase(Dataset):
                 print(f"  {w}x{h}: {len(ids)}")
             print()
 
+    def load_image(self, path):
+        """runs in a worker thread; reads everything needed about the image, decoding it only if its latent is not in cache"""
+
+        alpha_channel = None
+        try:
+            image = Image.open(path)
+            size = image.size if self.varsize else (self.width, self.height)
+            cache_key = latent_cache.file_hash(path) if self.cache is not None else None
+            cached = cache_key in self.cache if self.cache is not None else False
+
+            #Currently does not work for single color transparency
+            #We would need to read image.info['transparency'] for that
+            if self.use_weight and 'A' in image.getbands() and not (self.lazy and cached and f"{cache_key}-weight" in self.cache):
+                alpha_channel = image.getchannel('A')
+
+            if cached:
+                image = None
+            else:
+                image = image.convert('RGB')
+                if not self.varsize:
+                    image = image.resize((self.width, self.height), PIL.Image.BICUBIC)
+        except Exception:
+            return None
+
+        text_filename = f"{os.path.splitext(path)[0]}.txt"
+        filename = os.path.basename(path)
+
+        if os.path.exists(text_filename):
+            with open(text_filename, "r", encoding="utf8") as file:
+                filename_text = file.read()
+        else:
+            filename_text = os.path.splitext(filename)[0]
+            filename_text = re.sub(re_numbers_at_start, '', filename_text)
+            if self.re_word:
+                tokens = self.re_word.findall(filename_text)
+                filename_text = (shared.opts.dataset_filename_join_string or "").join(tokens)
+
+        return LoadedImage(path, size, filename_text, cache_key=cache_key, cached=cached, image=image, alpha_channel=alpha_channel)
+
+    def encode_images(self, items, model, device):
+        """runs images of the same size through VAE as a single batch and assigns resulting latents to their entries"""
+
+        npimages = np.stack([np.array(loaded.image).astype(np.uint8) for _, loaded in items])
+        npimages = (npimages / 127.5 - 1.0).astype(np.float32)
+
+        torchdata = torch.from_numpy(npimages).permute(0, 3, 1, 2).to(device=device, dtype=torch.float32)
+
+        with devices.autocast():
+            latent_dist = model.encode_first_stage(torchdata)
+
+        if not isinstance(latent_dist, DiagonalGaussianDistribution):
+            # sampling anything else always gives the same result, so random and deterministic sampling are same as once
+            self.latent_sampling_method = "once"
+
+        if self.latent_sampling_method == "random":
+            # the distribution is kept, and a new sample is taken from it every time the image is used
+            latents = latent_dist.parameters
+        else:
+            if self.latent_sampling_method == "deterministic":
+                latent_dist.std = 0
+            latents = model.get_first_stage_encoding(latent_dist)
+
+        latents = latents.to(devices.cpu)
+        use_cache = self.cache is not None and self.cache.latent_sampling_method == self.latent_sampling_method
+
+        for (entry, loaded), latent in zip(items, latents):
+            if use_cache:
+                self.cache.put(loaded.cache_key, latent)
+
+            if use_cache and self.lazy:
+                entry.cache_key = loaded.cache_key
+                self.set_weight(entry, loaded.alpha_channel, self.latent_shape(latent.shape))
+            else:
+                self.set_latent(entry, latent, loaded.alpha_channel)
+
+    def latent_shape(self, stored_shape):
+        """shape of latent sample for a latent stored as stored_shape; for random sampling, mean and logvar are stored instead"""
+
+        if self.latent_sampling_method == "random":
+            channels, *size = stored_shape
+            return [channels // 2] + list(size)
+
+        return list(stored_shape)
+
+    def set_latent(self, entry, latent, alpha_channel):
+        if self.latent_sampling_method == "random":
+            entry.latent_dist = DiagonalGaussianDistribution(latent.unsqueeze(0))
+        else:
+            entry.latent_sample = latent
+
+        self.set_weight(entry, alpha_channel, self.latent_shape(latent.shape))
+
+    def set_weight(self, entry, alpha_channel, latent_shape):
+        """
+        Calculates weight map from image's alpha channel. For lazily loaded latents it's stored in cache along with them.
+        Images without alpha channel get no weight map here; a map of ones is made for them every time they are used.
+        """
+
+        if entry.cache_key is not None and self.use_weight and f"{entry.cache_key}-weight" in self.cache:
+            entry.weight_key = f"{entry.cache_key}-weight"
+            return
+
+        if not self.use_weight or alpha_channel is None:
+            return
+
+        channels, *latent_size = latent_shape
+        weight_img = alpha_channel.resize(latent_size)
+        npweight = np.array(weight_img).astype(np.float32)
+        #Repeat for every channel in the latent sample
+        weight = torch.tensor(np.array([npweight] * channels)).reshape([channels] + latent_size)
+        #Normalize the weight to a minimum of 0 and a mean of 1, that way the loss will be comparable to default.
+        weight -= weight.min()
+        weight /= weight.mean()
+
+        if entry.cache_key is not None:
+            entry.weight_key = f"{entry.cache_key}-weight"
+            self.cache.put(entry.weight_key, weight)
+        else:
+            entry.weight = weight
+
     def create_text(self, filename_text):
         text = random.choice(self.lines)
         tags = filename_text.split(',')
@@ -165,11 +283,23 @@ class PersonalizedBase(Dataset):
         return self.length
 
     def __getitem__(self, i):
-        entry = self.dataset[i]
+        # a copy, so that latents and weights loaded for this use are not kept in the dataset
+        entry = copy.copy(self.dataset[i])
         if self.tag_drop_out != 0 or self.shuffle_tags:
             entry.cond_text = self.create_text(entry.filename_text)
+        if entry.cache_key is not None:
+            latent = self.cache.get(entry.cache_key)
+            if self.latent_sampling_method == "random":
+                entry.latent_dist = DiagonalGaussianDistribution(latent.unsqueeze(0))
+            else:
+                entry.latent_sample = latent
+        if entry.weight_key is not None:
+            entry.weight = self.cache.get(entry.weight_key)
         if self.latent_sampling_method == "random":
             entry.latent_sample = shared.sd_model.get_first_stage_encoding(entry.latent_dist).to(devices.cpu)
+        if self.use_weight and entry.weight is None:
+            #If an image does not have a alpha channel, add a ones weight map anyway so we can stack it later
+            entry.weight = torch.ones(entry.latent_sample.shape[-3:])
         return entry
 
 
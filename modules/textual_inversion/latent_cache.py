@@ -0,0 +1,186 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from modules import paths, sd_vae, hashes
+
+cache_dir = os.path.join(paths.data_path, "cache", "latents")
+save_every = 1000
+max_age = 60 * 60 * 24 * 30
+"""latents that were not used for this many seconds are removed from the cache when it's saved"""
+
+compact_ratio = 0.25
+"""the .bin file is rewritten without data of removed latents once they take more than this part of it"""
+
+
+def file_hash(filename):
+    """hash of the file's contents; cheap compared to decoding the image and running it through VAE"""
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def vae_hash(model):
+    if sd_vae.loaded_vae_file:
+        return hashes.sha256(sd_vae.loaded_vae_file, f"vae/{os.path.basename(sd_vae.loaded_vae_file)}")
+
+    return model.sd_checkpoint_info.calculate_shorthash()
+
+
+class LatentCache:
+    """
+    Latents of training images, stored on disk so that they do not have to be calculated again when training on the
+    same dataset. Latents are appended as raw float32 data to a .bin file, which is memory-mapped for reading; a .json
+    file next to it maps hashes of images to the offset and shape of their latents, and the time they were last used.
+    Latents not used for max_age are dropped from the index by the final save, and the .bin file is compacted when data that is
+    no longer in the index grows over compact_ratio of it.
+
+    All latents in one cache share target size, VAE and latent sampling method; those are part of the cache's name.
+    """
+
+    def __init__(self, model, width, height, varsize, latent_sampling_method):
+        settings = f"{vae_hash(model)}-{'varsize' if varsize else f'{width}x{height}'}-{latent_sampling_method}"
+        name = hashlib.sha256(settings.encode("utf8")).hexdigest()[0:16]
+
+        self.latent_sampling_method = latent_sampling_method
+        self.data_filename = os.path.join(cache_dir, f"{name}.bin")
+        self.index_filename = os.path.join(cache_dir, f"{name}.json")
+        self.index = {}
+        self.data = None
+        self.changed = 0
+        self.used = set()
+        self.lock = threading.RLock()
+
+        if os.path.exists(self.index_filename) and os.path.exists(self.data_filename):
+            try:
+                with open(self.index_filename, "r", encoding="utf8") as file:
+                    self.index = json.load(file)
+            except Exception:
+                print(f"Could not read latent cache index {self.index_filename}, latents will be calculated again")
+
+        # drop entries that point past the end of data, which happens if the process was killed in the middle of writing
+        size = os.path.getsize(self.data_filename) // 4 if os.path.exists(self.data_filename) else 0
+        self.index = {k: v for k, v in self.index.items() if v[0] + math.prod(v[1]) <= size}
+
+        # indexes written before last use time was recorded
+        now = int(time.time())
+        for v in self.index.values():
+            if len(v) < 3:
+                v.append(now)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.index:
+                return False
+
+            self.used.add(key)
+            return True
+
+    def shape(self, key):
+        with self.lock:
+            return self.index[key][1]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+
+            offset, shape, _ = entry
+            end = offset + math.prod(shape)
+
+            if self.data is None or len(self.data) < end:
+                self.data = np.memmap(self.data_filename, dtype=np.float32, mode='r')
+
+            data = np.array(self.data[offset:end])
+
+        return torch.from_numpy(data.reshape(shape))
+
+    def put(self, key, tensor):
+        data = tensor.detach().to(device="cpu", dtype=torch.float32).contiguous().numpy()
+
+        with self.lock:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(self.data_filename, "ab") as file:
+                offset = file.tell() // 4
+                file.write(data.tobytes())
+
+            self.index[key] = [offset, list(data.shape), int(time.time())]
+            self.used.add(key)
+            self.changed += 1
+
+            # the index is saved every now and then, so that if preparing a large dataset is interrupted, the work is not lost
+            if self.changed >= save_every:
+                self.save()
+
+    def save(self, final=False):
+        """
+        Writes the index. With final=True, which must only be used once nothing else will look up entries that it
+        has already found, latents that were not used for max_age are also removed, and the .bin file is compacted.
+        """
+
+        with self.lock:
+            now = int(time.time())
+            for key in self.used:
+                entry = self.index.get(key)
+                if entry is not None and entry[2] != now:
+                    entry[2] = now
+                    self.changed += 1
+            self.used.clear()
+
+            if final:
+                expired = [k for k, v in self.index.items() if v[2] < now - max_age]
+                for key in expired:
+                    del self.index[key]
+                self.changed += len(expired)
+
+            if not self.changed:
+                return
+
+            if final:
+                size = os.path.getsize(self.data_filename) // 4 if os.path.exists(self.data_filename) else 0
+                used_size = sum(math.prod(v[1]) for v in self.index.values())
+                if size - used_size > size * compact_ratio:
+                    self.compact()
+
+            self.write_index()
+
+    def write_index(self):
+        """called with lock held"""
+
+        with open(self.index_filename + ".tmp", "w", encoding="utf8") as file:
+            json.dump(self.index, file)
+        os.replace(self.index_filename + ".tmp", self.index_filename)
+
+        self.changed = 0
+
+    def compact(self):
+        """called with lock held; rewrites the .bin file with only the latents that are in the index"""
+
+        data = np.memmap(self.data_filename, dtype=np.float32, mode='r')
+        index = {}
+
+        with open(self.data_filename + ".tmp", "wb") as file:
+            for key, (offset, shape, used) in sorted(self.index.items(), key=lambda x: x[1][0]):
+                index[key] = [file.tell() // 4, shape, used]
+                file.write(data[offset:offset + math.prod(shape)].tobytes())
+
+        del data
+        self.data = None
+
+        # without the old index, an interruption past this point loses the cache, but can't pair latents with wrong offsets
+        if os.path.exists(self.index_filename):
+            os.remove(self.index_filename)
+        os.replace(self.data_filename + ".tmp", self.data_filename)
+
+        self.index = index
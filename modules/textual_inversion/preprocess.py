@@ -38,6 +38,40 @@ class PreprocessParams:
     process_caption = False
     process_caption_deepbooru = False
     preprocess_txt_action = None
+    pending_captions = None
+
+
+def save_caption(basename, caption, params: PreprocessParams, existing_caption=None):
+    if params.preprocess_txt_action == 'prepend' and existing_caption:
+        caption = f"{existing_caption} {caption}"
+    elif params.preprocess_txt_action == 'append' and existing_caption:
+        caption = f"{caption} {existing_caption}"
+    elif params.preprocess_txt_action == 'copy' and existing_caption:
+        caption = existing_caption
+
+    caption = caption.strip()
+
+    if caption:
+        with open(os.path.join(params.dstdir, f"{basename}.txt"), "w", encoding="utf8") as file:
+            file.write(caption)
+
+
+def flush_pending_captions(params: PreprocessParams):
+    """runs deepbooru on all images waiting for it as one batch and writes their captions"""
+
+    if not params.pending_captions:
+        return
+
+    tags = deepbooru.model.tag_batch([image for image, *_ in params.pending_captions])
+
+    for (_, basename, caption, existing_caption), image_tags in zip(params.pending_captions, tags):
+        if caption:
+            caption += ", "
+        caption += image_tags or ""
+
+        save_caption(basename, caption, params, existing_caption=existing_caption)
+
+    params.pending_captions = []
 
 
 def save_pic_with_caption(image, index, params: PreprocessParams, existing_caption=None):
@@ -46,11 +80,6 @@ def save_pic_with_caption(image, index, params: PreprocessParams, existing_capti
     if params.process_caption:
         caption += shared.interrogator.generate_caption(image)
 
-    if params.process_caption_deepbooru:
-        if caption:
-            caption += ", "
-        caption += deepbooru.model.tag_multi(image)
-
     filename_part = params.src
     filename_part = os.path.splitext(filename_part)[0]
     filename_part = os.path.basename(filename_part)
@@ -58,18 +87,13 @@ def save_pic_with_caption(image, index, params: PreprocessParams, existing_capti
     basename = f"{index:05}-{params.subindex}-{filename_part}"
     image.save(os.path.join(params.dstdir, f"{basename}.png"))
 
-    if params.preprocess_txt_action == 'prepend' and existing_caption:
-        caption = f"{existing_caption} {caption}"
-    elif params.preprocess_txt_action == 'append' and existing_caption:
-        caption = f"{caption} {existing_caption}"
-    elif params.preprocess_txt_action == 'copy' and existing_caption:
-        caption = existing_caption
-
-    caption = caption.strip()
-
-    if caption:
-        with open(os.path.join(params.dstdir, f"{basename}.txt"), "w", encoding="utf8") as file:
-            file.write(caption)
+    if params.process_caption_deepbooru:
+        # deepbooru tags are added in batches; the caption is written once the batch is full
+        params.pending_captions.append((image, basename, caption, existing_caption))
+        if len(params.pending_captions) >= shared.opts.deepbooru_batch_size:
+            flush_pending_captions(params)
+    else:
+        save_caption(basename, caption, params, existing_caption=existing_caption)
 
     params.subindex += 1
 
@@ -151,6 +175,7 @@ def preprocess_work(process_src, process_dst, process_width, process_height, pre
     params.process_caption = process_caption
     params.process_caption_deepbooru = process_caption_deepbooru
     params.preprocess_txt_action = preprocess_txt_action
+    params.pending_captions = []
 
     pbar = tqdm.tqdm(files)
     for index, imagefile in enumerate(pbar):
@@ -230,3 +255,5 @@ def preprocess_work(process_src, process_dst, process_width, process_height, pre
             save_pic(img, index, params, existing_caption=existing_caption)
 
         shared.state.nextjob()
+
+    flush_pending_captions(params)
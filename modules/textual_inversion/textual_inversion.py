@@ -13,7 +13,7 @@ import numpy as np
 from PIL import Image, PngImagePlugin
 from torch.utils.tensorboard import SummaryWriter
 
-from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes
+from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes, hash_queue, cond_cache
 import modules.textual_inversion.dataset
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 
@@ -51,6 +51,24 @@ class Embedding:
         self.filename = None
         self.hash = None
         self.shorthash = None
+        self.device_vec = None
+
+    def vec_for(self, device):
+        """
+        Returns vec on the device. Embeddings loaded from files are kept on CPU and copied to the device the first
+        time a prompt uses them; the copy is kept for later prompts.
+        """
+
+        if self.vec.device == device:
+            return self.vec
+
+        if self.vec.requires_grad:
+            return self.vec.to(device)
+
+        if self.device_vec is None or self.device_vec[0] is not self.vec or self.device_vec[1].device != device:
+            self.device_vec = (self.vec, self.vec.to(device))
+
+        return self.device_vec[1]
 
     def save(self, filename):
         embedding_data = {
@@ -88,6 +106,10 @@ class Embedding:
         self.hash = v
         self.shorthash = self.hash[0:12]
 
+    def read_hash(self):
+        if not self.hash and self.filename:
+            self.set_hash(hashes.sha256(self.filename, "textual_inversion/" + self.name) or '')
+
 
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
@@ -118,6 +140,12 @@ class EmbeddingDatabase:
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
 
+        self.version = 0
+        """incremented every time the set of registered embeddings changes"""
+
+        self.files = {}
+        """for every file in embedding directories: ((mtime, size), embedding loaded from it or None if it's not an embedding)"""
+
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
 
@@ -128,6 +156,8 @@ class EmbeddingDatabase:
         return self.register_embedding_by_name(embedding, model, embedding.name)
 
     def register_embedding_by_name(self, embedding, model, name):
+        self.version += 1
+
         ids = model.cond_stage_model.tokenize([name])[0]
         first_id = ids[0]
         if first_id not in self.ids_lookup:
@@ -155,13 +185,33 @@ class EmbeddingDatabase:
         return vec.shape[1]
 
     def load_from_file(self, path, filename):
+        embedding = self.read_embedding_from_file(path, filename)
+        if embedding is not None:
+            self.register_loaded_embedding(embedding)
+
+    def register_loaded_embedding(self, embedding):
+        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+            self.register_embedding(embedding, shared.sd_model)
+        else:
+            self.skipped_embeddings[embedding.name] = embedding
+
+    def unregister_loaded_embedding(self, embedding):
+        if self.word_embeddings.get(embedding.name) is embedding:
+            self.register_embedding_by_name(None, shared.sd_model, embedding.name)
+
+        if self.skipped_embeddings.get(embedding.name) is embedding:
+            del self.skipped_embeddings[embedding.name]
+
+    def read_embedding_from_file(self, path, filename):
+        """returns Embedding from the file, with its tensor on CPU, or None if the file is not an embedding"""
+
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None
 
             embed_image = Image.open(path)
             if hasattr(embed_image, 'text') and 'sd-ti-embedding' in embed_image.text:
@@ -173,13 +223,13 @@ class EmbeddingDatabase:
                     name = data.get('name', name)
                 else:
                     # if data is None, means this is not an embeding, just a preview image
-                    return
+                    return None
         elif ext in ['.BIN', '.PT']:
             data = torch.load(path, map_location="cpu")
         elif ext in ['.SAFETENSORS']:
             data = safetensors.torch.load_file(path, device="cpu")
         else:
-            return
+            return None
 
         # textual inversion embeddings
         if 'string_to_param' in data:
@@ -197,7 +247,7 @@ class EmbeddingDatabase:
         else:
             raise Exception(f"Couldn't identify {filename} as neither textual inversion embedding nor diffuser concept.")
 
-        vec = emb.detach().to(devices.device, dtype=torch.float32)
+        vec = emb.detach().to(devices.cpu, dtype=torch.float32)
         embedding = Embedding(vec, name)
         embedding.step = data.get('step', None)
         embedding.sd_checkpoint = data.get('sd_checkpoint', None)
@@ -205,31 +255,52 @@ class EmbeddingDatabase:
         embedding.vectors = vec.shape[0]
         embedding.shape = vec.shape[-1]
         embedding.filename = path
-        embedding.set_hash(hashes.sha256(embedding.filename, "textual_inversion/" + name) or '')
+        embedding.set_hash(hashes.sha256_from_cache(embedding.filename, "textual_inversion/" + name) or '')
 
-        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-            self.register_embedding(embedding, shared.sd_model)
-        else:
-            self.skipped_embeddings[name] = embedding
+        if not embedding.hash:
+            hash_queue.service.enqueue(embedding.filename, "textual_inversion/" + name, callback=embedding.set_hash)
+
+        return embedding
 
     def load_from_dir(self, embdir):
+        for fullfn, fn, _ in self.list_files(embdir):
+            try:
+                self.load_from_file(fullfn, fn)
+            except Exception:
+                errors.report(f"Error loading embedding {fn}", exc_info=True)
+                continue
+
+    def list_files(self, embdir):
+        """returns (full path, filename, (mtime, size)) for all non-empty files in the directory and its subdirectories"""
+
         if not os.path.isdir(embdir.path):
-            return
+            return []
 
+        res = []
         for root, _, fns in os.walk(embdir.path, followlinks=True):
             for fn in fns:
-                try:
-                    fullfn = os.path.join(root, fn)
+                fullfn = os.path.join(root, fn)
 
-                    if os.stat(fullfn).st_size == 0:
-                        continue
+                try:
+                    stat = os.stat(fullfn)
+                except OSError:
+                    continue
 
-                    self.load_from_file(fullfn, fn)
-                except Exception:
-                    errors.report(f"Error loading embedding {fn}", exc_info=True)
+                if stat.st_size == 0:
                     continue
 
+                res.append((fullfn, fn, (stat.st_mtime_ns, stat.st_size)))
+
+        return res
+
     def load_textual_inversion_embeddings(self, force_reload=False):
+        """
+        Brings embeddings up to date with the files in embedding directories. Only files that were added or have a
+        different mtime or size since the last call are read; embeddings of changed and removed files are unregistered.
+        With force_reload, all files are checked even if no directory's mtime has changed, and all embeddings are
+        registered again from memory, which is needed when the text encoder of the model changes.
+        """
+
         if not force_reload:
             need_reload = False
             for embdir in self.embedding_dirs.values():
@@ -240,15 +311,67 @@ class EmbeddingDatabase:
             if not need_reload:
                 return
 
-        self.ids_lookup.clear()
-        self.word_embeddings.clear()
-        self.skipped_embeddings.clear()
-        self.expected_shape = self.get_expected_shape()
+        expected_shape = self.get_expected_shape()
+        reregister = force_reload or expected_shape != self.expected_shape
+        self.expected_shape = expected_shape
 
+        files = {}
         for embdir in self.embedding_dirs.values():
-            self.load_from_dir(embdir)
+            for fullfn, fn, key in self.list_files(embdir):
+                files[fullfn] = (fn, key)
+
             embdir.update()
 
+        removed = []
+        for fullfn, (key, embedding) in list(self.files.items()):
+            if fullfn not in files or files[fullfn][1] != key:
+                del self.files[fullfn]
+                if embedding is not None:
+                    removed.append(embedding)
+
+        added = []
+        for fullfn, (fn, key) in files.items():
+            if fullfn in self.files:
+                continue
+
+            try:
+                embedding = self.read_embedding_from_file(fullfn, fn)
+            except Exception:
+                errors.report(f"Error loading embedding {fn}", exc_info=True)
+                embedding = None
+
+            self.files[fullfn] = (key, embedding)
+            if embedding is not None:
+                added.append(embedding)
+
+        if not removed and not added and not reregister:
+            return
+
+        if reregister:
+            self.version += 1
+            self.ids_lookup.clear()
+            self.word_embeddings.clear()
+            self.skipped_embeddings.clear()
+
+            for fullfn in files:
+                embedding = self.files[fullfn][1]
+                if embedding is not None:
+                    self.register_loaded_embedding(embedding)
+        else:
+            for embedding in removed:
+                self.unregister_loaded_embedding(embedding)
+
+            for embedding in added:
+                self.register_loaded_embedding(embedding)
+
+            # another file may have an embedding with the same name as the one that was removed
+            for name in {x.name for x in removed} - set(self.word_embeddings) - set(self.skipped_embeddings):
+                embedding = next((x for _, x in self.files.values() if x is not None and x.name == name), None)
+                if embedding is not None:
+                    self.register_loaded_embedding(embedding)
+
+        cond_cache.clear()
+
         # re-sort word_embeddings because load_from_dir may not load in alphabetic order.
         # using a temporary copy so we don't reinitialize self.word_embeddings in case other objects have a reference to it.
         sorted_word_embeddings = {e.name: e for e in sorted(self.word_embeddings.values(), key=lambda e: e.name.lower())}
@@ -449,6 +572,7 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
         shared.parallel_processing_allowed = False
         shared.sd_model.first_stage_model.to(devices.cpu)
 
+    embedding.vec = embedding.vec.to(devices.device)
     embedding.vec.requires_grad = True
     optimizer = torch.optim.AdamW([embedding.vec], lr=scheduler.learn_rate, weight_decay=0.0)
     if shared.opts.save_optimizer_state:
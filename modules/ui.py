@@ -12,7 +12,7 @@ import numpy as np
 from PIL import Image, PngImagePlugin  # noqa: F401
 from modules.call_queue import wrap_gradio_gpu_call, wrap_queued_call, wrap_gradio_call
 
-from modules import sd_hijack, sd_models, script_callbacks, ui_extensions, deepbooru, sd_vae, extra_networks, ui_common, ui_postprocessing, progress, ui_loadsave, errors, shared_items, ui_settings, timer, sysinfo
+from modules import sd_hijack, sd_models, script_callbacks, ui_extensions, deepbooru, sd_vae, extra_networks, ui_common, ui_postprocessing, progress, ui_loadsave, errors, shared_items, ui_settings, timer, sysinfo, job_queue
 from modules.ui_components import FormRow, FormGroup, ToolButton, FormHTML
 from modules.paths import script_path
 from modules.ui_common import create_refresh_button
@@ -150,11 +150,20 @@ def process_interrogate(interrogation_function, mode, ii_input_dir, ii_output_di
         else:
             ii_output_dir = ii_input_dir
 
-        for image in images:
-            img = Image.open(image)
+        if interrogation_function == interrogate:
+            captions = shared.interrogator.interrogate_batch(Image.open(image).convert("RGB") for image in images)
+        elif interrogation_function == interrogate_deepbooru:
+            captions = deepbooru.model.tag_images(images)
+        else:
+            captions = (interrogation_function(Image.open(image)) for image in images)
+
+        for caption, image in zip(captions, images):
+            if caption is None:
+                continue
+
             filename = os.path.basename(image)
             left, _ = os.path.splitext(filename)
-            print(interrogation_function(img), file=open(os.path.join(ii_output_dir, f"{left}.txt"), 'a', encoding='utf-8'))
+            print(caption, file=open(os.path.join(ii_output_dir, f"{left}.txt"), 'a', encoding='utf-8'))
 
         return [gr.update(), None]
 
@@ -1340,7 +1349,7 @@ def create_ui():
         )
 
         run_preprocess.click(
-            fn=wrap_gradio_gpu_call(modules.textual_inversion.ui.preprocess, extra_outputs=[gr.update()]),
+            fn=wrap_gradio_gpu_call(modules.textual_inversion.ui.preprocess, extra_outputs=[gr.update()], job_type=job_queue.train),
             _js="start_training_textual_inversion",
             inputs=[
                 dummy_component,
@@ -1376,7 +1385,7 @@ def create_ui():
         )
 
         train_embedding.click(
-            fn=wrap_gradio_gpu_call(modules.textual_inversion.ui.train_embedding, extra_outputs=[gr.update()]),
+            fn=wrap_gradio_gpu_call(modules.textual_inversion.ui.train_embedding, extra_outputs=[gr.update()], job_type=job_queue.train),
             _js="start_training_textual_inversion",
             inputs=[
                 dummy_component,
@@ -1410,7 +1419,7 @@ def create_ui():
         )
 
         train_hypernetwork.click(
-            fn=wrap_gradio_gpu_call(modules.hypernetworks.ui.train_hypernetwork, extra_outputs=[gr.update()]),
+            fn=wrap_gradio_gpu_call(modules.hypernetworks.ui.train_hypernetwork, extra_outputs=[gr.update()], job_type=job_queue.train),
             _js="start_training_textual_inversion",
             inputs=[
                 dummy_component,
@@ -1527,7 +1536,7 @@ def create_ui():
 
         modelmerger_merge.click(fn=lambda: '', inputs=[], outputs=[modelmerger_result])
         modelmerger_merge.click(
-            fn=wrap_gradio_gpu_call(modelmerger, extra_outputs=lambda: [gr.update() for _ in range(4)]),
+            fn=wrap_gradio_gpu_call(modelmerger, extra_outputs=lambda: [gr.update() for _ in range(4)], job_type=job_queue.exclusive),
             _js='modelmerger',
             inputs=[
                 dummy_component,
@@ -11,7 +11,7 @@ import html
 import shutil
 import errno
 
-from modules import extensions, shared, paths, config_states, errors, restart
+from modules import extensions, shared, paths, config_states, errors, restart, job_queue
 from modules.paths_internal import config_states_dir
 from modules.call_queue import wrap_gradio_gpu_call
 
@@ -555,7 +555,7 @@ def create_ui():
                 )
 
                 check.click(
-                    fn=wrap_gradio_gpu_call(check_updates, extra_outputs=[gr.update()]),
+                    fn=wrap_gradio_gpu_call(check_updates, extra_outputs=[gr.update()], job_type=job_queue.exclusive),
                     _js="extensions_check",
                     inputs=[info, extensions_disabled_list],
                     outputs=[extensions_table, info],
@@ -61,6 +61,11 @@ def get_single_card(page: str = "", tabname: str = "", name: str = ""):
 
     page = next(iter([x for x in extra_pages if x.name == page]), None)
 
+    # files of the item may have just been changed by user metadata editor
+    existing_item = page.items.get(name)
+    if existing_item and existing_item.get("filename"):
+        page.scan_directory(os.path.dirname(existing_item["filename"]))
+
     try:
         item = page.create_item(name, enable_filter=False)
         page.items[name] = item
@@ -74,10 +79,55 @@ def get_single_card(page: str = "", tabname: str = "", name: str = ""):
     return JSONResponse({"html": item_html})
 
 
+def get_cards(page: str = "", tabname: str = "", search: str = "", sort: str = "default", descending: bool = False, offset: int = 0, limit: int = 100):
+    """
+    Returns a part of cards for a page as JSON, with the same filtering and sorting the UI does on the full list: cards
+    whose name or search term contain search, sorted by one of sort_keys of the items.
+    """
+
+    from starlette.responses import JSONResponse
+
+    page = next(iter([x for x in extra_pages if x.name == page]), None)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    if not page.items:
+        page.refresh_items()
+
+    search = search.lower()
+    cards = []
+    for item in list(page.items.values()):
+        if search not in f"{item['name']} {item.get('search_term', '')}".lower():
+            continue
+
+        if page.is_search_only(item) and (len(search) < 4 or shared.opts.extra_networks_hidden_models == "Never"):
+            continue
+
+        cards.append(item)
+
+    def sort_key(item):
+        sort_keys = item.get("sort_keys", {})
+        value = sort_keys.get(sort, sort_keys.get("default"))
+        return value is None, value if value is not None else 0
+
+    cards.sort(key=sort_key, reverse=descending)
+
+    result = []
+    for item in cards[max(offset, 0):max(offset, 0) + max(limit, 0)]:
+        result.append({
+            "name": item["name"],
+            "html": page.card_html(item, tabname),
+            "sort_keys": item.get("sort_keys", {}),
+        })
+
+    return JSONResponse({"total": len(cards), "offset": offset, "cards": result})
+
+
 def add_pages_to_demo(app):
     app.add_api_route("/sd_extra_networks/thumb", fetch_file, methods=["GET"])
     app.add_api_route("/sd_extra_networks/metadata", get_metadata, methods=["GET"])
     app.add_api_route("/sd_extra_networks/get-single-card", get_single_card, methods=["GET"])
+    app.add_api_route("/sd_extra_networks/cards", get_cards, methods=["GET"])
 
 
 def quote_js(s):
@@ -96,9 +146,100 @@ class ExtraNetworksPage:
         self.metadata = {}
         self.items = {}
 
+        self.files = {}
+        """for every directory with previews: dict of names of files in it to their (mtime, ctime); filled by scan_files()"""
+
+        self.child_directories = {}
+        self.file_contents = {}
+        self.html_cache = {}
+
     def refresh(self):
         pass
 
+    def scan_files(self):
+        """
+        Lists all files in directories with previews along with their stats, once per refresh; checks for previews,
+        descriptions and user metadata of items are answered from this listing instead of touching the disk for every
+        item, and text files are only read again if their mtime has changed.
+        """
+
+        self.files = {}
+        self.child_directories = {}
+
+        visited = set()
+        for parentdir in self.allowed_directories_for_previews():
+            self.scan_directory(os.path.abspath(parentdir), recursive=True, visited=visited)
+
+        self.file_contents = {k: v for k, v in self.file_contents.items() if self.file_stat(k) is not None}
+
+    def scan_directory(self, path, recursive=False, visited=None):
+        if visited is not None:
+            realpath = os.path.realpath(path)
+            if realpath in visited:
+                return
+
+            visited.add(realpath)
+
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return
+
+        files = {}
+        children = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    children.append(entry.path)
+                    continue
+
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            files[os.path.normcase(entry.name)] = (stat.st_mtime, stat.st_ctime)
+
+        self.files[os.path.normcase(path)] = files
+        self.child_directories[path] = children
+
+        if recursive:
+            for child in children:
+                self.scan_directory(child, recursive=True, visited=visited)
+
+    def file_stat(self, filename):
+        """returns (mtime, ctime) of the file if it exists, or None"""
+
+        directory, name = os.path.split(os.path.normcase(os.path.abspath(filename)))
+
+        files = self.files.get(directory)
+        if files is not None:
+            return files.get(name)
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        return (stat.st_mtime, stat.st_ctime) if os.path.isfile(filename) else None
+
+    def read_file(self, filename):
+        """returns text of the file, or None if it does not exist; the text is remembered until file's mtime changes"""
+
+        stat = self.file_stat(filename)
+        if stat is None:
+            return None
+
+        cached = self.file_contents.get(filename)
+        if cached is not None and cached[0] == stat[0]:
+            return cached[1]
+
+        with open(filename, "r", encoding="utf-8", errors="replace") as file:
+            text = file.read()
+
+        self.file_contents[filename] = (stat[0], text)
+        return text
+
     def read_user_metadata(self, item):
         filename = item.get("filename", None)
         basename, ext = os.path.splitext(filename)
@@ -106,9 +247,9 @@ class ExtraNetworksPage:
 
         metadata = {}
         try:
-            if os.path.isfile(metadata_filename):
-                with open(metadata_filename, "r", encoding="utf8") as file:
-                    metadata = json.load(file)
+            text = self.read_file(metadata_filename)
+            if text is not None:
+                metadata = json.loads(text)
         except Exception as e:
             errors.display(e, f"reading extra network user metadata from {metadata_filename}")
 
@@ -120,7 +261,8 @@ class ExtraNetworksPage:
 
     def link_preview(self, filename):
         quoted_filename = urllib.parse.quote(filename.replace('\\', '/'))
-        mtime = os.path.getmtime(filename)
+        stat = self.file_stat(filename)
+        mtime = stat[0] if stat is not None else os.path.getmtime(filename)
         return f"./sd_extra_networks/thumb?filename={quoted_filename}&mtime={mtime}"
 
     def search_terms_from_path(self, filename, possible_directories=None):
@@ -133,25 +275,27 @@ class ExtraNetworksPage:
 
         return ""
 
+    def refresh_items(self):
+        self.scan_files()
+        self.items = {x["name"]: x for x in self.list_items()}
+
     def create_html(self, tabname):
         items_html = ''
 
         self.metadata = {}
 
+        self.refresh_items()
+
         subdirs = {}
         for parentdir in [os.path.abspath(x) for x in self.allowed_directories_for_previews()]:
-            for root, dirs, _ in sorted(os.walk(parentdir, followlinks=True), key=lambda x: shared.natural_sort_key(x[0])):
-                for dirname in sorted(dirs, key=shared.natural_sort_key):
-                    x = os.path.join(root, dirname)
-
-                    if not os.path.isdir(x):
-                        continue
-
+            roots = [x for x in self.child_directories if x == parentdir or x.startswith(os.path.join(parentdir, ""))]
+            for root in sorted(roots, key=shared.natural_sort_key):
+                for x in sorted(self.child_directories[root], key=lambda d: shared.natural_sort_key(os.path.basename(d))):
                     subdir = os.path.abspath(x)[len(parentdir):].replace("\\", "/")
                     while subdir.startswith("/"):
                         subdir = subdir[1:]
 
-                    is_empty = len(os.listdir(x)) == 0
+                    is_empty = not self.files.get(os.path.normcase(x)) and not self.child_directories.get(x)
                     if not is_empty and not subdir.endswith("/"):
                         subdir = subdir + "/"
 
@@ -169,7 +313,6 @@ class ExtraNetworksPage:
 </button>
 """ for subdir in subdirs])
 
-        self.items = {x["name"]: x for x in self.list_items()}
         for item in self.items.values():
             metadata = item.get("metadata")
             if metadata:
@@ -178,7 +321,7 @@ class ExtraNetworksPage:
             if "user_metadata" not in item:
                 self.read_user_metadata(item)
 
-            items_html += self.create_html_for_item(item, tabname)
+            items_html += self.card_html(item, tabname)
 
         if items_html == '':
             dirs = "".join([f"<li>{x}</li>" for x in self.allowed_directories_for_previews()])
@@ -206,6 +349,45 @@ class ExtraNetworksPage:
     def allowed_directories_for_previews(self):
         return []
 
+    def card_html(self, item, tabname):
+        """same as create_html_for_item, but HTML is remembered and only made again when the item or settings change"""
+
+        opts = shared.opts
+        key = (
+            repr([(k, v) for k, v in item.items() if k != "metadata"]),
+            bool(item.get("metadata")),
+            opts.extra_networks_card_height,
+            opts.extra_networks_card_width,
+            opts.extra_networks_card_text_scale,
+            opts.extra_networks_card_show_desc,
+            opts.extra_networks_hidden_models,
+        )
+
+        cached = self.html_cache.get((tabname, item["name"]))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        item_html = self.create_html_for_item(item, tabname)
+        self.html_cache[(tabname, item["name"])] = (key, item_html)
+
+        return item_html
+
+    def is_search_only(self, item):
+        """if this is true, the item must not be shown in the default view, and must instead only be shown when searching for it"""
+
+        if shared.opts.extra_networks_hidden_models == "Always":
+            return False
+
+        local_path = ""
+        filename = item.get("filename", "")
+        for reldir in self.allowed_directories_for_previews():
+            absdir = os.path.abspath(reldir)
+
+            if filename.startswith(absdir):
+                local_path = filename[len(absdir):]
+
+        return "/." in local_path or "\\." in local_path
+
     def create_html_for_item(self, item, tabname):
         """
         Create HTML for card item in tab tabname; can return empty string if the item is not meant to be shown.
@@ -227,20 +409,7 @@ class ExtraNetworksPage:
 
         edit_button = f"<div class='edit-button card-button' title='Edit metadata' onclick='extraNetworksEditUserMetadata(event, {quote_js(tabname)}, {quote_js(self.id_page)}, {quote_js(item['name'])})'></div>"
 
-        local_path = ""
-        filename = item.get("filename", "")
-        for reldir in self.allowed_directories_for_previews():
-            absdir = os.path.abspath(reldir)
-
-            if filename.startswith(absdir):
-                local_path = filename[len(absdir):]
-
-        # if this is true, the item must not be shown in the default view, and must instead only be
-        # shown when searching for it
-        if shared.opts.extra_networks_hidden_models == "Always":
-            search_only = False
-        else:
-            search_only = "/." in local_path or "\\." in local_path
+        search_only = self.is_search_only(item)
 
         if search_only and shared.opts.extra_networks_hidden_models == "Never":
             return ""
@@ -271,10 +440,14 @@ class ExtraNetworksPage:
         List of default keys used for sorting in the UI.
         """
         pth = Path(path)
-        stat = pth.stat()
+        stat = self.file_stat(path)
+        if stat is None:
+            stat = pth.stat()
+            stat = (stat.st_mtime, stat.st_ctime)
+
         return {
-            "date_created": int(stat.st_ctime or 0),
-            "date_modified": int(stat.st_mtime or 0),
+            "date_created": int(stat[1] or 0),
+            "date_modified": int(stat[0] or 0),
             "name": pth.name.lower(),
         }
 
@@ -290,7 +463,7 @@ class ExtraNetworksPage:
         potential_files = sum([[path + "." + ext, path + ".preview." + ext] for ext in preview_extensions], [])
 
         for file in potential_files:
-            if os.path.isfile(file):
+            if self.file_stat(file) is not None:
                 return self.link_preview(file)
 
         return None
@@ -301,8 +474,9 @@ class ExtraNetworksPage:
         """
         for file in [f"{path}.txt", f"{path}.description.txt"]:
             try:
-                with open(file, "r", encoding="utf-8", errors="replace") as f:
-                    return f.read()
+                text = self.read_file(file)
+                if text is not None:
+                    return text
             except OSError:
                 pass
         return None
@@ -1,5 +1,5 @@
 import gradio as gr
-from modules import scripts, shared, ui_common, postprocessing, call_queue
+from modules import scripts, shared, ui_common, postprocessing, call_queue, job_queue
 import modules.generation_parameters_copypaste as parameters_copypaste
 
 
@@ -32,7 +32,7 @@ def create_ui():
     tab_batch_dir.select(fn=lambda: 2, inputs=[], outputs=[tab_index])
 
     submit.click(
-        fn=call_queue.wrap_gradio_gpu_call(postprocessing.run_postprocessing, extra_outputs=[None, '']),
+        fn=call_queue.wrap_gradio_gpu_call(postprocessing.run_postprocessing, extra_outputs=[None, ''], job_type=job_queue.postprocess),
         inputs=[
             tab_index,
             extras_image,
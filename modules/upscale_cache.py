@@ -0,0 +1,225 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from modules import shared, errors
+from modules.paths_internal import data_path
+
+disk_cache_dir = os.path.join(data_path, "cache", "upscale")
+
+
+def fingerprint(image):
+    """content hash of an image, computed over its raw pixel buffer without converting it to python objects"""
+
+    h = hashlib.blake2b(image.tobytes(), digest_size=16)
+    h.update(f"{image.mode}:{image.width}x{image.height}".encode())
+    return h.hexdigest()
+
+
+def image_size(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class UpscaleResultCache:
+    """
+    Content-addressed cache of upscaled images, keyed by the fingerprint of the source image together with the
+    upscaler and scale, so the same picture gets the same entry no matter whether it came from the extras tab, batch
+    processing or the API.
+
+    Images are kept in memory up to upscaling_cache_size_mb and upscaling_max_images_in_cache; if
+    upscaling_cache_disk_mb is set, images pushed out of memory are saved as PNG files and read back from there on
+    the next hit, with the oldest files removed once the directory goes over the limit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.disk_entries = None
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def max_size(self):
+        return int(shared.opts.upscaling_cache_size_mb * 1024 * 1024)
+
+    def max_disk_size(self):
+        return int(shared.opts.upscaling_cache_disk_mb * 1024 * 1024)
+
+    def disk_filename(self, key):
+        return os.path.join(disk_cache_dir, hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + ".png")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        image = self.read_from_disk(key)
+
+        with self.lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+
+        if image is None:
+            return None
+
+        self.put(key, image)
+        return image
+
+    def put(self, key, image):
+        size = image_size(image)
+        spilled = []
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (image, size)
+            self.size += size
+
+            max_size = self.max_size()
+            max_count = shared.opts.upscaling_max_images_in_cache
+            while self.entries and (self.size > max_size or len(self.entries) > max_count):
+                evicted_key, (evicted_image, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                spilled.append((evicted_key, evicted_image))
+
+        for evicted_key, evicted_image in spilled:
+            self.write_to_disk(evicted_key, evicted_image)
+
+    def load_disk_index(self):
+        """called with lock held; lists files already in the cache directory, oldest first"""
+
+        if self.disk_entries is not None:
+            return
+
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+
+        if not os.path.isdir(disk_cache_dir):
+            return
+
+        files = []
+        for entry in os.scandir(disk_cache_dir):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for _, filename, size in sorted(files):
+            self.disk_entries[filename] = size
+            self.disk_size += size
+
+    def read_from_disk(self, key):
+        if self.max_disk_size() <= 0:
+            return None
+
+        filename = self.disk_filename(key)
+
+        with self.lock:
+            self.load_disk_index()
+            if filename not in self.disk_entries:
+                return None
+
+            self.disk_entries.move_to_end(filename)
+
+        try:
+            with Image.open(filename) as image:
+                image.load()
+                os.utime(filename)
+                return image.copy()
+        except Exception as e:
+            errors.display(e, f"reading cached upscale {filename}")
+            self.remove_from_disk(filename)
+            return None
+
+    def write_to_disk(self, key, image):
+        max_disk_size = self.max_disk_size()
+        if max_disk_size <= 0:
+            return
+
+        filename = self.disk_filename(key)
+
+        with self.lock:
+            self.load_disk_index()
+            if filename in self.disk_entries:
+                return
+
+        try:
+            os.makedirs(disk_cache_dir, exist_ok=True)
+            image.save(filename, format="PNG", compress_level=1)
+            size = os.path.getsize(filename)
+        except Exception as e:
+            errors.display(e, f"saving cached upscale {filename}")
+            return
+
+        removed = []
+        with self.lock:
+            self.disk_entries[filename] = size
+            self.disk_size += size
+
+            while self.disk_entries and self.disk_size > max_disk_size:
+                old_filename, old_size = self.disk_entries.popitem(last=False)
+                self.disk_size -= old_size
+                removed.append(old_filename)
+
+        for old_filename in removed:
+            try:
+                os.remove(old_filename)
+            except OSError:
+                pass
+
+    def remove_from_disk(self, filename):
+        with self.lock:
+            size = self.disk_entries.pop(filename, None)
+            if size is not None:
+                self.disk_size -= size
+
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        """removes all cached images, both from memory and from disk"""
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+            self.load_disk_index()
+            removed = list(self.disk_entries)
+            self.disk_entries.clear()
+            self.disk_size = 0
+
+        for filename in removed:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size(),
+                "disk_entries": len(self.disk_entries or ()),
+                "disk_size": self.disk_size,
+                "max_disk_size": self.max_disk_size(),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+cache = UpscaleResultCache()
@@ -1,16 +1,148 @@
+import itertools
 import os
+import threading
 from abc import abstractmethod
+from collections import OrderedDict
 
 import PIL
+import torch
 from PIL import Image
 
 import modules.shared
-from modules import modelloader, shared
+from modules import modelloader, shared, devices, job_queue
 
 LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
 NEAREST = (Image.Resampling.NEAREST if hasattr(Image, 'Resampling') else Image.NEAREST)
 
 
+def torch_module(model):
+    """torch model, or the one that a wrapper object keeps in its model field; None if there is none"""
+
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, 'model', None)
+    return module if isinstance(module, torch.nn.Module) else None
+
+
+def model_size(model):
+    """number of bytes taken by weights of a torch model, or of a wrapper object that keeps one in its model field"""
+
+    module = torch_module(model)
+    if module is None:
+        return 0
+
+    return sum(x.element_size() * x.nelement() for x in itertools.chain(module.parameters(), module.buffers()))
+
+
+def model_device(model):
+    module = torch_module(model)
+    if module is None:
+        return None
+
+    return next(itertools.chain(module.parameters(), module.buffers()), torch.empty(0)).device
+
+
+class UpscalerModelCache:
+    """
+    Models loaded by upscalers, shared by all of them, so that upscaling many images with one model loads it only once.
+    Total size of their weights is limited by upscaler_models_cache_mb, least recently used ones are unloaded first.
+
+    Cached models are moved to RAM once the job that used them is done with the upscaler, so that they don't take VRAM
+    while images are generated, and get() moves them back to the device they were loaded on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = OrderedDict()
+        self.size = 0
+        self.model_stats = {}
+
+    def stats_for(self, key):
+        """load statistics for a model; keys are (upscaler name, path, ...), and statistics are kept by first two elements"""
+
+        s = self.model_stats.get(key[:2])
+        if s is None:
+            s = {"loads": 0, "hits": 0, "evictions": 0}
+            self.model_stats[key[:2]] = s
+
+        return s
+
+    def get(self, key, load):
+        """Returns model for key, calling load() to create it if it's not in the cache."""
+
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is not None:
+                self.models.move_to_end(key)
+                self.stats_for(key)["hits"] += 1
+                self.move_to(entry[0], entry[2])
+                return entry[0]
+
+        model = load()
+        size = model_size(model)
+        max_size = shared.opts.upscaler_models_cache_mb * 1024 * 1024
+
+        with self.lock:
+            self.stats_for(key)["loads"] += 1
+
+            # another thread could have loaded the same model while this one was loading it; keep only one copy
+            entry = self.models.get(key)
+            if entry is not None:
+                self.models.move_to_end(key)
+                self.move_to(entry[0], entry[2])
+                return entry[0]
+
+            if size > max_size:
+                return model
+
+            self.models[key] = (model, size, model_device(model))
+            self.size += size
+
+            evicted = False
+            while self.size > max_size:
+                evicted_key, (_, evicted_size, _) = self.models.popitem(last=False)
+                self.size -= evicted_size
+                self.stats_for(evicted_key)["evictions"] += 1
+                evicted = True
+
+        if evicted:
+            devices.torch_gc()
+
+        return model
+
+    def move_to(self, model, device):
+        """called with lock held"""
+
+        module = torch_module(model)
+        if module is not None and device is not None and model_device(model) != device:
+            module.to(device)
+
+    def offload(self):
+        """moves cached models to RAM"""
+
+        moved = False
+        with self.lock:
+            for model, _, device in self.models.values():
+                if device is not None and device != devices.cpu and model_device(model) != devices.cpu:
+                    self.move_to(model, devices.cpu)
+                    moved = True
+
+        if moved:
+            devices.torch_gc()
+
+    def is_loaded(self, key):
+        return any(x[:2] == key[:2] for x in list(self.models))
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.size = 0
+
+        devices.torch_gc()
+
+
+model_cache = UpscalerModelCache()
+job_queue.scheduler.on_release("upscaler", model_cache.offload)
+
+
 class Upscaler:
     name = None
     model_path = None
@@ -59,7 +191,8 @@ class Upscaler:
         for _ in range(3):
             shape = (img.width, img.height)
 
-            img = self.do_upscale(img, selected_model)
+            with job_queue.scheduler.job(job_queue.upscale):
+                img = self.do_upscale(img, selected_model)
 
             if shape == (img.width, img.height):
                 break
@@ -76,6 +209,14 @@ class Upscaler:
     def load_model(self, path: str):
         pass
 
+    def model_cache_key(self, path: str):
+        return self.name, path
+
+    def load_model_cached(self, path: str):
+        """same as load_model, but returns the model from model_cache if it was loaded before"""
+
+        return model_cache.get(self.model_cache_key(path), lambda: self.load_model(path))
+
     def find_models(self, ext_filter=None) -> list:
         return modelloader.load_models(model_path=self.model_path, model_url=self.model_url, command_path=self.user_path, ext_filter=ext_filter)
 
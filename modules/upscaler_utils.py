@@ -0,0 +1,154 @@
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from modules import devices, shared
+
+
+def pil_image_to_torch_bgr(img: Image.Image) -> torch.Tensor:
+    """converts PIL image to CHW float tensor with values in [0, 1] and channels in BGR order, the way upscalers want it"""
+
+    img = np.array(img.convert("RGB"))
+    img = img[:, :, ::-1]  # RGB to BGR
+    img = np.ascontiguousarray(np.transpose(img, (2, 0, 1)))  # HWC to CHW
+    return torch.from_numpy(img).float().div_(255)
+
+
+def torch_bgr_to_pil_image(tensor: torch.Tensor) -> Image.Image:
+    arr = tensor.float().cpu().clamp_(0, 1).numpy()
+    arr = 255.0 * np.moveaxis(arr, 0, 2)  # CHW to HWC
+    arr = arr.round().astype(np.uint8)
+    arr = arr[:, :, ::-1]  # BGR to RGB
+    return Image.fromarray(arr, "RGB")
+
+
+def tile_positions(length, tile, overlap):
+    """start coordinates of tiles of size tile covering length, with neighbouring tiles overlapping by at least overlap"""
+
+    if tile >= length:
+        return [0]
+
+    stride = max(tile - overlap, 1)
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def blend_weights(tile_h, tile_w, overlap, device=None):
+    """weight map for a tile: linear ramps over the borders, so that overlapping tiles fade into each other without seams"""
+
+    def ramp(n):
+        if overlap <= 0:
+            return torch.ones(n, device=device)
+
+        r = torch.arange(1, n + 1, dtype=torch.float32, device=device).clamp_(max=overlap + 1) / (overlap + 1)
+        return torch.minimum(r, r.flip(0))
+
+    return ramp(tile_h)[:, None] * ramp(tile_w)[None, :]
+
+
+class TileBlender:
+    """
+    Accumulates upscaled tiles into a single image, blending overlaps with a precomputed weight map.
+    The output is as large as the whole upscaled image, so it's normally kept on CPU.
+    """
+
+    def __init__(self, channels, height, width, tile_h, tile_w, overlap, device):
+        self.output = torch.zeros((channels, height, width), dtype=torch.float32, device=device)
+        self.weights = torch.zeros((1, height, width), dtype=torch.float32, device=device)
+        self.weight_map = blend_weights(tile_h, tile_w, overlap, device=device)
+        self.tile_h = tile_h
+        self.tile_w = tile_w
+
+    def add(self, tile, y, x):
+        """adds tile with its top left corner at (y, x); parts of it outside of the output are cut off, which happens
+        when split_grid is used with an image smaller than the tile, and gives negative coordinates"""
+
+        _, height, width = self.output.shape
+        top, left = max(-y, 0), max(-x, 0)
+        bottom, right = min(self.tile_h, height - y), min(self.tile_w, width - x)
+        if bottom <= top or right <= left:
+            return
+
+        weight_map = self.weight_map[top:bottom, left:right]
+        y, x = y + top, x + left
+
+        self.output[:, y:y + bottom - top, x:x + right - left].addcmul_(tile[:, top:bottom, left:right].float(), weight_map)
+        self.weights[:, y:y + bottom - top, x:x + right - left].add_(weight_map)
+
+    def result(self):
+        return self.output / self.weights.clamp(min=1e-8)
+
+
+@torch.no_grad()
+def tiled_upscale(img, model, *, tile_size, tile_overlap, device, dtype=torch.float32, batch_size=None, desc="Tiles"):
+    """Upscales CHW tensor img with model, splitting it into tiles that are run through the model in batches.
+
+    Only the tiles of the current batch are on device: each batch is copied there from a pinned buffer, and the results
+    are copied back and blended into an output tensor on CPU, so that VRAM use depends on tile size, not on the size of
+    the image. Returns the upscaled CHW float tensor on CPU, or None if the job was interrupted before anything was
+    upscaled.
+    """
+
+    batch_size = batch_size or shared.opts.upscaler_tile_batch_size
+    _, h, w = img.shape
+
+    if tile_size <= 0:
+        return model(img.unsqueeze(0).to(device, dtype=dtype))[0].float().cpu()
+
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    coords = [(y, x) for y in tile_positions(h, tile_h, tile_overlap) for x in tile_positions(w, tile_w, tile_overlap)]
+    blender = None
+    scale = 1
+
+    buffer = torch.empty((min(batch_size, len(coords)), img.shape[0], tile_h, tile_w), dtype=img.dtype)
+    if device.type == "cuda":
+        buffer = buffer.pin_memory()  # lets the copies below run asynchronously; results are copied back before the buffer is reused
+
+    with tqdm(total=len(coords), desc=desc) as pbar:
+        for i in range(0, len(coords), batch_size):
+            if shared.state.interrupted or shared.state.skipped:
+                break
+
+            batch_coords = coords[i:i + batch_size]
+            batch = torch.stack([img[:, y:y + tile_h, x:x + tile_w] for y, x in batch_coords], out=buffer[:len(batch_coords)])
+            output = model(batch.to(device, dtype=dtype, non_blocking=True)).float().cpu()
+
+            if blender is None:
+                scale = output.shape[2] // tile_h
+                blender = TileBlender(output.shape[1], h * scale, w * scale, tile_h * scale, tile_w * scale, tile_overlap * scale, devices.cpu)
+
+            for (y, x), tile in zip(batch_coords, output):
+                blender.add(tile, y * scale, x * scale)
+
+            pbar.update(len(batch_coords))
+
+    if blender is None:
+        return None
+
+    return blender.result()
+
+
+def upscale_with_model(model, img: Image.Image, *, tile_size, tile_overlap, device, dtype=torch.float32, pad_to_multiple=1, desc="Tiles"):
+    """Upscales PIL image with model using tiled_upscale; returns original image if the job was interrupted."""
+
+    tensor = pil_image_to_torch_bgr(img)
+    _, h, w = tensor.shape
+
+    # mirror the image at the bottom/right edges for models that need dimensions to be multiples of some size
+    pad_h = -h % pad_to_multiple
+    pad_w = -w % pad_to_multiple
+    if pad_h:
+        tensor = torch.cat([tensor, tensor.flip(1)], 1)[:, :h + pad_h, :]
+    if pad_w:
+        tensor = torch.cat([tensor, tensor.flip(2)], 2)[:, :, :w + pad_w]
+
+    output = tiled_upscale(tensor, model, tile_size=tile_size, tile_overlap=tile_overlap, device=device, dtype=dtype, desc=desc)
+    if output is None:
+        return img
+
+    scale = output.shape[1] // tensor.shape[1]
+    output = output[:, :h * scale, :w * scale]
+
+    devices.torch_gc()
+
+    return torch_bgr_to_pil_image(output)
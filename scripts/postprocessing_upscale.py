@@ -1,14 +1,11 @@
 from PIL import Image
-import numpy as np
 
-from modules import scripts_postprocessing, shared
+from modules import scripts_postprocessing, shared, upscale_cache
 import gradio as gr
 
 from modules.ui_components import FormRow, ToolButton
 from modules.ui import switch_values_symbol
 
-upscale_cache = {}
-
 
 class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
     name = "Upscale"
@@ -61,17 +58,15 @@ class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
         else:
             info["Postprocess upscale by"] = upscale_by
 
-        cache_key = (hash(np.array(image.getdata()).tobytes()), upscaler.name, upscale_mode, upscale_by,  upscale_to_width, upscale_to_height, upscale_crop)
-        cached_image = upscale_cache.pop(cache_key, None)
+        # the upscaler only sees the image and the scale; cropping happens below, so it is not part of the key
+        cache_key = (upscale_cache.fingerprint(image), upscaler.name, upscale_by)
+        cached_image = upscale_cache.cache.get(cache_key)
 
         if cached_image is not None:
             image = cached_image
         else:
             image = upscaler.scaler.upscale(image, upscale_by, upscaler.data_path)
-
-        upscale_cache[cache_key] = image
-        if len(upscale_cache) > shared.opts.upscaling_max_images_in_cache:
-            upscale_cache.pop(next(iter(upscale_cache), None), None)
+            upscale_cache.cache.put(cache_key, image)
 
         if upscale_mode == 1 and upscale_crop:
             cropped = Image.new("RGB", (upscale_to_width, upscale_to_height))
@@ -108,9 +103,6 @@ class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
 
         pp.image = upscaled_image
 
-    def image_changed(self):
-        upscale_cache.clear()
-
 
 class ScriptPostprocessingUpscaleSimple(ScriptPostprocessingUpscale):
     name = "Simple Upscale"
@@ -4,7 +4,7 @@ import modules.scripts as scripts
 import gradio as gr
 from PIL import Image
 
-from modules import processing, shared, images, devices
+from modules import processing, shared, images, devices, upscaler_utils
 from modules.processing import Processed
 from modules.shared import opts, state
 
@@ -84,13 +84,15 @@ class Script(scripts.Script):
                 p.seed = processed.seed + 1
                 work_results += processed.images
 
+            blender = upscaler_utils.TileBlender(3, grid.image_h, grid.image_w, grid.tile_h, grid.tile_w, grid.overlap, devices.cpu)
             image_index = 0
-            for _y, _h, row in grid.tiles:
-                for tiledata in row:
-                    tiledata[2] = work_results[image_index] if image_index < len(work_results) else Image.new("RGB", (p.width, p.height))
+            for y, _h, row in grid.tiles:
+                for x, _w, _tile in row:
+                    tile = work_results[image_index] if image_index < len(work_results) else Image.new("RGB", (p.width, p.height))
+                    blender.add(upscaler_utils.pil_image_to_torch_bgr(tile), y, x)
                     image_index += 1
 
-            combined_image = images.combine_grid(grid)
+            combined_image = upscaler_utils.torch_bgr_to_pil_image(blender.result())
             result_images.append(combined_image)
 
             if opts.samples_save:
@@ -0,0 +1,109 @@
+"""
+Measures per-step overhead of CFGDenoiser outside of the UNet: the UNet is replaced with a model that returns its
+input, so what is left is preparing conditioning for the step, building the batch and combining the results. It is
+run once with conditioning looked up in prompt_parser.ConditioningTable, and once rebuilding it on every step, as
+was done before the tables were added.
+
+Conditioning is random, with SD1 shapes, for a batch of prompts where some use prompt editing and are longer than 75
+tokens. Runs on CPU; no checkpoint is needed. Run from the webui directory, in its venv:
+
+    python -m test.benchmarks.bench_cfg_denoiser --batch-size 8 --steps 30
+"""
+
+import argparse
+import os
+import sys
+import time
+import types
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--steps", type=int, default=30)
+parser.add_argument("--repeats", type=int, default=5)
+args = parser.parse_args()
+
+sys.argv = sys.argv[:1]  # webui parses the command line on import
+os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+
+import torch  # noqa: E402
+
+from modules import prompt_parser, shared, sd_samplers_kdiffusion  # noqa: E402
+from modules.prompt_parser import ScheduledPromptConditioning, ComposableScheduledPromptConditioning, MulticondLearnedConditioning  # noqa: E402
+
+
+class IdentityModel(torch.nn.Module):
+    def forward(self, x, sigma, cond):
+        return x
+
+
+class ReconstructEveryStep:
+    """stand-in for ConditioningTable that makes conditioning anew for every step"""
+
+    def __init__(self, c, reconstruct):
+        self.c = c
+        self.reconstruct = reconstruct
+
+    def get(self, current_step):
+        return self.reconstruct(self.c, current_step)
+
+
+def make_conds():
+    def schedule(i):
+        tokens = 77 * (1 + i % 2)
+        if i % 3:
+            return [ScheduledPromptConditioning(args.steps // 3, torch.randn(tokens, 768)), ScheduledPromptConditioning(args.steps, torch.randn(tokens, 768))]
+
+        return [ScheduledPromptConditioning(args.steps, torch.randn(tokens, 768))]
+
+    cond = MulticondLearnedConditioning((args.batch_size, ), [[ComposableScheduledPromptConditioning(schedule(i))] for i in range(args.batch_size)])
+    uncond = [[ScheduledPromptConditioning(args.steps, torch.randn(77, 768))] for _ in range(args.batch_size)]
+
+    return cond, uncond
+
+
+def run(cond, uncond):
+    """average time of one step, in milliseconds"""
+
+    x = torch.randn(args.batch_size, 4, 64, 64)
+    sigma = torch.ones(args.batch_size)
+    image_cond = torch.zeros(args.batch_size, 5, 1, 1)
+
+    best = None
+    for _ in range(args.repeats):
+        denoiser = sd_samplers_kdiffusion.CFGDenoiser(IdentityModel())
+
+        t = time.perf_counter()
+        for _ in range(args.steps):
+            denoiser(x, sigma, uncond=uncond, cond=cond, cond_scale=7.0, s_min_uncond=0.0, image_cond=image_cond)
+        elapsed = time.perf_counter() - t
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / args.steps * 1000
+
+
+def main():
+    shared.sd_model = types.SimpleNamespace(
+        cond_stage_key="crossattn",
+        model=types.SimpleNamespace(conditioning_key="crossattn"),
+        cond_stage_model_empty_prompt=torch.zeros(1, 77, 768),
+    )
+    shared.opts.live_previews_enable = False
+
+    cond, uncond = make_conds()
+
+    with torch.no_grad():
+        with_tables = run(cond, uncond)
+
+        get_conditioning_table = prompt_parser.get_conditioning_table
+        prompt_parser.get_conditioning_table = lambda table, c, reconstruct: ReconstructEveryStep(c, reconstruct)
+        try:
+            every_step = run(cond, uncond)
+        finally:
+            prompt_parser.get_conditioning_table = get_conditioning_table
+
+    print(f"batch of {args.batch_size}, {args.steps} steps, per step overhead: {every_step:.3f} ms rebuilding conditioning every step, {with_tables:.3f} ms with conditioning tables")
+
+
+if __name__ == "__main__":
+    main()
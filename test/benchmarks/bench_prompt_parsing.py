@@ -0,0 +1,75 @@
+"""
+Measures the cost of parsing prompt schedules (prompt_parser.get_learned_conditioning_prompt_schedules) and of
+tokenizing prompts (FrozenCLIPEmbedderWithCustomWords.process_texts), each with empty caches and with the prompts
+already seen, the way the same prompt is processed again in every job and on every keystroke by the token counter.
+
+Only the SD1 CLIP tokenizer is needed, not a checkpoint. Run from the webui directory, in its venv:
+
+    python -m test.benchmarks.bench_prompt_parsing --repeats 200
+"""
+
+import argparse
+import os
+import sys
+import time
+import types
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--steps", type=int, default=30)
+parser.add_argument("--repeats", type=int, default=100)
+parser.add_argument("--tokenizer", type=str, default="openai/clip-vit-large-patch14")
+args = parser.parse_args()
+
+sys.argv = sys.argv[:1]  # webui parses the command line on import
+os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+
+from modules import prompt_parser, sd_hijack, sd_hijack_clip  # noqa: E402
+
+prompts = [
+    "a photograph of an astronaut riding a horse",
+    "masterpiece, best quality, (detailed face:1.2), portrait of a woman, [[freckles]], soft lighting, film grain, 85mm, bokeh",
+    "a [cat:dog:0.4] eating ice cream, ((highly detailed)), (sharp focus:1.1), studio lighting",
+    "[oil painting|watercolor] of a lighthouse at [dawn:dusk:10], waves crashing, (dramatic sky:1.3), by a famous artist",
+    "landscape, mountains, lake, reflections, golden hour, " * 8 + "(volumetric light:1.2)",
+]
+
+
+def measure(func, clear):
+    """average time of one call of func, in milliseconds"""
+
+    total = 0
+    for _ in range(args.repeats):
+        if clear is not None:
+            clear()
+
+        t = time.perf_counter()
+        func()
+        total += time.perf_counter() - t
+
+    return total / args.repeats * 1000
+
+
+def make_clip():
+    from transformers import CLIPTokenizer
+
+    wrapped = types.SimpleNamespace(tokenizer=CLIPTokenizer.from_pretrained(args.tokenizer))
+
+    return sd_hijack_clip.FrozenCLIPEmbedderWithCustomWords(wrapped, sd_hijack.model_hijack)
+
+
+def main():
+    parse = lambda: prompt_parser.get_learned_conditioning_prompt_schedules(prompts, args.steps)
+    cold = measure(parse, prompt_parser.schedules_cache.clear)
+    warm = measure(parse, None)
+    print(f"parse {len(prompts)} prompts: {cold:.3f} ms uncached, {warm:.4f} ms cached")
+
+    clip = make_clip()
+    texts = sorted({text for schedule in parse() for _, text in schedule})
+    tokenize = lambda: clip.process_texts(texts)
+    cold = measure(tokenize, clip.chunks_cache.clear)
+    warm = measure(tokenize, None)
+    print(f"tokenize {len(texts)} texts: {cold:.3f} ms uncached, {warm:.4f} ms cached")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Measures how long it takes to decode a batch of latents with the VAE, for different values of the
+sd_vae_decode_batch_size setting (0 picks the sub-batch size from free VRAM).
+
+Uses a randomly initialized SD1 VAE built from configs/v1-inference.yaml, so no checkpoint is needed; decoding speed
+does not depend on weights. Run from the webui directory, in its venv:
+
+    python -m test.benchmarks.bench_vae_decode --batch-size 8 --decode-batch-sizes 1 2 4 8 0
+"""
+
+import argparse
+import os
+import sys
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--batch-size", type=int, default=8, help="number of latents to decode")
+parser.add_argument("--width", type=int, default=512)
+parser.add_argument("--height", type=int, default=512)
+parser.add_argument("--decode-batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 0], help="values of sd_vae_decode_batch_size to try")
+parser.add_argument("--repeats", type=int, default=3)
+args = parser.parse_args()
+
+sys.argv = sys.argv[:1]  # webui parses the command line on import
+os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+
+import torch  # noqa: E402
+from omegaconf import OmegaConf  # noqa: E402
+
+from modules import paths, devices, shared, processing  # noqa: E402
+
+
+class DummyModel:
+    def __init__(self, first_stage_model, scale_factor):
+        self.first_stage_model = first_stage_model
+        self.scale_factor = scale_factor
+
+    def decode_first_stage(self, z):
+        return self.first_stage_model.decode(z / self.scale_factor)
+
+
+def load_dummy_model():
+    from ldm.util import instantiate_from_config
+
+    config = OmegaConf.load(os.path.join(paths.script_path, "configs", "v1-inference.yaml"))
+    first_stage_model = instantiate_from_config(config.model.params.first_stage_config)
+
+    if devices.device.type != "cuda":
+        devices.dtype_vae = torch.float32
+
+    first_stage_model.to(devices.device, devices.dtype_vae).eval()
+
+    return DummyModel(first_stage_model, config.model.params.scale_factor)
+
+
+def synchronize():
+    if devices.device.type == "cuda":
+        torch.cuda.synchronize(devices.device)
+
+
+def measure(model, latents):
+    synchronize()
+    t = time.perf_counter()
+    processing.decode_latent_batch(model, latents, target_device=devices.cpu)
+    synchronize()
+
+    return time.perf_counter() - t
+
+
+def main():
+    model = load_dummy_model()
+    latents = torch.randn((args.batch_size, 4, args.height // processing.opt_f, args.width // processing.opt_f), device=devices.device)
+
+    print(f"device: {devices.device}, dtype: {devices.dtype_vae}, {args.batch_size} latents of {args.width}x{args.height}")
+
+    with torch.no_grad():
+        for decode_batch_size in args.decode_batch_sizes:
+            shared.opts.sd_vae_decode_batch_size = decode_batch_size
+
+            measure(model, latents[:1])  # warmup
+            best = min(measure(model, latents) for _ in range(args.repeats))
+
+            actual = processing.get_decode_batch_size(latents)
+            print(f"sd_vae_decode_batch_size={decode_batch_size} (decodes {actual} at once): {best:.3f} s total, {best / args.batch_size * 1000:.1f} ms per image")
+
+
+if __name__ == "__main__":
+    main()
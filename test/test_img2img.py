@@ -66,3 +66,11 @@ def test_img2img_sd_upscale_performed(url_img2img, simple_img2img_request):
     simple_img2img_request["script_name"] = "sd upscale"
     simple_img2img_request["script_args"] = ["", 8, "Lanczos", 2.0]
     assert requests.post(url_img2img, json=simple_img2img_request).status_code == 200
+
+
+def test_img2img_sd_upscale_image_smaller_than_tile(url_img2img, simple_img2img_request):
+    simple_img2img_request["width"] = 128
+    simple_img2img_request["height"] = 96
+    simple_img2img_request["script_name"] = "sd upscale"
+    simple_img2img_request["script_args"] = ["", 8, "None", 1.0]
+    assert requests.post(url_img2img, json=simple_img2img_request).status_code == 200
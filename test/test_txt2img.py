@@ -1,3 +1,5 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 import requests
@@ -88,3 +90,31 @@ def test_txt2img_multiple_batches_performed(url_txt2img, simple_txt2img_request)
 def test_txt2img_batch_performed(url_txt2img, simple_txt2img_request):
     simple_txt2img_request["batch_size"] = 2
     assert requests.post(url_txt2img, json=simple_txt2img_request).status_code == 200
+
+
+def test_txt2img_merged_requests_split_performed(base_url, url_txt2img, simple_txt2img_request):
+    url_options = f"{base_url}/sdapi/v1/options"
+    options = requests.get(url_options).json()
+    assert requests.post(url_options, json={"api_txt2img_batch_window": 1000}).status_code == 200
+
+    try:
+        payloads = []
+        for i, batch_size in enumerate([2, 1]):
+            payload = dict(simple_txt2img_request, prompt=f"example prompt {i}", seed=1000 * (i + 1), batch_size=batch_size, save_images=True)
+            payloads.append(payload)
+
+        with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+            responses = list(executor.map(lambda payload: requests.post(url_txt2img, json=payload), payloads))
+    finally:
+        requests.post(url_options, json={"api_txt2img_batch_window": options["api_txt2img_batch_window"]})
+
+    for payload, response in zip(payloads, responses):
+        assert response.status_code == 200
+
+        info = json.loads(response.json()["info"])
+        has_grid = options["return_grid"] and not (payload["batch_size"] < 2 and options["grid_only_if_multiple"])
+
+        assert info["all_prompts"] == [payload["prompt"]] * payload["batch_size"]
+        assert info["all_seeds"] == [payload["seed"] + x for x in range(payload["batch_size"])]
+        assert info["index_of_first_image"] == (1 if has_grid else 0)
+        assert len(response.json()["images"]) == payload["batch_size"] + (1 if has_grid else 0)